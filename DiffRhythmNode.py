@@ -21,12 +21,19 @@ from einops import rearrange
 import sys
 import os
 import json
+import time
+from contextlib import nullcontext
 from muq import MuQMuLan
 
 current_dir = os.path.dirname(os.path.abspath(__file__))
 sys.path.append(current_dir)
 
 from model import DiT, CFM
+from model.quantize import QUANT_MODES, quantize_dit
+from model.offload import OFFLOAD_MODES, OffloadScheduler
+from model.attention import ATTENTION_BACKENDS
+from model.callbacks import SamplingCallback, CallbackList
+from model.tracing import LATENCY_STATS, Tracer, trace_span
 
 from diffrhythm_utils import (
     decode_audio,
@@ -35,9 +42,101 @@ from diffrhythm_utils import (
     get_reference_latent,
     CNENTokenizer,
     load_checkpoint,
+    prepare_audio,
+    encode_audio,
+    remember_latent,
+    splice_audio,
+    save_latent,
+    load_latent,
 )
 
 
+TRACE_MODES = ["off", "spans", "profiler"]
+
+
+def _stage(offloader, name, prefetch=None):
+    if offloader is None:
+        return nullcontext()
+    return offloader.stage(name, prefetch=prefetch)
+
+
+def sample_latent(
+    cfm_model,
+    cond,
+    text,
+    duration,
+    style_prompt,
+    negative_style_prompt,
+    start_time,
+    offloader=None,
+    **sample_kwargs,
+):
+    with _stage(offloader, "cfm", prefetch="vae"), torch.inference_mode():
+        generated, _ = cfm_model.sample(
+            cond=cond,
+            text=text,
+            duration=duration,
+            style_prompt=style_prompt,
+            negative_style_prompt=negative_style_prompt,
+            steps=32,
+            cfg_strength=4.0,
+            start_time=start_time,
+            **sample_kwargs,
+        )
+
+    return generated.to(torch.float32)  # [b t d]
+
+
+class ComfyProgress(SamplingCallback):
+    """
+    Feeds a ComfyUI progress bar with the sampling steps and decoded chunks, and stops at the next step
+    when the queue is interrupted.
+    """
+
+    def __init__(self, verbose=True):
+        self.verbose = verbose
+        self.pbar = None
+
+    def on_stage_start(self, stage, total):
+        import comfy.model_management
+        from comfy.utils import ProgressBar
+        comfy.model_management.throw_exception_if_processing_interrupted()
+        self.pbar = ProgressBar(total)
+
+    def on_step(self, stage, step, total, elapsed):
+        import comfy.model_management
+        self.pbar.update_absolute(step, total)
+        comfy.model_management.throw_exception_if_processing_interrupted()
+
+    def on_stage_end(self, stage, elapsed):
+        if self.verbose:
+            print(f"DiffRhythm {stage}: {elapsed:.2f} s")
+
+
+def release_device(offloader, *models):
+    # called when a run is interrupted or fails: the weights are dropped right away instead of
+    # holding the device until the exception is discarded. The next run loads the models again,
+    # a cached compiled model included (see DiffRhythmRun.prepare_compiled_model).
+    if offloader is not None:
+        for stage in offloader.stages.values():
+            stage.offload()
+    for model in models:
+        if model is None:
+            continue
+        try:
+            model.to("meta")
+        except Exception:
+            # scripted modules (the VAE) can't move to meta
+            model.to("cpu")
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+
+def _on_device(model, device):
+    param = next(model.parameters(), None)
+    return param is not None and param.device.type == torch.device(device).type
+
+
 def inference(
     cfm_model,
     vae_model,
@@ -48,38 +147,237 @@ def inference(
     negative_style_prompt,
     start_time,
     chunked=False,
+    offloader=None,
+    callback=None,
+    tracer=None,
+):
+        with trace_span(tracer, "sample"):
+            generated = sample_latent(
+                cfm_model, cond, text, duration, style_prompt, negative_style_prompt, start_time, offloader=offloader,
+                callback=callback,
+            )
+        latent = generated.transpose(1, 2)  # [b d t]
+
+        with _stage(offloader, "vae"), trace_span(tracer, "decode"):
+            output = decode_audio(latent, vae_model, chunked=chunked, callback=callback)
+
+        with trace_span(tracer, "postprocess"):
+            return postprocess_audio(output)
+
+
+def postprocess_audio(output):
+    # Rearrange audio batch to a single sequence
+    output = rearrange(output, "b d n -> d (b n)")
+    # Peak normalize, clip, convert to int16, and save to file
+    output = (
+        output.to(torch.float32)
+        .div(torch.max(torch.abs(output)))
+        .clamp(-1, 1)
+        .mul(32767)
+        .to(torch.int16)
+        .cpu()
+    )
+    return output
+
+
+def sample_long(
+    cfm_model,
+    tokenizer,
+    lyrics,
+    style_prompt,
+    negative_style_prompt,
+    window_frames,
+    total_frames,
+    context_frames=None,
+    device="cpu",
+    **sample_kwargs,
 ):
+    """
+    Generates total_frames of latent window by window. Each window after the first is conditioned
+    on the last context_frames of the song so far and only predicts the rest, with the lyrics
+    re-timed to the window start, so every window keeps the attention cost of a single generation.
+    """
+    context_frames = context_frames or window_frames // 4
+    latents = None
+    start = 0
+    while True:
+        text, start_time = get_lrc_token(
+            window_frames, lyrics, tokenizer, device, start_frame=start, total_frames=total_frames
+        )
+        cond = torch.zeros(1, window_frames, cfm_model.num_channels, device=device)
+        if latents is not None:
+            cond[:, :context_frames] = latents[:, -context_frames:]
+
         with torch.inference_mode():
             generated, _ = cfm_model.sample(
                 cond=cond,
                 text=text,
-                duration=duration,
+                duration=window_frames,
                 style_prompt=style_prompt,
                 negative_style_prompt=negative_style_prompt,
                 steps=32,
                 cfg_strength=4.0,
                 start_time=start_time,
+                latent_pred_start_frame=0 if latents is None else context_frames,
+                use_cond=latents is not None,
+                **sample_kwargs,
             )
+        generated = generated.to(torch.float32)
+
+        if latents is None:
+            latents = generated
+        else:
+            # the context frames of the window are the previous tail, pasted back unchanged
+            latents = torch.cat([latents, generated[:, context_frames:]], dim=1)
 
+        if start + window_frames >= total_frames:
+            break
+        start = latents.shape[1] - context_frames
 
-        generated = generated.to(torch.float32)
-        latent = generated.transpose(1, 2)  # [b d t]
+    return latents[:, :total_frames]
 
-        output = decode_audio(latent, vae_model, chunked=chunked)
-
-        # Rearrange audio batch to a single sequence
-        output = rearrange(output, "b d n -> d (b n)")
-        # Peak normalize, clip, convert to int16, and save to file
-        output = (
-            output.to(torch.float32)
-            .div(torch.max(torch.abs(output)))
-            .clamp(-1, 1)
-            .mul(32767)
-            .to(torch.int16)
-            .cpu()
+
+def inference_long(
+    cfm_model,
+    vae_model,
+    tokenizer,
+    lyrics,
+    style_prompt,
+    negative_style_prompt,
+    window_frames,
+    total_frames,
+    context_frames=None,
+    offloader=None,
+    device="cpu",
+    callback=None,
+):
+    with _stage(offloader, "cfm", prefetch="vae"):
+        generated = sample_long(
+            cfm_model, tokenizer, lyrics, style_prompt, negative_style_prompt,
+            window_frames, total_frames, context_frames=context_frames, device=device, callback=callback,
+        )
+    latent = generated.transpose(1, 2)  # [b d t]
+
+    # one streaming decode over the stitched latent, memory bounded by the chunk size
+    with _stage(offloader, "vae"):
+        output = decode_audio(latent, vae_model, chunked=True, callback=callback)
+
+    return postprocess_audio(output)
+
+
+def regenerate_span(
+    cfm_model,
+    tokenizer,
+    song_latent,
+    start_frame,
+    end_frame,
+    lyrics,
+    style_prompt,
+    negative_style_prompt,
+    max_frames,
+    context_frames=256,
+    device="cpu",
+    **sample_kwargs,
+):
+    """
+    Regenerates song_latent[:, start_frame:end_frame] ([1, t, 64]) and returns the spliced latent.
+    Only a window of context_frames on each side of the span is sampled, conditioned on the
+    unchanged music around it, with the (absolute time) lyrics re-timed to the window start.
+    """
+    total_frames = song_latent.shape[1]
+    span = end_frame - start_frame
+    if span <= 0 or span > max_frames:
+        raise ValueError(f"The edited span must be between 1 and {max_frames} frames, got {span}")
+    context_frames = min(context_frames, (max_frames - span) // 2)
+    window_start = max(0, start_frame - context_frames)
+    window_end = min(total_frames, end_frame + context_frames)
+    window_frames = window_end - window_start
+
+    text, start_time = get_lrc_token(
+        window_frames, lyrics, tokenizer, device, start_frame=window_start, total_frames=total_frames
+    )
+    with torch.inference_mode():
+        generated, _ = cfm_model.sample(
+            cond=song_latent[:, window_start:window_end].to(device),
+            text=text,
+            duration=window_frames,
+            style_prompt=style_prompt,
+            negative_style_prompt=negative_style_prompt,
+            steps=32,
+            cfg_strength=4.0,
+            start_time=start_time,
+            latent_pred_start_frame=start_frame - window_start,
+            latent_pred_end_frame=end_frame - window_start,
+            use_cond=True,
+            **sample_kwargs,
         )
 
-        return output
+    latent = song_latent.clone().to(device)
+    latent[:, start_frame:end_frame] = generated[:, start_frame - window_start : end_frame - window_start].to(latent.dtype)
+    return latent
+
+
+def decode_span(vae_model, latent, audio, start_frame, end_frame, margin_frames=32, callback=None):
+    """
+    Decodes only the latent chunks around [start_frame, end_frame) and splices them into audio ([1, 2, n]),
+    crossfading over margin_frames / 2 of unchanged music on each side.
+    """
+    downsample_rate = 2048
+    decode_start = max(0, start_frame - margin_frames)
+    decode_end = min(latent.shape[1], end_frame + margin_frames)
+    with torch.inference_mode():
+        decoded = decode_audio(
+            latent[:, decode_start:decode_end].transpose(1, 2), vae_model, chunked=decode_end - decode_start > 128,
+            callback=callback,
+        )
+    end = min(end_frame * downsample_rate, audio.shape[-1])
+    return splice_audio(
+        audio, decoded.float(), decode_start * downsample_rate,
+        start_frame * downsample_rate, end, fade=margin_frames // 2 * downsample_rate,
+    )
+
+
+class PreviewReporter:
+    """
+    CFM.sample preview callback for ComfyUI: decodes a short section from the middle of the running
+    estimate of the final latent, writes it to the temp folder and announces it on the "diffrhythm.preview" event.
+    The interrupt button stops sampling at the next preview, and filter_fn(audio) returning False
+    lets automated checks drop a bad generation early.
+    """
+
+    def __init__(self, vae_model, unique_id=None, preview_frames=256, filter_fn=None, offloader=None):
+        self.vae_model = vae_model
+        self.unique_id = unique_id
+        self.preview_frames = preview_frames
+        self.filter_fn = filter_fn
+        self.offloader = offloader
+
+    def __call__(self, step, estimate):
+        import comfy.model_management
+        comfy.model_management.throw_exception_if_processing_interrupted()
+
+        if self.offloader is not None:
+            self.offloader.ensure("vae")
+        start = max(0, (estimate.shape[1] - self.preview_frames) // 2)
+        section = estimate[:1, start : start + self.preview_frames].float().transpose(1, 2)
+        audio = decode_audio(section, self.vae_model).float()
+        audio = (audio / audio.abs().max().clamp(min=1e-8)).cpu()
+
+        self.send(step, audio[0])
+
+        if self.filter_fn is not None and not self.filter_fn(audio):
+            return False
+
+    def send(self, step, audio):
+        import folder_paths
+        from server import PromptServer
+        filename = f"diffrhythm_preview_{self.unique_id}_{step:03d}.wav"
+        torchaudio.save(os.path.join(folder_paths.get_temp_directory(), filename), audio, 44100)
+        PromptServer.instance.send_sync("diffrhythm.preview", {
+            "node": self.unique_id,
+            "step": step,
+            "audio": {"filename": filename, "subfolder": "", "type": "temp"},
+        })
 
 
 class MultiLinePrompt:
@@ -114,6 +412,8 @@ class DiffRhythmRun:
     comfy_path = os.path.dirname(os.path.dirname(node_dir))
     model_path = os.path.join(comfy_path, "models", "TTS")
     models = ["cfm_model.pt", "cfm_full_model.pt"]
+    # the compiled model of the last compile run, reused by the next ones instead of recompiling
+    _compiled_models = {}
 
     @classmethod
     def INPUT_TYPES(cls):
@@ -131,7 +431,15 @@ class DiffRhythmRun:
                 "style_audio": ("AUDIO", ),
                 "chunked": ("BOOLEAN", {"default": False, "tooltip": "Whether to use chunked decoding."}),
                 "seed": ("INT", {"default": 0, "min": 0, "max": 0xFFFFFFFFFFFFFFFF}),
+                "compile": ("BOOLEAN", {"default": False, "tooltip": "Compile the sampling step with torch.compile, compiled kernels are cached on disk."}),
+                "quantize": (QUANT_MODES, {"default": "none", "tooltip": "Quantize the DiT at load time. int8_dynamic runs on CPU only and is the faster mode there. The weight-only modes cut the model's memory but dequantize every layer on the fly, so they run slower than none (int8_weight_only uses a fused int8 kernel on CPU)."}),
+                "offload": (OFFLOAD_MODES, {"default": "none", "tooltip": "Keep only the active model (or DiT layer) on the GPU, for low-VRAM cards."}),
+                "attention": (ATTENTION_BACKENDS, {"default": "sdpa", "tooltip": "Attention kernel, chunked keeps memory linear in frames on CPU."}),
+                "song_length": ("INT", {"default": 0, "min": 0, "max": 1200, "tooltip": "Song length in seconds. 0 uses the model length (95 s or 285 s), shorter songs are cut from it, longer songs are generated in overlapping windows."}),
+                "preview_every": ("INT", {"default": 0, "min": 0, "max": 32, "tooltip": "Decode a short preview of the song every N sampling steps, 0 disables previews."}),
+                "trace": (TRACE_MODES, {"default": "off", "tooltip": "Write a Chrome trace of the run's stages and steps to output/diffrhythm/traces, profiler also records torch kernels."}),
             },
+            "hidden": {"unique_id": "UNIQUE_ID"},
         }
 
     CATEGORY = "MW-DiffRhythm"
@@ -147,42 +455,142 @@ class DiffRhythmRun:
             lyrics_prompt: str = "",
             style_audio: str = None,
             chunked: bool = False,
-            seed: int = 0):
+            seed: int = 0,
+            compile: bool = False,
+            quantize: str = "none",
+            offload: str = "none",
+            attention: str = "sdpa",
+            song_length: int = 0,
+            preview_every: int = 0,
+            trace: str = "off",
+            unique_id=None):
+
+        tracer = self.start_trace(trace)
+        try:
+            latent, vae, offloader = self.generate_latent(
+                model, style_prompt, lyrics_prompt, style_audio, compile, quantize, offload, attention, song_length,
+                preview_every=preview_every, unique_id=unique_id, tracer=tracer,
+            )
+
+            # songs longer than the model length always decode in chunks
+            chunked = chunked or latent.shape[1] > 6144
+            try:
+                with _stage(offloader, "vae"), trace_span(tracer, "decode"):
+                    output = decode_audio(
+                        latent.transpose(1, 2), vae, chunked=chunked, callback=CallbackList(ComfyProgress(), tracer)
+                    )
+            except Exception:
+                release_device(offloader, vae)
+                raise
+
+            with trace_span(tracer, "postprocess"):
+                audio_tensor = postprocess_audio(output).unsqueeze(0)
+        except Exception:
+            self.abort_trace(tracer)
+            raise
+        self.finish_trace(tracer)
+        return ({"waveform": audio_tensor, "sample_rate": 44100},)
+
+    def start_trace(self, trace):
+        if trace == "off":
+            return None
+        return Tracer(device=self.device, profile=trace == "profiler")
+
+    def abort_trace(self, tracer):
+        # stops a running profiler, nothing is written for a failed run
+        if tracer is not None:
+            tracer.finish()
+
+    def finish_trace(self, tracer):
+        if tracer is None:
+            return
+        import folder_paths
+        path = os.path.join(
+            folder_paths.get_output_directory(), "diffrhythm", "traces", f"trace_{time.strftime('%Y%m%d_%H%M%S')}.json"
+        )
+        tracer.finish(path)
+        print(f"DiffRhythm trace written to {path}")
+        print(LATENCY_STATS.report())
+
+    def generate_latent(
+            self,
+            model: str,
+            style_prompt: str,
+            lyrics_prompt: str = "",
+            style_audio=None,
+            compile: bool = False,
+            quantize: str = "none",
+            offload: str = "none",
+            attention: str = "sdpa",
+            song_length: int = 0,
+            preview_every: int = 0,
+            unique_id=None,
+            tracer=None):
 
         if model == "cfm_model.pt":
             max_frames = 2048
         elif model == "cfm_full_model.pt":
             max_frames = 6144
 
-        cfm, tokenizer, muq, vae = self.prepare_model(model, self.device)
+        offloader = OffloadScheduler(self.device, mode=offload) if offload != "none" else None
+        with trace_span(tracer, "load_models"):
+            if compile and offloader is None:
+                cfm, tokenizer, muq, vae = self.prepare_compiled_model(model, quantize=quantize, attention=attention)
+            else:
+                cfm, tokenizer, muq, vae = self.prepare_model(
+                    model, self.device, quantize=quantize, offloader=offloader, attention=attention
+                )
+                if compile:
+                    cfm.enable_compile(cache_dir=f"{self.model_path}/DiffRhythm/compile_cache")
 
-        lrc_prompt, start_time = get_lrc_token(max_frames, lyrics_prompt, tokenizer, self.device)
+        with trace_span(tracer, "g2p"):
+            lrc_prompt, start_time = get_lrc_token(max_frames, lyrics_prompt, tokenizer, self.device)
 
-        if style_audio:
-            prompt = self.get_style_prompt(muq, style_audio)
-        else:
-            prompt = self.get_style_prompt(muq, prompt=style_prompt)
+        with _stage(offloader, "muq", prefetch="cfm"), trace_span(tracer, "style_embed"):
+            if style_audio:
+                prompt = self.get_style_prompt(muq, style_audio)
+            else:
+                prompt = self.get_style_prompt(muq, prompt=style_prompt)
 
         negative_style_prompt = get_negative_style_prompt(self.device)
         latent_prompt = get_reference_latent(self.device, max_frames)
 
+        sample_kwargs = {"callback": CallbackList(ComfyProgress(), tracer)}
+        if preview_every > 0:
+            sample_kwargs["preview_callback"] = PreviewReporter(vae, unique_id=unique_id, offloader=offloader)
+            sample_kwargs["preview_every"] = preview_every
+
+        total_frames = int(song_length * 44100 / 2048)
         try:
-            generated_song = inference(
-                cfm_model=cfm,
-                vae_model=vae,
-                cond=latent_prompt,
-                text=lrc_prompt,
-                duration=max_frames,
-                style_prompt=prompt,
-                negative_style_prompt=negative_style_prompt,
-                start_time=start_time,
-                chunked=chunked,
-            )
-        except Exception as e:
+            if total_frames > max_frames:
+                with _stage(offloader, "cfm", prefetch="vae"), trace_span(tracer, "sample"):
+                    latent = sample_long(
+                        cfm, tokenizer, lyrics_prompt, prompt, negative_style_prompt,
+                        window_frames=max_frames, total_frames=total_frames, device=self.device, **sample_kwargs,
+                    )
+            else:
+                with trace_span(tracer, "sample"):
+                    latent = sample_latent(
+                        cfm_model=cfm,
+                        cond=latent_prompt,
+                        text=lrc_prompt,
+                        duration=max_frames,
+                        style_prompt=prompt,
+                        negative_style_prompt=negative_style_prompt,
+                        start_time=start_time,
+                        offloader=offloader,
+                        **sample_kwargs,
+                    )
+        except Exception:
+            # an interrupted run frees the GPU now rather than after the remaining steps
+            release_device(offloader, cfm, muq, vae)
             raise
 
-        audio_tensor = generated_song.unsqueeze(0)
-        return ({"waveform": audio_tensor, "sample_rate": 44100},)
+        # the model always fills its window, a shorter song is cut from it (as diffrhythm_cli does)
+        if 0 < total_frames < max_frames:
+            latent = latent[:, :total_frames]
+
+        return latent, vae, offloader
 
     @torch.no_grad()
     def get_style_prompt(self, model, audio=None, prompt=None):
@@ -231,8 +639,9 @@ class DiffRhythmRun:
 
         return audio_emb
 
-    def prepare_model(self, model, device):
+    def prepare_model(self, model, device, quantize="none", offloader=None, attention="sdpa"):
         from huggingface_hub import snapshot_download
+        self.release_compiled_models()
         # prepare cfm model
         if model == "cfm_full_model.pt":
             dit_ckpt_path = f"{self.model_path}/DiffRhythm/cfm_full_model.pt"
@@ -248,13 +657,6 @@ class DiffRhythmRun:
                 snapshot_download(repo_id="ASLP-lab/DiffRhythm-base",
                                     local_dir=f"{self.model_path}/DiffRhythm")
 
-        vae_ckpt_path = f"{self.model_path}/DiffRhythm/vae_model.pt"
-
-        if not os.path.exists(vae_ckpt_path):
-            snapshot_download(repo_id="ASLP-lab/DiffRhythm-vae",
-                                local_dir=f"{self.model_path}/DiffRhythm",
-                                ignore_patterns=["*safetensors"])
-
         try:
             with open(dit_config_path, "r", encoding="utf-8") as f:
                 model_config = json.load(f)
@@ -264,22 +666,35 @@ class DiffRhythmRun:
         dit_model_cls = DiT
         if model == "cfm_model.pt":
             cfm = CFM(
-                transformer=dit_model_cls(**model_config["model"], use_style_prompt=True, max_pos=2048),
+                transformer=dit_model_cls(**model_config["model"], use_style_prompt=True, max_pos=2048, fused_blocks=True, attn_backend=attention),
                 num_channels=model_config["model"]["mel_dim"],
             )
         elif model == "cfm_full_model.pt":
             cfm = CFM(
-                    transformer=dit_model_cls(**model_config["model"], use_style_prompt=True, max_pos=6144),
+                    transformer=dit_model_cls(**model_config["model"], use_style_prompt=True, max_pos=6144, fused_blocks=True, attn_backend=attention),
                     num_channels=model_config["model"]['mel_dim'],
                     use_style_prompt=True
                 )
-        cfm = cfm.to(device)
+        # with an offloader the models are loaded on the host and moved by it
+        load_device = device if offloader is None else "cpu"
+        cfm = cfm.to(load_device)
+
+        # fp16 is slow or unsupported on CPU, quantized CPU inference starts from fp32 weights
+        if quantize == "int8_dynamic" and device != "cpu":
+            raise ValueError("int8_dynamic quantization only runs on CPU")
+        dtype = torch.float32 if (quantize != "none" and device == "cpu") or device == "mps" else None
 
         try:
-            cfm = load_checkpoint(cfm, dit_ckpt_path, device=device, use_ema=False)
+            cfm = load_checkpoint(cfm, dit_ckpt_path, device=load_device, use_ema=False, dtype=dtype)
         except Exception as e:
             raise
 
+        if quantize != "none":
+            quantize_dit(
+                cfm.transformer, quantize, cache_path=f"{dit_ckpt_path}.{quantize}.qcache.safetensors",
+                source_path=dit_ckpt_path,
+            )
+
         # prepare tokenizer
         try:
             tokenizer = CNENTokenizer()
@@ -293,27 +708,289 @@ class DiffRhythmRun:
         except Exception as e:
             raise
 
-        muq = muq.to(device).eval()
+        muq = muq.to(load_device).eval()
 
         # prepare vae
+        vae = self.prepare_vae(load_device)
+
+        if offloader is not None:
+            offloader.register("muq", muq)
+            offloader.register("cfm", cfm, layers=cfm.transformer.transformer_blocks)
+            offloader.register("vae", vae)
+
+        return cfm, tokenizer, muq, vae
+
+    @staticmethod
+    def release_compiled_models():
+        # a run loading its own models drops the cached compiled set first, two sets don't fit on most cards
+        for cfm, _, muq, vae in DiffRhythmRun._compiled_models.values():
+            release_device(None, cfm, muq, vae)
+        DiffRhythmRun._compiled_models.clear()
+
+    def prepare_compiled_model(self, model, quantize="none", attention="sdpa"):
+        # prepare_model and enable_compile once, the later runs with the same settings reuse the
+        # compiled model. Offloaded models aren't cached, the offloader is built per run.
+        key = (model, self.device, quantize, attention)
+        models = DiffRhythmRun._compiled_models.get(key)
+        # a failed run released the weights (release_device), they are loaded again
+        if models is None or not all(_on_device(m, self.device) for m in (models[0], models[2], models[3])):
+            # only one set is kept, the models are too large to hold several
+            self.release_compiled_models()
+            models = self.prepare_model(model, self.device, quantize=quantize, attention=attention)
+            models[0].enable_compile(cache_dir=f"{self.model_path}/DiffRhythm/compile_cache")
+            DiffRhythmRun._compiled_models[key] = models
+        return models
+
+    def prepare_vae(self, device):
+        from huggingface_hub import snapshot_download
+        vae_ckpt_path = f"{self.model_path}/DiffRhythm/vae_model.pt"
+
+        if not os.path.exists(vae_ckpt_path):
+            snapshot_download(repo_id="ASLP-lab/DiffRhythm-vae",
+                                local_dir=f"{self.model_path}/DiffRhythm",
+                                ignore_patterns=["*safetensors"])
+
         try:
             vae = torch.jit.load(vae_ckpt_path, map_location="cpu").to(device)
         except Exception as e:
             raise
 
-        return cfm, tokenizer, muq, vae
+        return vae
 
 
-from MWAudioRecorderDR import AudioRecorderDR
+class DiffRhythmEdit(DiffRhythmRun):
+    @classmethod
+    def INPUT_TYPES(cls):
+
+        return {
+            "required": {
+                "model": (cls.models, {"default": "cfm_full_model.pt"}),
+                "audio": ("AUDIO", ),
+                "start_time": ("FLOAT", {"default": 0.0, "min": 0.0, "max": 1200.0, "step": 0.1, "tooltip": "Start of the regenerated span in seconds."}),
+                "end_time": ("FLOAT", {"default": 10.0, "min": 0.0, "max": 1200.0, "step": 0.1, "tooltip": "End of the regenerated span in seconds."}),
+                "style_prompt": ("STRING", {
+                    "multiline": True,
+                    "default": ""}),
+                },
+            "optional": {
+                "lyrics_prompt": ("STRING", {"tooltip": "Lyrics with timestamps of the whole song, lines inside the span are sung anew."}),
+                "style_audio": ("AUDIO", ),
+                "context_seconds": ("FLOAT", {"default": 12.0, "min": 0.0, "max": 60.0, "step": 0.5, "tooltip": "Unchanged music on each side of the span the model conditions on."}),
+                "latent": ("LATENT", {"tooltip": "Latent of the audio (e.g. from DiffRhythm Sample), skips encoding it."}),
+                "seed": ("INT", {"default": 0, "min": 0, "max": 0xFFFFFFFFFFFFFFFF}),
+            },
+        }
+
+    CATEGORY = "MW-DiffRhythm"
+    RETURN_TYPES = ("AUDIO", "LATENT")
+    RETURN_NAMES = ("audio", "latent")
+    FUNCTION = "diffrhythmedit"
+
+    def diffrhythmedit(
+            self,
+            model: str,
+            audio,
+            start_time: float,
+            end_time: float,
+            style_prompt: str,
+            lyrics_prompt: str = "",
+            style_audio=None,
+            context_seconds: float = 12.0,
+            latent=None,
+            seed: int = 0):
+
+        if model == "cfm_model.pt":
+            max_frames = 2048
+        elif model == "cfm_full_model.pt":
+            max_frames = 6144
+
+        cfm, tokenizer, muq, vae = self.prepare_model(model, self.device)
+
+        song = prepare_audio(audio["waveform"], audio["sample_rate"], self.device)
+        if latent is not None:
+            song_latent = latent["samples"][:1].to(self.device)
+        else:
+            song_latent = encode_audio(song, vae)
+
+        frames_per_sec = 44100 / 2048
+        start_frame = int(start_time * frames_per_sec)
+        end_frame = min(int(end_time * frames_per_sec), song_latent.shape[1])
+
+        if style_audio:
+            prompt = self.get_style_prompt(muq, style_audio)
+        else:
+            prompt = self.get_style_prompt(muq, prompt=style_prompt)
+        negative_style_prompt = get_negative_style_prompt(self.device)
+
+        try:
+            edited_latent = regenerate_span(
+                cfm, tokenizer, song_latent, start_frame, end_frame, lyrics_prompt, prompt, negative_style_prompt,
+                max_frames, context_frames=int(context_seconds * frames_per_sec), device=self.device,
+                callback=ComfyProgress(), seed=seed,
+            )
+            edited = decode_span(vae, edited_latent, song, start_frame, end_frame, callback=ComfyProgress()).clamp(-1, 1)
+        except Exception:
+            release_device(None, cfm, muq, vae)
+            raise
+
+        output = edited.mul(32767).to(torch.int16).cpu()
+        # editing the result again skips the encoder
+        remember_latent(prepare_audio(output, 44100, self.device), edited_latent)
+        return ({"waveform": output, "sample_rate": 44100}, pack_latent(edited_latent, model))
+
+
+def pack_latent(latent, model):
+    # LATENT as passed between the DiffRhythm nodes, samples are the raw [b, t, 64] CFM output
+    return {"samples": latent.detach().float().cpu(), "model": model, "sample_rate": 44100, "downsample_rate": 2048}
+
+
+class DiffRhythmSample(DiffRhythmRun):
+    @classmethod
+    def INPUT_TYPES(cls):
+        inputs = super().INPUT_TYPES()
+        inputs["optional"].pop("chunked")
+        return inputs
+
+    CATEGORY = "MW-DiffRhythm"
+    RETURN_TYPES = ("LATENT",)
+    RETURN_NAMES = ("latent",)
+    FUNCTION = "diffrhythmsample"
+
+    def diffrhythmsample(
+            self,
+            model: str,
+            style_prompt: str,
+            lyrics_prompt: str = "",
+            style_audio=None,
+            seed: int = 0,
+            compile: bool = False,
+            quantize: str = "none",
+            offload: str = "none",
+            attention: str = "sdpa",
+            song_length: int = 0,
+            preview_every: int = 0,
+            trace: str = "off",
+            unique_id=None):
+
+        tracer = self.start_trace(trace)
+        try:
+            latent, _, _ = self.generate_latent(
+                model, style_prompt, lyrics_prompt, style_audio, compile, quantize, offload, attention, song_length,
+                preview_every=preview_every, unique_id=unique_id, tracer=tracer,
+            )
+        except Exception:
+            self.abort_trace(tracer)
+            raise
+        self.finish_trace(tracer)
+        return (pack_latent(latent, model),)
+
+
+class DiffRhythmDecode(DiffRhythmRun):
+    @classmethod
+    def INPUT_TYPES(cls):
+
+        return {
+            "required": {
+                "latent": ("LATENT", ),
+                },
+            "optional": {
+                "chunked": ("BOOLEAN", {"default": True, "tooltip": "Decode in overlapping chunks, memory stays bounded by the chunk size."}),
+                "chunk_size": ("INT", {"default": 128, "min": 32, "max": 6144, "step": 16}),
+                "overlap": ("INT", {"default": 32, "min": 0, "max": 512, "step": 2}),
+            },
+        }
+
+    CATEGORY = "MW-DiffRhythm"
+    RETURN_TYPES = ("AUDIO",)
+    RETURN_NAMES = ("audio",)
+    FUNCTION = "diffrhythmdecode"
+
+    def diffrhythmdecode(self, latent, chunked: bool = True, chunk_size: int = 128, overlap: int = 32):
+        if overlap >= chunk_size:
+            raise ValueError("overlap must be smaller than chunk_size")
+        vae = self.prepare_vae(self.device)
+        samples = latent["samples"].to(self.device).transpose(1, 2)  # [b d t]
+        with torch.inference_mode():
+            output = decode_audio(
+                samples, vae, chunked=chunked, overlap=overlap, chunk_size=chunk_size, callback=ComfyProgress()
+            )
+        return ({"waveform": postprocess_audio(output).unsqueeze(0), "sample_rate": 44100},)
+
+
+class DiffRhythmSaveLatent:
+    @classmethod
+    def INPUT_TYPES(cls):
+
+        return {
+            "required": {
+                "latent": ("LATENT", ),
+                "filename_prefix": ("STRING", {"default": "diffrhythm/latent"}),
+                },
+        }
+
+    CATEGORY = "MW-DiffRhythm"
+    RETURN_TYPES = ()
+    OUTPUT_NODE = True
+    FUNCTION = "save"
+
+    def save(self, latent, filename_prefix: str):
+        import folder_paths
+        output_dir = folder_paths.get_output_directory()
+        full_output_folder, filename, counter, subfolder, _ = folder_paths.get_save_image_path(filename_prefix, output_dir)
+        file = f"{filename}_{counter:05}_.safetensors"
+        metadata = {k: v for k, v in latent.items() if k != "samples"}
+        save_latent(os.path.join(full_output_folder, file), latent["samples"], metadata=metadata)
+        return {"ui": {"latents": [{"filename": file, "subfolder": subfolder, "type": "output"}]}}
+
+
+class DiffRhythmLoadLatent:
+    @classmethod
+    def INPUT_TYPES(cls):
+
+        return {
+            "required": {
+                "path": ("STRING", {"default": "", "tooltip": "A .safetensors latent saved by DiffRhythm Save Latent, relative to the output folder or absolute."}),
+                },
+        }
+
+    CATEGORY = "MW-DiffRhythm"
+    RETURN_TYPES = ("LATENT",)
+    RETURN_NAMES = ("latent",)
+    FUNCTION = "load"
+
+    def load(self, path: str):
+        if not os.path.isabs(path):
+            import folder_paths
+            path = os.path.join(folder_paths.get_output_directory(), path)
+        samples, metadata = load_latent(path)
+        latent = pack_latent(samples, metadata.get("model", ""))
+        return (latent,)
+
 
 NODE_CLASS_MAPPINGS = {
     "DiffRhythmRun": DiffRhythmRun,
+    "DiffRhythmEdit": DiffRhythmEdit,
+    "DiffRhythmSample": DiffRhythmSample,
+    "DiffRhythmDecode": DiffRhythmDecode,
+    "DiffRhythmSaveLatent": DiffRhythmSaveLatent,
+    "DiffRhythmLoadLatent": DiffRhythmLoadLatent,
     "MultiLinePrompt": MultiLinePrompt,
-    "AudioRecorderDR": AudioRecorderDR
 }
 
+# the recorder needs ComfyUI and an audio device, the rest of this module is also used headless
+try:
+    from MWAudioRecorderDR import AudioRecorderDR
+    NODE_CLASS_MAPPINGS["AudioRecorderDR"] = AudioRecorderDR
+except ImportError as e:
+    print(f"MW Audio Recorder unavailable: {e}")
+
 NODE_DISPLAY_NAME_MAPPINGS = {
     "DiffRhythmRun": "DiffRhythm Run",
+    "DiffRhythmEdit": "DiffRhythm Edit Span",
+    "DiffRhythmSample": "DiffRhythm Sample",
+    "DiffRhythmDecode": "DiffRhythm Decode",
+    "DiffRhythmSaveLatent": "DiffRhythm Save Latent",
+    "DiffRhythmLoadLatent": "DiffRhythm Load Latent",
     "MultiLinePrompt": "Multi Line Prompt",
     "AudioRecorderDR": "MW Audio Recorder"
 }
@@ -0,0 +1,22 @@
+"""
+CPU-runnable benchmarks for DiffRhythm, on a tiny random-weight model.
+
+    python -m benchmarks --out results.json
+    python -m benchmarks --frames 256 1024 --only sample decode --compare baseline.json
+
+benchmarks.checks compares the optimized model paths against their references:
+
+    python -m benchmarks.checks
+"""
+
+from benchmarks.tiny_model import (
+    StubStyleEncoder,
+    StubTokenizer,
+    StubVAE,
+    build_tiny_cfm,
+    load_tiny_config,
+    random_inputs,
+)
+
+
+__all__ = ["StubStyleEncoder", "StubTokenizer", "StubVAE", "build_tiny_cfm", "load_tiny_config", "random_inputs"]
@@ -0,0 +1,6 @@
+import sys
+
+from benchmarks.bench import main
+
+
+sys.exit(main())
@@ -0,0 +1,311 @@
+"""
+Benchmarks of the DiffRhythm inference and data pipeline, written as JSON for regression tracking.
+
+sample  - CFM.sample steps/s of the tiny DiT, per frame length
+decode  - stub VAE decode throughput (audio seconds per second), whole and chunked, per frame length
+g2p     - lyric lines/s through CNENTokenizer and get_lrc_token
+dataset - DiffusionDataset items/s over the example items in dataset/train.scp
+
+Every case also records the peak memory it took above the memory in use when it started.
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import torch
+
+from benchmarks.tiny_model import DOWNSAMPLE_RATE, StubVAE, build_tiny_cfm, load_tiny_config, random_inputs, repo_dir
+from model.callbacks import SamplingCallback
+from model.compile_utils import _synchronize
+
+BENCHMARKS = ["sample", "decode", "g2p", "dataset"]
+
+SAMPLE_RATE = 44100
+
+LYRICS = [
+    "[00:10.00]Walking down the empty road tonight",
+    "[00:14.20]City lights are fading out of sight",
+    "[00:18.50]我们在风中唱着那首歌",
+    "[00:22.80]Every heartbeat echoes what we lost",
+    "[00:27.10]月光洒在安静的街道上",
+    "[00:31.40]Hold on, hold on, we are almost home",
+]
+
+
+def _rss_bytes():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        # no /proc, fall back to the process high-water mark (kilobytes on Linux, bytes on macOS)
+        import resource
+        scale = 1 if sys.platform == "darwin" else 1024
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+
+class PeakMemory:
+    """Peak memory above the start of the block, CUDA allocator stats on GPU, sampled RSS on CPU."""
+
+    def __init__(self, device, interval=0.005):
+        self.device = torch.device(device)
+        self.interval = interval
+        self.peak_mb = None
+
+    def __enter__(self):
+        if self.device.type == "cuda":
+            torch.cuda.synchronize(self.device)
+            torch.cuda.reset_peak_memory_stats(self.device)
+            self.base = torch.cuda.memory_allocated(self.device)
+            return self
+        self.base = self.peak = _rss_bytes()
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self._poll, daemon=True)
+        self.thread.start()
+        return self
+
+    def _poll(self):
+        while not self.stop.wait(self.interval):
+            self.peak = max(self.peak, _rss_bytes())
+
+    def __exit__(self, *exc):
+        if self.device.type == "cuda":
+            torch.cuda.synchronize(self.device)
+            peak = torch.cuda.max_memory_allocated(self.device)
+        else:
+            self.stop.set()
+            self.thread.join()
+            peak = max(self.peak, _rss_bytes())
+        self.peak_mb = (peak - self.base) / 2**20
+        return False
+
+
+class StepTimes(SamplingCallback):
+    def __init__(self):
+        self.times = []
+
+    def on_step(self, stage, step, total, elapsed):
+        self.times.append(elapsed)
+
+
+def _median(values):
+    values = sorted(values)
+    mid = len(values) // 2
+    return values[mid] if len(values) % 2 else (values[mid - 1] + values[mid]) / 2
+
+
+def bench_sample(frames_list, device, steps=8, repeats=2, batch=1, attention="sdpa"):
+    cfm = build_tiny_cfm(max_frames=max(frames_list), device=device, attn_backend=attention)
+    results = []
+    for frames in frames_list:
+        inputs = random_inputs(cfm, frames, batch=batch)
+        with torch.inference_mode():
+            # warm up the allocator and kernels
+            cfm.sample(**inputs, steps=2, cfg_strength=4.0)
+            step_times = []
+            with PeakMemory(device) as mem:
+                for _ in range(repeats):
+                    timer = StepTimes()
+                    cfm.sample(**inputs, steps=steps, cfg_strength=4.0, callback=timer)
+                    step_times.extend(timer.times)
+        step_time = _median(step_times)
+        results.append({
+            "benchmark": "sample",
+            "frames": frames,
+            "batch": batch,
+            "attention": attention,
+            "steps_per_s": 1 / step_time,
+            "ms_per_step": step_time * 1000,
+            "peak_mem_mb": mem.peak_mb,
+        })
+    return results
+
+
+def bench_decode(frames_list, device, repeats=3, chunk_size=128, overlap=32):
+    from diffrhythm_utils import decode_audio
+
+    vae = StubVAE().to(device)
+    results = []
+    for frames in frames_list:
+        latents = torch.randn(1, 64, frames, device=device)
+        for chunked in (False, True):
+            with torch.inference_mode():
+                decode_audio(latents, vae, chunked=chunked, chunk_size=chunk_size, overlap=overlap)
+                times = []
+                with PeakMemory(device) as mem:
+                    for _ in range(repeats):
+                        _synchronize(torch.device(device))
+                        start = time.perf_counter()
+                        decode_audio(latents, vae, chunked=chunked, chunk_size=chunk_size, overlap=overlap)
+                        _synchronize(torch.device(device))
+                        times.append(time.perf_counter() - start)
+            elapsed = _median(times)
+            results.append({
+                "benchmark": "decode",
+                "frames": frames,
+                "chunked": chunked,
+                "audio_s_per_s": frames * DOWNSAMPLE_RATE / SAMPLE_RATE / elapsed,
+                "frames_per_s": frames / elapsed,
+                "peak_mem_mb": mem.peak_mb,
+            })
+    return results
+
+
+def bench_g2p(repeats=5):
+    from diffrhythm_utils import CNENTokenizer, get_lrc_token
+
+    tokenizer = CNENTokenizer()
+    lyrics = "\n".join(LYRICS)
+    get_lrc_token(2048, lyrics, tokenizer, "cpu")
+    times = []
+    with PeakMemory("cpu") as mem:
+        for _ in range(repeats):
+            start = time.perf_counter()
+            get_lrc_token(2048, lyrics, tokenizer, "cpu")
+            times.append(time.perf_counter() - start)
+    return [{
+        "benchmark": "g2p",
+        "lines": len(LYRICS),
+        "lines_per_s": len(LYRICS) / _median(times),
+        "peak_mem_mb": mem.peak_mb,
+    }]
+
+
+def bench_dataset(items=32, max_frames=2048, min_frames=512):
+    from model.dataset import DiffusionDataset
+
+    # the example list uses paths relative to the repo root
+    with open(os.path.join(repo_dir, "dataset", "train.scp"), "r") as f:
+        lines = [line.strip() for line in f if line.strip()]
+    with tempfile.NamedTemporaryFile("w", suffix=".scp", delete=False) as f:
+        for line in lines:
+            utt, *paths = line.split("|")
+            f.write("|".join([utt] + [os.path.join(repo_dir, p) for p in paths]) + "\n")
+        scp_path = f.name
+
+    try:
+        dataset = DiffusionDataset(scp_path, max_frames=max_frames, min_frames=min_frames)
+        with PeakMemory("cpu") as mem:
+            start = time.perf_counter()
+            batch = [dataset[i % len(dataset)] for i in range(items)]
+            elapsed = time.perf_counter() - start
+            collate_start = time.perf_counter()
+            dataset.custom_collate_fn(batch[:8])
+            collate_elapsed = time.perf_counter() - collate_start
+    finally:
+        os.remove(scp_path)
+
+    return [{
+        "benchmark": "dataset",
+        "items": items,
+        "items_per_s": items / elapsed,
+        "collate_ms_per_batch_of_8": collate_elapsed * 1000,
+        "peak_mem_mb": mem.peak_mb,
+    }]
+
+
+def environment(device):
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=repo_dir, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except Exception:
+        commit = None
+    return {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "commit": commit,
+        "python": platform.python_version(),
+        "torch": torch.__version__,
+        "platform": platform.platform(),
+        "device": str(device),
+        "threads": torch.get_num_threads(),
+        "tiny_config": load_tiny_config()["model"],
+    }
+
+
+def run(benchmarks, frames_list, device="cpu", steps=8, attention="sdpa"):
+    results = []
+    errors = {}
+    for name in benchmarks:
+        print(f"running {name} ...")
+        try:
+            if name == "sample":
+                results += bench_sample(frames_list, device, steps=steps, attention=attention)
+            elif name == "decode":
+                results += bench_decode(frames_list, device)
+            elif name == "g2p":
+                results += bench_g2p()
+            elif name == "dataset":
+                results += bench_dataset()
+        except Exception as e:
+            # e.g. the g2p frontend missing, the other benchmarks still report
+            print(f"{name} failed: {e!r}")
+            errors[name] = repr(e)
+    return {"environment": environment(device), "results": results, "errors": errors}
+
+
+# the throughput metric of each benchmark, higher is better
+METRICS = {"sample": "steps_per_s", "decode": "audio_s_per_s", "g2p": "lines_per_s", "dataset": "items_per_s"}
+CASE_KEYS = ("benchmark", "frames", "batch", "chunked", "attention")
+
+
+def compare(report, baseline, tolerance=0.1):
+    """Prints the throughput change of every case against a baseline report, returns the regressed cases."""
+    def key(result):
+        return tuple(result.get(k) for k in CASE_KEYS)
+
+    previous = {key(r): r for r in baseline["results"]}
+    regressions = []
+    for result in report["results"]:
+        old = previous.get(key(result))
+        if old is None:
+            continue
+        metric = METRICS[result["benchmark"]]
+        ratio = result[metric] / old[metric]
+        case = ", ".join(f"{k}={result[k]}" for k in CASE_KEYS[1:] if k in result)
+        print(f"{result['benchmark']:<8} {case:<40} {metric} {old[metric]:.2f} -> {result[metric]:.2f} ({ratio:.2f}x)")
+        if ratio < 1 - tolerance:
+            regressions.append(result)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="DiffRhythm benchmarks on a tiny random-weight model")
+    parser.add_argument("--only", nargs="+", choices=BENCHMARKS, default=BENCHMARKS)
+    parser.add_argument("--frames", nargs="+", type=int, default=[256, 512, 1024, 2048])
+    parser.add_argument("--steps", type=int, default=8, help="sampling steps per sample call")
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--attention", default="sdpa")
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--out", default=None, help="write the results to this JSON file")
+    parser.add_argument("--compare", default=None, help="baseline JSON to compare the throughput against")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="allowed relative slowdown against the baseline")
+    args = parser.parse_args(argv)
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    report = run(args.only, args.frames, device=args.device, steps=args.steps, attention=args.attention)
+    print(json.dumps(report["results"], indent=2))
+
+    if args.out is not None:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"results written to {args.out}")
+
+    if args.compare is not None:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, tolerance=args.tolerance)
+        if regressions:
+            print(f"{len(regressions)} case(s) slower than the baseline by more than {args.tolerance:.0%}")
+            return 1
+    return 0
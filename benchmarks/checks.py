@@ -0,0 +1,238 @@
+"""
+Numerical checks of the optimized model paths against their reference implementations,
+on random weights and fixed seeds, so they run anywhere without checkpoints.
+
+    python -m benchmarks.checks
+    python -m benchmarks.checks --only input_embedding
+
+Every check raises AssertionError with the offending difference, main returns 1 if any failed.
+"""
+
+from __future__ import annotations
+
+import argparse
+import sys
+import traceback
+
+import torch
+
+CHECKS = {}
+
+
+def check(fn):
+    CHECKS[fn.__name__.removeprefix("check_")] = fn
+    return fn
+
+
+def assert_close(actual, expected, atol, rtol, what):
+    if not torch.allclose(actual.float(), expected.float(), atol=atol, rtol=rtol):
+        diff = (actual.float() - expected.float()).abs().max().item()
+        raise AssertionError(f"{what}: max abs difference {diff:.3e} above atol={atol} rtol={rtol}")
+
+
+@check
+def check_input_embedding():
+    """The split-weight InputEmbedding equals proj(cat(x, cond, text, style, time)), also with a half style in fp32"""
+    from model.dit import InputEmbedding
+
+    torch.manual_seed(0)
+    mel_dim, text_dim, cond_dim, dim, b, n = 64, 512, 512, 256, 2, 37
+    embed = InputEmbedding(mel_dim, text_dim, dim, cond_dim).eval()
+    x = torch.randn(b, n, mel_dim)
+    cond = torch.randn(b, n, mel_dim)
+    text = torch.randn(b, n, text_dim)
+    # the style prompts reaching the model are always half
+    style = torch.randn(b, cond_dim).half()
+    time = torch.randn(b, cond_dim)
+
+    def reference(cond):
+        seq = torch.cat((style.float(), time), dim=-1).unsqueeze(1).expand(-1, n, -1)
+        out = embed.proj(torch.cat((x, cond, text, seq), dim=-1))
+        return embed.conv_pos_embed(out) + out
+
+    with torch.no_grad():
+        assert_close(embed(x, cond, text, style, time), reference(cond), 1e-4, 1e-4, "fp32 with cond")
+        zeros = torch.zeros_like(cond)
+        assert_close(embed(x, cond, text, style, time, drop_audio_cond=True), reference(zeros), 1e-4, 1e-4, "dropped cond")
+        assert_close(embed(x, None, text, style, time), reference(zeros), 1e-4, 1e-4, "no cond")
+
+
+@check
+def check_fused_blocks():
+    """LlamaInferenceBlock loads a LlamaDecoderLayer state_dict with no missing keys and matches its output"""
+    from benchmarks.tiny_model import build_tiny_cfm
+
+    hf = build_tiny_cfm(max_frames=256, seed=0, fused_blocks=False).transformer
+    fused = build_tiny_cfm(max_frames=256, seed=1, fused_blocks=True).transformer
+
+    # one layer, loaded on its own
+    hf_layer, fused_layer = hf.transformer_blocks[0], fused.transformer_blocks[0]
+    result = fused_layer.load_state_dict(hf_layer.state_dict(), strict=False)
+    assert not result.missing_keys and not result.unexpected_keys, f"layer remap: {result}"
+    assert set(fused_layer.state_dict()) == set(hf_layer.state_dict()), "state_dict() doesn't give back the HF layout"
+
+    torch.manual_seed(0)
+    x = torch.randn(2, 64, hf.dim)
+    pos_ids = torch.arange(64).unsqueeze(0).repeat(2, 1)
+    rotary = hf.rotary_emb(x, pos_ids)
+    with torch.no_grad():
+        expected = hf_layer(x, position_embeddings=rotary)
+        expected = expected[0] if isinstance(expected, tuple) else expected
+        actual = fused_layer(x, position_embeddings=rotary)[0]
+    # fp16 level tolerance, the fused path only reorders the matmuls
+    assert_close(actual, expected, 1e-3, 1e-3, "block output")
+
+    # the whole DiT, strictly, the way load_checkpoint would load an HF layout checkpoint
+    fused.load_state_dict(hf.state_dict(), strict=True)
+    n = 96
+    x = torch.randn(2, n, 64)
+    text = torch.randint(0, 363, (2, n))
+    time = torch.rand(2)
+    style = torch.randn(2, 512)
+    start_time = torch.zeros(2)
+    with torch.no_grad():
+        expected = hf.forward_train(x, text, torch.zeros_like(x), time, style_prompt=style, start_time=start_time)
+        actual = fused.forward_train(x, text, torch.zeros_like(x), time, style_prompt=style, start_time=start_time)
+    assert_close(actual, expected, 1e-3, 1e-3, "DiT output")
+
+
+@check
+def check_chunked_attention():
+    """The chunked attention backend matches sdpa, directly with a ragged last chunk and in the tiny DiT"""
+    import torch.nn.functional as F
+
+    from benchmarks.tiny_model import build_tiny_cfm
+    from model.attention import chunked_attention
+
+    torch.manual_seed(0)
+    q, k, v = (torch.randn(2, 4, 100, 32) for _ in range(3))
+    for is_causal in (False, True):
+        expected = F.scaled_dot_product_attention(q, k, v, is_causal=is_causal)
+        # 32 doesn't divide 100, the last chunk is 4 queries
+        actual = chunked_attention(q, k, v, is_causal=is_causal, chunk_size=32)
+        assert_close(actual, expected, 1e-5, 1e-5, f"chunked_attention, is_causal={is_causal}")
+
+    n = 96
+    x = torch.randn(2, n, 64)
+    text = torch.randint(0, 363, (2, n))
+    time = torch.rand(2)
+    style = torch.randn(2, 512)
+    start_time = torch.zeros(2)
+    for fused_blocks in (True, False):
+        outputs = []
+        for backend in ("sdpa", "chunked"):
+            dit = build_tiny_cfm(
+                max_frames=256, seed=0, fused_blocks=fused_blocks, attn_backend=backend, attn_chunk_size=40
+            ).transformer
+            with torch.no_grad():
+                outputs.append(dit.forward_train(x, text, torch.zeros_like(x), time, style_prompt=style, start_time=start_time))
+        assert_close(outputs[1], outputs[0], 1e-4, 1e-4, f"DiT output, fused_blocks={fused_blocks}")
+
+
+@check
+def check_quantized_accuracy():
+    """Every quantization mode stays close to the fp32 DiT, and a cached quantization loads back identical"""
+    import os
+    import tempfile
+
+    from benchmarks.tiny_model import build_tiny_cfm
+    from model.quantize import (
+        QUANT_MODES, _read_cache, _source_stamp, check_quantized_accuracy, quantization_targets, quantize_dit,
+    )
+
+    reference = build_tiny_cfm(max_frames=256, seed=0).transformer
+    # output cosine similarity to the fp32 DiT on random weights
+    min_cosine = {"int8_dynamic": 0.99, "int8_weight_only": 0.995, "int4_weight_only": 0.95}
+    with tempfile.TemporaryDirectory() as tmp:
+        source = os.path.join(tmp, "cfm_model.pt")
+        with open(source, "wb") as f:
+            f.write(b"checkpoint")
+
+        for mode in QUANT_MODES[1:]:
+            cache = os.path.join(tmp, f"cfm_model.pt.{mode}.qcache.safetensors")
+            quantized = quantize_dit(build_tiny_cfm(max_frames=256, seed=0).transformer, mode, cache, source)
+            for result in check_quantized_accuracy(reference, quantized, seeds=(0, 1), frames=64):
+                assert result["cosine"] > min_cosine[mode], f"{mode}: {result}"
+
+            cached = quantize_dit(build_tiny_cfm(max_frames=256, seed=0).transformer, mode, cache, source)
+            for result in check_quantized_accuracy(quantized, cached, seeds=(0,), frames=64):
+                assert result["max_abs_err"] == 0, f"{mode} from the cache: {result}"
+
+        # a replaced checkpoint makes the caches stale
+        with open(source, "ab") as f:
+            f.write(b" replaced")
+        names = [name for name, _, _ in quantization_targets(reference)]
+        assert _read_cache(cache, mode, _source_stamp(source), names) is None, "cache of a replaced checkpoint was used"
+
+
+@check
+def check_fast_ema():
+    """FastEMA in the device and cpu modes averages like ema_pytorch.EMA with the same options"""
+    from torch import nn
+    from ema_pytorch import EMA
+
+    from model.ema import FastEMA
+
+    torch.manual_seed(0)
+    model = nn.Sequential(nn.Linear(16, 32), nn.LayerNorm(32), nn.Linear(32, 8))
+    options = dict(beta=0.99, update_after_step=20, update_every=5, power=3 / 4)
+    reference = EMA(model, include_online_model=False, **options)
+    emas = {mode: FastEMA(model, mode=mode, **options) for mode in ("device", "cpu")}
+
+    generator = torch.Generator().manual_seed(0)
+    for _ in range(120):
+        with torch.no_grad():
+            for p in model.parameters():
+                p.add_(torch.randn(p.shape, generator=generator) * 0.1)
+        reference.update()
+        for ema in emas.values():
+            ema.update()
+
+    expected = reference.state_dict()
+    for mode, ema in emas.items():
+        actual = ema.state_dict()
+        assert int(actual["step"]) == int(expected["step"]), f"{mode}: step {int(actual['step'])} != {int(expected['step'])}"
+        for key, value in expected.items():
+            if key.startswith("ema_model."):
+                assert_close(actual[key], value, 1e-6, 1e-5, f"{mode} {key}")
+
+
+@check
+def check_resume_without_checkpoint():
+    """Trainer starts from step 0 when the checkpoint directory only holds telemetry and an unfinished save"""
+    import os
+    import tempfile
+    from types import SimpleNamespace
+
+    from model.trainer import Trainer
+
+    with tempfile.TemporaryDirectory() as tmp:
+        with open(os.path.join(tmp, "telemetry.jsonl"), "w", encoding="utf-8") as f:
+            f.write("{}\n")
+        os.makedirs(os.path.join(tmp, "model_100.tmp"))
+
+        trainer = SimpleNamespace(checkpoint_path=tmp, accelerator=SimpleNamespace(wait_for_everyone=lambda: None))
+        trainer.latest_checkpoint = lambda: Trainer.latest_checkpoint(trainer)
+        assert trainer.latest_checkpoint() is None, f"resumed from {trainer.latest_checkpoint()}"
+        assert Trainer.load_checkpoint(trainer) == 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Numerical checks of the optimized DiffRhythm paths")
+    parser.add_argument("--only", nargs="+", choices=list(CHECKS), default=list(CHECKS))
+    args = parser.parse_args(argv)
+
+    failed = 0
+    for name in args.only:
+        try:
+            CHECKS[name]()
+            print(f"{name}: ok")
+        except Exception:
+            failed += 1
+            print(f"{name}: FAILED")
+            traceback.print_exc()
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,113 @@
+"""
+A scaled-down DiffRhythm with random weights, for benchmarks and smoke tests without downloaded checkpoints.
+
+The tiny DiT (config/diffrhythm-tiny.json) has the same structure as the released models
+(same text vocabulary, latent and style sizes) with a much smaller width and depth,
+and StubVAE has the decode_export / encode_export interface of the scripted VAE.
+StubTokenizer and StubStyleEncoder stand in for the g2p frontend and MuQ-MuLan text prompts.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+
+import torch
+from torch import nn
+
+from model import CFM, DiT
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TINY_CONFIG_PATH = os.path.join(repo_dir, "config", "diffrhythm-tiny.json")
+
+DOWNSAMPLE_RATE = 2048
+
+
+def load_tiny_config(path=TINY_CONFIG_PATH):
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def build_tiny_cfm(max_frames=2048, device="cpu", dtype=torch.float32, seed=0, config_path=TINY_CONFIG_PATH, **dit_kwargs):
+    """CFM with a random-weight tiny DiT, built like DiffRhythmRun.prepare_model builds the real one."""
+    model_config = load_tiny_config(config_path)
+    dit_kwargs.setdefault("fused_blocks", True)
+    torch.manual_seed(seed)
+    cfm = CFM(
+        transformer=DiT(**model_config["model"], use_style_prompt=True, max_pos=max_frames, **dit_kwargs),
+        num_channels=model_config["model"]["mel_dim"],
+        use_style_prompt=True,
+    )
+    return cfm.to(device=device, dtype=dtype).eval()
+
+
+class StubVAE(nn.Module):
+    """
+    Stands in for the scripted VAE: [b, 64, t] latents <-> [b, 2, t * 2048] audio,
+    one transposed convolution per direction, so decoding cost still grows linearly with frames.
+    """
+
+    def __init__(self, latent_dim=64, channels=2, downsample_rate=DOWNSAMPLE_RATE, seed=0):
+        super().__init__()
+        generator = torch.Generator().manual_seed(seed)
+        self.decoder = nn.ConvTranspose1d(latent_dim, channels, kernel_size=downsample_rate, stride=downsample_rate)
+        self.encoder = nn.Conv1d(channels, latent_dim * 2, kernel_size=downsample_rate, stride=downsample_rate)
+        with torch.no_grad():
+            for p in self.parameters():
+                p.copy_(torch.randn(p.shape, generator=generator) * 0.02)
+
+    @torch.no_grad()
+    def decode_export(self, latents):
+        return torch.tanh(self.decoder(latents.to(self.decoder.weight.dtype)))
+
+    @torch.no_grad()
+    def encode_export(self, audio):
+        # mean and scale of the posterior, like the real encoder
+        return self.encoder(audio.to(self.encoder.weight.dtype))
+
+
+class StubTokenizer:
+    """CNENTokenizer interface without the g2p frontend: one token per character, inside the text vocabulary."""
+
+    def __init__(self, num_tokens=363):
+        self.num_tokens = num_tokens
+
+    def encode(self, text):
+        # 0 is the filler token and 1 / 2 are comma / period
+        return [3 + ord(c) % (self.num_tokens - 3) for c in text if not c.isspace()]
+
+
+class StubStyleEncoder:
+    """MuQ-MuLan interface for text prompts: a fixed random [n, 512] embedding per prompt."""
+
+    def __init__(self, dim=512):
+        self.dim = dim
+
+    def __call__(self, texts=None, wavs=None):
+        if texts is None:
+            raise ValueError("The stub style encoder only embeds text prompts")
+        if isinstance(texts, str):
+            texts = [texts]
+        embeds = []
+        for text in texts:
+            generator = torch.Generator().manual_seed(int.from_bytes(hashlib.sha1(text.encode()).digest()[:8], "little"))
+            embed = torch.randn(self.dim, generator=generator)
+            embeds.append(embed / embed.norm())
+        return torch.stack(embeds)
+
+
+def random_inputs(cfm, frames, batch=1, seed=0):
+    """Conditioning for CFM.sample: empty reference, random lyric tokens and random style embeddings."""
+    generator = torch.Generator().manual_seed(seed)
+    device = cfm.device
+    dtype = next(cfm.parameters()).dtype
+    num_tokens = cfm.transformer.text_embed.text_embed.num_embeddings
+    return {
+        "cond": torch.zeros(batch, frames, cfm.num_channels, device=device, dtype=dtype),
+        "text": torch.randint(0, num_tokens, (batch, frames), generator=generator).to(device),
+        "duration": frames,
+        "style_prompt": torch.randn(batch, 512, generator=generator).to(device=device, dtype=dtype),
+        "negative_style_prompt": torch.randn(batch, 512, generator=generator).to(device=device, dtype=dtype),
+        "start_time": torch.zeros(batch, device=device, dtype=dtype),
+    }
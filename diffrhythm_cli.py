@@ -0,0 +1,277 @@
+"""
+Headless batch generation from a JSONL job file, without ComfyUI.
+
+    python diffrhythm_cli.py jobs.jsonl --out-dir songs --batch-size 4
+
+One job per line:
+    {"id": "song-001", "lyrics": "[00:10.00]...", "style_prompt": "dreamy synth pop", "seed": 7,
+     "duration": 95, "output": "songs/song-001.wav"}
+lyrics_path may replace lyrics, style_audio (a reference audio path) may replace style_prompt.
+Everything except lyrics and a style is optional, duration defaults to the model length and longer
+songs are generated in overlapping windows.
+
+The models are loaded once. All lyrics are tokenized and all styles embedded before sampling,
+then jobs run in batches of one CFM.sample call each. Every finished job is appended to the
+results file (with its timings) right away, a rerun skips the jobs already done.
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+import torch
+import torchaudio
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(current_dir)
+
+from DiffRhythmNode import DiffRhythmRun, postprocess_audio, sample_long
+from diffrhythm_scheduler import GenerationRequest, sample_batch
+from diffrhythm_utils import decode_audio, get_lrc_token, get_negative_style_prompt
+from model.attention import ATTENTION_BACKENDS
+from model.quantize import QUANT_MODES
+
+MODEL_FRAMES = {"cfm_model.pt": 2048, "cfm_full_model.pt": 6144}
+FRAMES_PER_SEC = 44100 / 2048
+
+
+def read_jobs(path):
+    jobs = []
+    with open(path, "r", encoding="utf-8") as f:
+        for i, line in enumerate(f):
+            line = line.strip()
+            if not line:
+                continue
+            job = json.loads(line)
+            job.setdefault("id", str(i))
+            jobs.append(job)
+    ids = [job["id"] for job in jobs]
+    if len(set(ids)) != len(ids):
+        raise ValueError("Job ids must be unique")
+    return jobs
+
+
+def read_done(results_path):
+    done = set()
+    if not os.path.exists(results_path):
+        return done
+    with open(results_path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+            except json.JSONDecodeError:
+                # a line cut short by an interrupted run
+                continue
+            if result.get("status") == "ok" and os.path.exists(result.get("output", "")):
+                done.add(result["id"])
+    return done
+
+
+class ResultWriter:
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.f = open(path, "a", encoding="utf-8")
+
+    def write(self, result):
+        self.f.write(json.dumps(result, ensure_ascii=False) + "\n")
+        self.f.flush()
+        os.fsync(self.f.fileno())
+
+    def close(self):
+        self.f.close()
+
+
+class BatchGenerator:
+    def __init__(self, model="cfm_full_model.pt", device=None, quantize="none", attention="sdpa", model_dir=None):
+        self.runner = DiffRhythmRun()
+        if model_dir is not None:
+            self.runner.model_path = model_dir
+        self.device = device or self.runner.device
+        self.model = model
+        self.max_frames = MODEL_FRAMES[model]
+        self.cfm, self.tokenizer, self.muq, self.vae = self.runner.prepare_model(
+            model, self.device, quantize=quantize, attention=attention
+        )
+        self.negative_style_prompt = get_negative_style_prompt(self.device)
+
+    def lyrics(self, job):
+        if "lyrics_path" in job:
+            with open(job["lyrics_path"], "r", encoding="utf-8") as f:
+                return f.read()
+        return job.get("lyrics", "")
+
+    def total_frames(self, job):
+        duration = job.get("duration")
+        return int(duration * FRAMES_PER_SEC) if duration else self.max_frames
+
+    def tokenize(self, jobs, timings):
+        for job in jobs:
+            start = time.perf_counter()
+            job["_lyrics"] = self.lyrics(job)
+            job["_text"], job["_start_time"] = get_lrc_token(self.max_frames, job["_lyrics"], self.tokenizer, self.device)
+            timings[job["id"]]["g2p"] = time.perf_counter() - start
+
+    @torch.no_grad()
+    def embed_styles(self, jobs, timings, batch_size=16):
+        # text prompts go through MuQ-MuLan in batches, reference audio one by one
+        text_jobs = [job for job in jobs if "style_audio" not in job]
+        for i in range(0, len(text_jobs), batch_size):
+            chunk = text_jobs[i : i + batch_size]
+            start = time.perf_counter()
+            embeds = self.muq(texts=[job["style_prompt"] for job in chunk]).half()
+            elapsed = (time.perf_counter() - start) / len(chunk)
+            for job, embed in zip(chunk, embeds):
+                job["_style"] = embed.unsqueeze(0)
+                timings[job["id"]]["style"] = elapsed
+        for job in jobs:
+            if "style_audio" not in job:
+                continue
+            start = time.perf_counter()
+            waveform, sample_rate = torchaudio.load(job["style_audio"])
+            job["_style"] = self.runner.get_style_prompt(self.muq, {"waveform": waveform, "sample_rate": sample_rate})
+            timings[job["id"]]["style"] = time.perf_counter() - start
+
+    def sample(self, jobs, timings):
+        # window-length jobs share one sample call, longer songs run alone in windows
+        start = time.perf_counter()
+        if len(jobs) == 1 and self.total_frames(jobs[0]) > self.max_frames:
+            job = jobs[0]
+            with torch.inference_mode():
+                torch.manual_seed(job["seed"])
+                latents = [sample_long(
+                    self.cfm, self.tokenizer, job["_lyrics"], job["_style"], self.negative_style_prompt,
+                    window_frames=self.max_frames, total_frames=self.total_frames(job), device=self.device,
+                )]
+        else:
+            requests = [
+                GenerationRequest(self.model, job["_text"], job["_start_time"], job["_style"], seed=job["seed"])
+                for job in jobs
+            ]
+            latents = sample_batch(self.cfm, requests, self.negative_style_prompt)
+        elapsed = (time.perf_counter() - start) / len(jobs)
+        for job in jobs:
+            timings[job["id"]]["sample"] = elapsed
+        return latents
+
+    def decode(self, job, latent, timings):
+        start = time.perf_counter()
+        with torch.inference_mode():
+            # like the node, songs longer than the full model window decode in chunks
+            output = decode_audio(latent.transpose(1, 2), self.vae, chunked=latent.shape[1] > 6144)
+        audio = postprocess_audio(output)
+        # the model always fills its window, a shorter duration is cut from the decoded song
+        audio = audio[:, : self.total_frames(job) * 2048]
+        os.makedirs(os.path.dirname(os.path.abspath(job["output"])), exist_ok=True)
+        torchaudio.save(job["output"], audio, 44100)
+        timings[job["id"]]["decode"] = time.perf_counter() - start
+
+
+def batches(jobs, batch_size, max_frames, total_frames):
+    single = [job for job in jobs if total_frames(job) <= max_frames]
+    for i in range(0, len(single), batch_size):
+        yield single[i : i + batch_size]
+    for job in jobs:
+        if total_frames(job) > max_frames:
+            yield [job]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate songs for every job of a JSONL file")
+    parser.add_argument("jobs", help="JSONL job file")
+    parser.add_argument("--out-dir", default="outputs", help="where jobs without an output path are written")
+    parser.add_argument("--results", default=None, help="JSONL results file, default <out-dir>/results.jsonl")
+    parser.add_argument("--model", choices=list(MODEL_FRAMES), default="cfm_full_model.pt")
+    parser.add_argument("--model-dir", default=None, help="folder holding DiffRhythm/, default ComfyUI's models/TTS")
+    parser.add_argument("--device", default=None)
+    parser.add_argument("--batch-size", type=int, default=4)
+    parser.add_argument("--quantize", choices=QUANT_MODES, default="none")
+    parser.add_argument("--attention", choices=ATTENTION_BACKENDS, default="sdpa")
+    args = parser.parse_args(argv)
+
+    results_path = args.results or os.path.join(args.out_dir, "results.jsonl")
+    jobs = read_jobs(args.jobs)
+    done = read_done(results_path)
+    jobs = [job for job in jobs if job["id"] not in done]
+    print(f"{len(jobs)} jobs to run, {len(done)} already done")
+    if not jobs:
+        return 0
+
+    for job in jobs:
+        job.setdefault("output", os.path.join(args.out_dir, f"{job['id']}.wav"))
+        if job.get("seed") is None:
+            job["seed"] = random.randrange(2**31)
+
+    start = time.perf_counter()
+    generator = BatchGenerator(
+        args.model, device=args.device, quantize=args.quantize, attention=args.attention, model_dir=args.model_dir
+    )
+    print(f"models loaded in {time.perf_counter() - start:.1f} s")
+
+    timings = {job["id"]: {} for job in jobs}
+    writer = ResultWriter(results_path)
+    failed = 0
+
+    def fail(job, e):
+        nonlocal failed
+        failed += 1
+        print(f"job {job['id']} failed: {e!r}")
+        writer.write({"id": job["id"], "status": "error", "error": repr(e), "timings": timings[job["id"]]})
+
+    # everything that doesn't need the DiT runs up front, a bad job fails here without costing a batch
+    ready = []
+    for job in jobs:
+        try:
+            if "style_audio" not in job and not job.get("style_prompt"):
+                raise ValueError("A job needs a style_prompt or a style_audio")
+            generator.tokenize([job], timings)
+            ready.append(job)
+        except Exception as e:
+            fail(job, e)
+    try:
+        generator.embed_styles(ready, timings)
+    except Exception:
+        # find the job(s) that broke the batch
+        for job in ready:
+            if "_style" in job:
+                continue
+            try:
+                generator.embed_styles([job], timings)
+            except Exception as e:
+                fail(job, e)
+        ready = [job for job in ready if "_style" in job]
+
+    try:
+        for batch in batches(ready, args.batch_size, generator.max_frames, generator.total_frames):
+            try:
+                latents = generator.sample(batch, timings)
+            except Exception as e:
+                for job in batch:
+                    fail(job, e)
+                continue
+            for job, latent in zip(batch, latents):
+                try:
+                    generator.decode(job, latent, timings)
+                except Exception as e:
+                    fail(job, e)
+                    continue
+                job_timings = timings[job["id"]]
+                job_timings["total"] = sum(job_timings.values())
+                writer.write({
+                    "id": job["id"], "status": "ok", "output": job["output"], "seed": job["seed"],
+                    "batch_size": len(batch), "timings": job_timings,
+                })
+                print(f"job {job['id']} done in {job_timings['total']:.1f} s -> {job['output']}")
+    finally:
+        writer.close()
+
+    print(f"{len(jobs) - failed} jobs done, {failed} failed, {time.perf_counter() - start:.1f} s")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,220 @@
+"""
+Micro-batching of generation requests.
+
+Requests for the same model and frame count are compatible: they can share one CFM.sample call,
+each with its own lyrics, style and seed. The scheduler collects them for up to max_wait seconds
+(or until max_batch_size are pending), runs the batch on a worker thread and resolves every
+request's future with its own latent.
+"""
+
+from __future__ import annotations
+
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+import torch
+
+from model.callbacks import SamplingCallback
+
+
+class GenerationRequest:
+    def __init__(self, model, text, start_time, style_prompt, seed=None, callback=None):
+        # text [1, frames] lrc tokens and start_time [1] from get_lrc_token, style_prompt [1, 512]
+        self.model = model
+        self.text = text
+        self.start_time = start_time
+        self.style_prompt = style_prompt
+        self.seed = seed
+        self.callback = callback
+        self.future = Future()
+        self.enqueued = time.perf_counter()
+
+    @property
+    def frames(self):
+        return self.text.shape[-1]
+
+    @property
+    def key(self):
+        return (self.model, self.frames)
+
+
+def sample_batch(cfm_model, requests, negative_style_prompt, steps=32, cfg_strength=4.0, callback=None):
+    """One CFM.sample call over compatible requests, returns a [1, frames, 64] float32 latent per request."""
+    device = cfm_model.device
+    dtype = next(cfm_model.parameters()).dtype
+    batch = len(requests)
+    frames = requests[0].frames
+
+    text = torch.cat([r.text for r in requests]).to(device)
+    style_prompt = torch.cat([r.style_prompt for r in requests]).to(device=device, dtype=dtype)
+    start_time = torch.cat([r.start_time.reshape(1) for r in requests]).to(device=device, dtype=dtype)
+    negative_style_prompt = negative_style_prompt.to(device=device, dtype=dtype).expand(batch, -1)
+
+    with torch.inference_mode():
+        latents, _ = cfm_model.sample(
+            cond=torch.zeros(batch, frames, cfm_model.num_channels, device=device, dtype=dtype),
+            text=text,
+            duration=frames,
+            style_prompt=style_prompt,
+            negative_style_prompt=negative_style_prompt,
+            steps=steps,
+            cfg_strength=cfg_strength,
+            start_time=start_time,
+            seed=[r.seed for r in requests],
+            callback=callback,
+        )
+    return [latent.unsqueeze(0).to(torch.float32) for latent in latents]
+
+
+class MicroBatcher:
+    """
+    Groups submitted requests by request.key and calls run_batch(key, requests) on a worker thread,
+    which returns one result per request.
+    """
+
+    def __init__(self, run_batch, max_batch_size=4, max_wait=0.05):
+        self.run_batch = run_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+
+        self.pending = OrderedDict()
+        self.lock = threading.Condition()
+        self.closed = False
+
+        self.max_queue_depth = 0
+        self.batches = 0
+        self.items = 0
+        self.total_wait = 0.0
+        self.running = 0
+        self.batch_sizes = {}
+
+        self.worker = threading.Thread(target=self._work, name="diffrhythm-batcher", daemon=True)
+        self.worker.start()
+
+    def submit(self, request):
+        with self.lock:
+            if self.closed:
+                raise RuntimeError("The scheduler is closed")
+            self.pending.setdefault(request.key, []).append(request)
+            self.max_queue_depth = max(self.max_queue_depth, self.queue_depth())
+            self.lock.notify_all()
+        return request.future
+
+    def queue_depth(self):
+        return sum(len(requests) for requests in self.pending.values())
+
+    def _next_batch(self):
+        # the key with the oldest request goes first, it waits for company until its deadline
+        with self.lock:
+            while not self.pending:
+                if self.closed:
+                    return None, None
+                self.lock.wait()
+            key = min(self.pending, key=lambda k: self.pending[k][0].enqueued)
+            deadline = self.pending[key][0].enqueued + self.max_wait
+            while len(self.pending[key]) < self.max_batch_size and not self.closed:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                self.lock.wait(remaining)
+            requests = self.pending[key][: self.max_batch_size]
+            del self.pending[key][: self.max_batch_size]
+            if not self.pending[key]:
+                del self.pending[key]
+            self.running = len(requests)
+            return key, requests
+
+    def _work(self):
+        while True:
+            key, requests = self._next_batch()
+            if requests is None:
+                return
+            # requests whose future was cancelled while queued are dropped
+            requests = [r for r in requests if r.future.set_running_or_notify_cancel()]
+            if not requests:
+                with self.lock:
+                    self.running = 0
+                continue
+            started = time.perf_counter()
+            try:
+                results = self.run_batch(key, requests)
+            except Exception as e:
+                for request in requests:
+                    request.future.set_exception(e)
+            else:
+                for request, result in zip(requests, results):
+                    request.future.set_result(result)
+            with self.lock:
+                self.running = 0
+                self.batches += 1
+                self.items += len(requests)
+                self.total_wait += sum(started - r.enqueued for r in requests)
+                self.batch_sizes[len(requests)] = self.batch_sizes.get(len(requests), 0) + 1
+
+    def metrics(self):
+        with self.lock:
+            return {
+                "queue_depth": self.queue_depth(),
+                "queue_depth_by_key": {"/".join(map(str, key)): len(r) for key, r in self.pending.items()},
+                "max_queue_depth": self.max_queue_depth,
+                "running": self.running,
+                "batches": self.batches,
+                "items": self.items,
+                "mean_batch_size": self.items / self.batches if self.batches else 0.0,
+                "batch_sizes": dict(sorted(self.batch_sizes.items())),
+                "mean_queue_wait_s": self.total_wait / self.items if self.items else 0.0,
+            }
+
+    def close(self, wait=True):
+        # pending requests still run, new ones are refused
+        with self.lock:
+            self.closed = True
+            self.lock.notify_all()
+        if wait:
+            self.worker.join()
+
+
+class SampleScheduler(MicroBatcher):
+    """
+    MicroBatcher over CFM.sample. get_model(name) returns (cfm_model, negative_style_prompt),
+    e.g. from a cache of loaded models, so every batch runs on warm weights.
+    """
+
+    def __init__(self, get_model, max_batch_size=4, max_wait=0.05, steps=32, cfg_strength=4.0):
+        self.get_model = get_model
+        self.steps = steps
+        self.cfg_strength = cfg_strength
+        super().__init__(self._sample, max_batch_size=max_batch_size, max_wait=max_wait)
+
+    def _sample(self, key, requests):
+        cfm_model, negative_style_prompt = self.get_model(key[0])
+        callbacks = [r.callback for r in requests if r.callback is not None]
+        return sample_batch(
+            cfm_model, requests, negative_style_prompt, steps=self.steps, cfg_strength=self.cfg_strength,
+            callback=_BroadcastCallback(callbacks) if callbacks else None,
+        )
+
+
+class _BroadcastCallback(SamplingCallback):
+    # every request of a batch sees the progress of the shared sample call. One request can't cancel
+    # the others, a failing callback (e.g. a disconnected client) only stops reporting to its request
+    def __init__(self, callbacks):
+        self.callbacks = list(callbacks)
+
+    def _each(self, method, *args):
+        for callback in list(self.callbacks):
+            try:
+                getattr(callback, method)(*args)
+            except Exception:
+                self.callbacks.remove(callback)
+
+    def on_stage_start(self, stage, total):
+        self._each("on_stage_start", stage, total)
+
+    def on_step(self, stage, step, total, elapsed):
+        self._each("on_step", stage, step, total, elapsed)
+
+    def on_stage_end(self, stage, elapsed):
+        self._each("on_stage_end", stage, elapsed)
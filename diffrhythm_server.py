@@ -0,0 +1,334 @@
+"""
+Standalone HTTP inference server, stdlib only, with the models kept warm.
+
+    python diffrhythm_server.py --model cfm_full_model.pt --port 8765
+    python diffrhythm_server.py --model tiny            # random-weight tiny model, for local testing
+
+POST /generate   {"lyrics": "[00:10.00]...", "style_prompt": "...", "seed": 7, "model": "...", "stream": true}
+                 streams newline-delimited JSON events: queued, progress (sampling steps and decoded chunks),
+                 audio (base64 little-endian int16 stereo pieces, in order) and done with the timings.
+                 With "stream": false the response is the finished song as a WAV file.
+GET  /health     the loaded models
+GET  /metrics    queue depth and batching of the scheduler, request counts and latency percentiles
+
+Requests go through the micro-batching scheduler, so concurrent requests for the same model share sampling calls.
+"""
+
+from __future__ import annotations
+
+import argparse
+import base64
+import io
+import json
+import os
+import queue
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import torch
+import torchaudio
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(current_dir)
+
+from diffrhythm_scheduler import GenerationRequest, SampleScheduler
+from diffrhythm_utils import decode_audio_stream, get_lrc_token, get_negative_style_prompt
+from model.callbacks import SamplingCallback
+from model.tracing import LATENCY_STATS, Tracer
+
+MODEL_FRAMES = {"cfm_model.pt": 2048, "cfm_full_model.pt": 6144}
+
+
+class LoadedModel:
+    def __init__(self, cfm, tokenizer, style_encoder, vae, max_frames, device):
+        self.cfm = cfm
+        self.tokenizer = tokenizer
+        self.style_encoder = style_encoder
+        self.vae = vae
+        self.max_frames = max_frames
+        self.negative_style_prompt = get_negative_style_prompt(device)
+        # the style encoder and the VAE are used from the request threads, one call at a time
+        self.style_lock = threading.Lock()
+        self.vae_lock = threading.Lock()
+
+
+class ModelRegistry:
+    """Loads each model once on first use and keeps it on the device."""
+
+    def __init__(self, device, quantize="none", attention="sdpa", model_dir=None, tiny_frames=512):
+        self.device = device
+        self.quantize = quantize
+        self.attention = attention
+        self.model_dir = model_dir
+        self.tiny_frames = tiny_frames
+        self.models = {}
+        self.lock = threading.Lock()
+
+    def get(self, name):
+        with self.lock:
+            if name not in self.models:
+                self.models[name] = self._load(name)
+            return self.models[name]
+
+    def _load(self, name):
+        start = time.perf_counter()
+        if name == "tiny":
+            from benchmarks.tiny_model import StubStyleEncoder, StubTokenizer, StubVAE, build_tiny_cfm
+
+            cfm = build_tiny_cfm(max_frames=self.tiny_frames, device=self.device, attn_backend=self.attention)
+            model = LoadedModel(
+                cfm, StubTokenizer(), StubStyleEncoder(), StubVAE().to(self.device), self.tiny_frames, self.device
+            )
+        elif name in MODEL_FRAMES:
+            from DiffRhythmNode import DiffRhythmRun
+
+            runner = DiffRhythmRun()
+            if self.model_dir is not None:
+                runner.model_path = self.model_dir
+            cfm, tokenizer, muq, vae = runner.prepare_model(
+                name, self.device, quantize=self.quantize, attention=self.attention
+            )
+            model = LoadedModel(cfm, tokenizer, muq, vae, MODEL_FRAMES[name], self.device)
+        else:
+            raise ValueError(f"Unknown model {name}, expected one of {list(MODEL_FRAMES) + ['tiny']}")
+        print(f"loaded {name} in {time.perf_counter() - start:.1f} s")
+        return model
+
+
+class EventQueue(SamplingCallback):
+    # sampling progress from the scheduler thread to the request thread
+    def __init__(self):
+        self.events = queue.Queue()
+
+    def on_step(self, stage, step, total, elapsed):
+        self.events.put({"event": "progress", "stage": stage, "step": step, "total": total})
+
+
+def to_pcm16(audio):
+    # [2, n] float in [-1, 1] -> interleaved little-endian int16 bytes
+    return audio.clamp(-1, 1).mul(32767).to(torch.int16).t().contiguous().cpu().numpy().tobytes()
+
+
+class DiffRhythmServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, registry, default_model, max_batch_size=4, max_wait=0.05, steps=32, chunk_size=128):
+        super().__init__(address, RequestHandler)
+        self.registry = registry
+        self.default_model = default_model
+        self.chunk_size = chunk_size
+        self.scheduler = SampleScheduler(
+            self._batch_model, max_batch_size=max_batch_size, max_wait=max_wait, steps=steps
+        )
+        self.counts_lock = threading.Lock()
+        self.counts = {"requests": 0, "completed": 0, "failed": 0, "disconnected": 0}
+        self.started = time.time()
+
+    def _batch_model(self, name):
+        model = self.registry.get(name)
+        return model.cfm, model.negative_style_prompt
+
+    def count(self, key):
+        with self.counts_lock:
+            self.counts[key] += 1
+
+    def metrics(self):
+        with self.counts_lock:
+            counts = dict(self.counts)
+        return {
+            "uptime_s": time.time() - self.started,
+            "requests": counts,
+            "scheduler": self.scheduler.metrics(),
+            "latency": LATENCY_STATS.summary(),
+        }
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        sys.stderr.write(f"{self.address_string()} {format % args}\n")
+
+    def send_json(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == "/health":
+            self.send_json(200, {"status": "ok", "models": list(self.server.registry.models)})
+        elif self.path == "/metrics":
+            self.send_json(200, self.server.metrics())
+        else:
+            self.send_json(404, {"error": f"unknown path {self.path}"})
+
+    def do_POST(self):
+        if self.path != "/generate":
+            self.send_json(404, {"error": f"unknown path {self.path}"})
+            return
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            if not body.get("style_prompt"):
+                raise ValueError("style_prompt is required")
+            body.setdefault("model", self.server.default_model)
+            model = self.server.registry.get(body["model"])
+        except Exception as e:
+            self.send_json(400, {"error": str(e)})
+            return
+
+        self.server.count("requests")
+        try:
+            if body.get("stream", True):
+                self.generate_stream(model, body)
+            else:
+                self.generate_wav(model, body)
+        except (BrokenPipeError, ConnectionResetError):
+            self.server.count("disconnected")
+            self.close_connection = True
+        except Exception as e:
+            self.server.count("failed")
+            self.log_message("generation failed: %r", e)
+            if not body.get("stream", True):
+                self.send_json(500, {"error": str(e)})
+            self.close_connection = True
+        else:
+            self.server.count("completed")
+
+    def sample(self, model, body, events, tracer):
+        device = self.server.registry.device
+        with tracer.span("g2p"):
+            text, start_time = get_lrc_token(model.max_frames, body.get("lyrics", ""), model.tokenizer, device)
+        with tracer.span("style_embed"), model.style_lock, torch.no_grad():
+            style_prompt = model.style_encoder(texts=[body["style_prompt"]])
+        request = GenerationRequest(
+            body["model"], text, start_time, style_prompt, seed=body.get("seed"), callback=events,
+        )
+        return request, self.server.scheduler.submit(request)
+
+    def generate_stream(self, model, body):
+        events = EventQueue()
+        tracer = Tracer(name="generate")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        try:
+            self._generate_stream(model, body, events, tracer)
+        except (BrokenPipeError, ConnectionResetError):
+            raise
+        except Exception as e:
+            # the status line is already sent, the failure is the last event of the stream
+            self.write_event({"event": "error", "error": str(e)})
+            self.wfile.write(b"0\r\n\r\n")
+            raise
+
+    def _generate_stream(self, model, body, events, tracer):
+        start = time.perf_counter()
+        request, future = self.sample(model, body, events, tracer)
+        self.write_event({"event": "queued", "queue_depth": self.server.scheduler.metrics()["queue_depth"]})
+        with tracer.span("queue_and_sample"):
+            try:
+                while not future.done():
+                    try:
+                        self.write_event(events.events.get(timeout=0.1))
+                    except queue.Empty:
+                        pass
+            except (BrokenPipeError, ConnectionResetError):
+                future.cancel()
+                raise
+            latent = future.result()
+        while not events.events.empty():
+            self.write_event(events.events.get())
+
+        with tracer.span("decode"), model.vae_lock, torch.inference_mode():
+            pieces = decode_audio_stream(latent.transpose(1, 2), model.vae, chunk_size=self.server.chunk_size)
+            for index, piece in enumerate(pieces):
+                self.write_event({
+                    "event": "audio",
+                    "index": index,
+                    "sample_rate": 44100,
+                    "channels": piece.shape[1],
+                    "pcm16": base64.b64encode(to_pcm16(piece[0].float())).decode(),
+                })
+        tracer.finish()
+        self.write_event({
+            "event": "done",
+            "seed": request.seed,
+            "timings": {e["name"]: e["dur"] / 1e6 for e in tracer.events},
+            "total_s": time.perf_counter() - start,
+        })
+        self.wfile.write(b"0\r\n\r\n")
+
+    def generate_wav(self, model, body):
+        from DiffRhythmNode import postprocess_audio
+
+        tracer = Tracer(name="generate")
+        _, future = self.sample(model, body, None, tracer)
+        with tracer.span("queue_and_sample"):
+            latent = future.result()
+        with tracer.span("decode"), model.vae_lock, torch.inference_mode():
+            output = torch.cat(list(decode_audio_stream(latent.transpose(1, 2), model.vae, chunk_size=self.server.chunk_size)), dim=2)
+        tracer.finish()
+        buffer = io.BytesIO()
+        torchaudio.save(buffer, postprocess_audio(output), 44100, format="wav")
+        data = buffer.getvalue()
+        self.send_response(200)
+        self.send_header("Content-Type", "audio/wav")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def write_event(self, event):
+        data = (json.dumps(event) + "\n").encode()
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+        self.wfile.flush()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="DiffRhythm HTTP inference server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--model", default="cfm_full_model.pt", help="default model, cfm_model.pt, cfm_full_model.pt or tiny")
+    parser.add_argument("--preload", nargs="*", default=None, help="models to load at startup, default the --model")
+    parser.add_argument("--model-dir", default=None, help="folder holding DiffRhythm/, default ComfyUI's models/TTS")
+    parser.add_argument("--device", default=None)
+    parser.add_argument("--quantize", default="none")
+    parser.add_argument("--attention", default="sdpa")
+    parser.add_argument("--max-batch-size", type=int, default=4)
+    parser.add_argument("--max-wait", type=float, default=0.05, help="seconds a request waits for others to batch with")
+    parser.add_argument("--steps", type=int, default=32)
+    parser.add_argument("--chunk-size", type=int, default=128, help="latent frames per streamed audio chunk")
+    parser.add_argument("--tiny-frames", type=int, default=512, help="frames generated by the tiny model")
+    args = parser.parse_args(argv)
+
+    device = args.device
+    if device is None:
+        device = "cuda" if torch.cuda.is_available() else "mps" if torch.backends.mps.is_available() else "cpu"
+
+    registry = ModelRegistry(
+        device, quantize=args.quantize, attention=args.attention, model_dir=args.model_dir, tiny_frames=args.tiny_frames
+    )
+    for name in args.preload if args.preload is not None else [args.model]:
+        registry.get(name)
+
+    server = DiffRhythmServer(
+        (args.host, args.port), registry, args.model,
+        max_batch_size=args.max_batch_size, max_wait=args.max_wait, steps=args.steps, chunk_size=args.chunk_size,
+    )
+    print(f"serving on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.scheduler.close()
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -18,76 +18,184 @@ import torch
 import random
 import json
 import os
+import hashlib
+from collections import OrderedDict
 import numpy as np
 
+from model.callbacks import StageTimer
+from model.checkpoint import is_checkpoint_dir, load_checkpoint_dir
+
 node_dir = os.path.dirname(os.path.abspath(__file__))
 
-def decode_audio(latents, vae_model, chunked=False, overlap=32, chunk_size=128):
-    downsampling_ratio = 2048
-    io_channels = 2
+def decode_audio(latents, vae_model, chunked=False, overlap=32, chunk_size=128, callback=None):
     if not chunked:
-        try:
-            output = vae_model.decode_export(latents)
-            return output
-        except Exception as e:
-            raise
+        with StageTimer(callback, "decode", device=latents.device) as timer:
+            try:
+                output = vae_model.decode_export(latents)
+            except Exception as e:
+                raise
+            timer.step()
+        return output
     else:
         # chunked decoding
-        hop_size = chunk_size - overlap
-        total_size = latents.shape[2]
-        batch_size = latents.shape[0]
-        chunks = []
-        i = 0
-        for i in range(0, total_size - chunk_size + 1, hop_size):
-            chunk = latents[:, :, i : i + chunk_size]
-            chunks.append(chunk)
-        if i + chunk_size != total_size:
-            # Final chunk
-            chunk = latents[:, :, -chunk_size:]
-            chunks.append(chunk)
-        chunks = torch.stack(chunks)
-        num_chunks = chunks.shape[0]
-        # samples_per_latent is just the downsampling ratio
-        samples_per_latent = downsampling_ratio
-        # Create an empty waveform, we will populate it with chunks as decode them
-        y_size = total_size * samples_per_latent
-        y_final = torch.zeros((batch_size, io_channels, y_size)).to(latents.device)
-        for i in range(num_chunks):
-            x_chunk = chunks[i, :]
+        return torch.cat(list(decode_audio_stream(latents, vae_model, overlap=overlap, chunk_size=chunk_size, callback=callback)), dim=2)
+
+
+def decode_audio_stream(latents, vae_model, overlap=32, chunk_size=128, callback=None):
+    """
+    Decodes [b, d, t] latents chunk by chunk and yields consecutive [b, 2, n] audio pieces,
+    so memory stays bounded by the chunk size whatever the song length.
+    callback (a SamplingCallback) sees one "decode" step per chunk.
+    """
+    downsampling_ratio = 2048
+    hop_size = chunk_size - overlap
+    total_size = latents.shape[2]
+    starts = list(range(0, total_size - chunk_size + 1, hop_size))
+    if not starts or starts[-1] + chunk_size != total_size:
+        # Final chunk
+        starts.append(max(total_size - chunk_size, 0))
+    # samples_per_latent is just the downsampling ratio
+    samples_per_latent = downsampling_ratio
+    y_size = total_size * samples_per_latent
+    ol = (overlap // 2) * samples_per_latent
+    written = 0
+    with StageTimer(callback, "decode", total=len(starts), device=latents.device) as timer:
+        for i, start in enumerate(starts):
+            x_chunk = latents[:, :, start : start + chunk_size]
             # decode the chunk
             try:
                 y_chunk = vae_model.decode_export(x_chunk)
             except Exception as e:
                 raise
+            timer.step()
             # figure out where to put the audio along the time domain
-            if i == num_chunks - 1:
+            last = i == len(starts) - 1
+            if last:
                 # final chunk always goes at the end
                 t_end = y_size
                 t_start = t_end - y_chunk.shape[2]
             else:
-                t_start = i * hop_size * samples_per_latent
+                t_start = start * samples_per_latent
                 t_end = t_start + chunk_size * samples_per_latent
             #  remove the edges of the overlaps
-            ol = (overlap // 2) * samples_per_latent
             chunk_start = 0
             chunk_end = y_chunk.shape[2]
             if i > 0:
                 # no overlap for the start of the first chunk
                 t_start += ol
                 chunk_start += ol
-            if i < num_chunks - 1:
+            if not last:
                 # no overlap for the end of the last chunk
                 t_end -= ol
                 chunk_end -= ol
-            # paste the chunked audio into our y_final output audio
-            y_final[:, :, t_start:t_end] = y_chunk[:, :, chunk_start:chunk_end]
-        return y_final
+            # the final chunk can reach back into audio an earlier chunk already produced
+            chunk_start += max(written - t_start, 0)
+            yield y_chunk[:, :, chunk_start:chunk_end]
+            written = t_end
 
 # for song edit, will be added in the future
 def get_reference_latent(device, max_frames):
     return torch.zeros(1, max_frames, 64).to(device)
 
 
+def prepare_audio(waveform, sample_rate, device, target_sr=44100):
+    # comfy AUDIO [1, c, n] (float or int16) -> float stereo [1, 2, n] at the VAE sample rate
+    if waveform.dtype == torch.int16:
+        waveform = waveform.float() / 32768
+    waveform = waveform.float()
+    if waveform.ndim == 3:
+        waveform = waveform[0]
+    if waveform.shape[0] == 1:
+        waveform = waveform.repeat(2, 1)
+    elif waveform.shape[0] > 2:
+        waveform = waveform[:2]
+    if sample_rate != target_sr:
+        import torchaudio
+        waveform = torchaudio.functional.resample(waveform, sample_rate, target_sr)
+    return waveform.unsqueeze(0).to(device)
+
+
+# latents of recently encoded (or edited) songs, keyed by a hash of the audio
+_latent_cache = OrderedDict()
+_latent_cache_size = 4
+
+
+def _audio_key(audio):
+    return hashlib.sha1(audio.detach().float().cpu().numpy().tobytes()).hexdigest()
+
+
+def remember_latent(audio, latent):
+    key = _audio_key(audio)
+    _latent_cache[key] = latent.detach().cpu()
+    _latent_cache.move_to_end(key)
+    while len(_latent_cache) > _latent_cache_size:
+        _latent_cache.popitem(last=False)
+
+
+@torch.no_grad()
+def encode_audio(audio, vae_model):
+    """
+    [1, 2, n] audio at 44.1 kHz -> [1, t, 64] latent, the inverse of decode_audio.
+    Encoding a whole song is expensive, so the result is cached for repeated edits of the same audio.
+    """
+    downsample_rate = 2048
+    key = _audio_key(audio)
+    if key in _latent_cache:
+        _latent_cache.move_to_end(key)
+        return _latent_cache[key].to(audio.device)
+
+    if not hasattr(vae_model, "encode_export"):
+        raise ValueError("This vae_model.pt has no encoder, download the latest DiffRhythm-vae to edit audio")
+    pad = -audio.shape[-1] % downsample_rate
+    latent = vae_model.encode_export(torch.nn.functional.pad(audio, (0, pad)))  # [b, 2 * d, t]
+    mean, scale = latent.chunk(2, dim=1)
+    # use the posterior mean, so editing the same audio is deterministic
+    latent = mean.transpose(1, 2).float()
+    remember_latent(audio, latent)
+    return latent
+
+
+def save_latent(path, latent, metadata=None):
+    # [b, t, 64] latent as fp16 safetensors, metadata values are stored as strings
+    from safetensors.torch import save_file
+    metadata = {k: str(v) for k, v in (metadata or {}).items()}
+    save_file({"latent": latent.detach().to(torch.float16).cpu().contiguous()}, path, metadata=metadata)
+
+
+def load_latent(path):
+    from safetensors import safe_open
+    with safe_open(path, framework="pt") as f:
+        latent = f.get_tensor("latent").to(torch.float32)
+        metadata = f.metadata() or {}
+    return latent, metadata
+
+
+def splice_audio(original, decoded, decoded_start, start, end, fade):
+    """
+    Pastes decoded audio into original between sample positions start and end, crossfading
+    over up to `fade` samples on each side, where both should be the same unchanged music.
+    decoded starts at sample decoded_start of the song, the gain is matched on the crossfade regions.
+    """
+    out = original.clone()
+    decoded_end = decoded_start + decoded.shape[-1]
+    a = max(decoded_start, start - fade)
+    b = min(decoded_end, end + fade, original.shape[-1])
+    piece = decoded[..., a - decoded_start : b - decoded_start]
+
+    margins = torch.cat([original[..., a:start], original[..., end:b]], dim=-1)
+    new_margins = torch.cat([piece[..., : start - a], piece[..., piece.shape[-1] - (b - end):]], dim=-1)
+    if margins.shape[-1] > 0 and new_margins.abs().max() > 0:
+        piece = piece * (margins.pow(2).mean().sqrt() / new_margins.pow(2).mean().sqrt().clamp(min=1e-8))
+
+    weight = torch.ones(b - a, device=piece.device)
+    if start > a:
+        weight[: start - a] = torch.linspace(0, 1, start - a, device=piece.device)
+    if b > end:
+        weight[end - a :] = torch.linspace(1, 0, b - end, device=piece.device)
+    out[..., a:b] = original[..., a:b] * (1 - weight) + piece * weight
+    return out
+
+
 def get_negative_style_prompt(device):
     file_path = f"{node_dir}/vocal.npy"
     try:
@@ -153,13 +261,16 @@ class CNENTokenizer:
             raise
 
 
-def get_lrc_token(max_frames, text, tokenizer, device):
+def get_lrc_token(max_frames, text, tokenizer, device, start_frame=0, total_frames=None):
+    # start_frame / total_frames place a window of max_frames inside a longer song,
+    # lyric times are shifted to the window start like the training crops
 
     # max_frames = 2048
     lyrics_shift = 0
     sampling_rate = 44100
     downsample_rate = 2048
     max_secs = max_frames / (sampling_rate / downsample_rate)
+    start_secs = start_frame * downsample_rate / sampling_rate
 
     comma_token_id = 1
     period_token_id = 2
@@ -177,13 +288,13 @@ def get_lrc_token(max_frames, text, tokenizer, device):
     lrc_with_time = modified_lrc_with_time
 
     lrc_with_time = [
-        (time_start, line)
+        (time_start - start_secs, line)
         for (time_start, line) in lrc_with_time
-        if time_start < max_secs
+        if 0 <= time_start - start_secs < max_secs
     ]
     # lrc_with_time = lrc_with_time[:-1] if len(lrc_with_time) >= 1 else lrc_with_time
 
-    normalized_start_time = 0.0
+    normalized_start_time = start_frame / total_frames if total_frames else 0.0
 
     lrc = torch.zeros((max_frames,), dtype=torch.long)
 
@@ -219,14 +330,20 @@ def get_lrc_token(max_frames, text, tokenizer, device):
     return lrc_emb, normalized_start_time
 
 
-def load_checkpoint(model, ckpt_path, device, use_ema=True):
+def load_checkpoint(model, ckpt_path, device, use_ema=True, dtype=None):
     model = model.half()
     if device == 'mps':
         model = model.float()
+    if dtype is not None:
+        model = model.to(dtype)
 
     ckpt_type = ckpt_path.split(".")[-1]
     try:
-        if ckpt_type == "safetensors":
+        if is_checkpoint_dir(ckpt_path):
+            # a Trainer checkpoint directory (model/checkpoint.py), only the weights are read
+            ckpt_type = "dir"
+            checkpoint = load_checkpoint_dir(ckpt_path, keys=["ema_model_state_dict" if use_ema else "model_state_dict"])
+        elif ckpt_type == "safetensors":
             from safetensors.torch import load_file
             checkpoint = load_file(ckpt_path)
         else:
@@ -0,0 +1,139 @@
+"""
+Attention backends for the DiT transformer blocks.
+
+backends:
+sdpa               - torch picks the sdpa kernel (default, same as before)
+sdpa_flash         - force the flash attention kernel
+sdpa_mem_efficient - force the memory-efficient kernel, never materializes the attention matrix
+sdpa_math          - force the reference math kernel
+chunked            - exact attention over query chunks, peak memory grows linearly with frames
+                     on backends without a fused kernel (e.g. CPU)
+
+The same backend is used by the HF LlamaDecoderLayer (through LlamaConfig._attn_implementation)
+and by LlamaInferenceBlock.
+"""
+
+from __future__ import annotations
+
+import torch
+import torch.nn.functional as F
+
+
+ATTENTION_BACKENDS = ["sdpa", "sdpa_flash", "sdpa_mem_efficient", "sdpa_math", "chunked"]
+
+_reported = set()
+
+
+def _sdpa_kernel_context(backend):
+    try:
+        from torch.nn.attention import SDPBackend, sdpa_kernel
+
+        kernels = {
+            "sdpa_flash": SDPBackend.FLASH_ATTENTION,
+            "sdpa_mem_efficient": SDPBackend.EFFICIENT_ATTENTION,
+            "sdpa_math": SDPBackend.MATH,
+        }
+        return sdpa_kernel(kernels[backend])
+    except ImportError:
+        return torch.backends.cuda.sdp_kernel(
+            enable_flash=backend == "sdpa_flash",
+            enable_mem_efficient=backend == "sdpa_mem_efficient",
+            enable_math=backend == "sdpa_math",
+        )
+
+
+def _probe_sdpa_kernel(q, k, v, is_causal):
+    # which kernel torch would dispatch the default sdpa call to
+    if q.device.type != "cuda":
+        return f"{q.device.type} sdpa"
+    try:
+        params = torch.backends.cuda.SDPAParams(q, k, v, None, 0.0, is_causal, False)
+    except TypeError:
+        params = torch.backends.cuda.SDPAParams(q, k, v, None, 0.0, is_causal)
+    except Exception:
+        return "unknown"
+    if torch.backends.cuda.flash_sdp_enabled() and torch.backends.cuda.can_use_flash_attention(params):
+        return "flash"
+    if torch.backends.cuda.mem_efficient_sdp_enabled() and torch.backends.cuda.can_use_efficient_attention(params):
+        return "mem_efficient"
+    return "math"
+
+
+def _report(backend, q, k, v, is_causal, chunk_size):
+    if torch.compiler.is_compiling():
+        return
+    key = (backend, q.device.type, q.dtype, tuple(q.shape))
+    if key in _reported:
+        return
+    _reported.add(key)
+    if backend == "sdpa":
+        kernel = _probe_sdpa_kernel(q, k, v, is_causal)
+    elif backend == "chunked":
+        kernel = f"query chunks of {chunk_size}"
+    else:
+        kernel = backend[len("sdpa_"):]
+    print(f"DiT attention: backend {backend}, kernel {kernel}, {q.device.type} {q.dtype}, q {tuple(q.shape)}")
+
+
+def chunked_attention(q, k, v, is_causal=False, chunk_size=1024):
+    # q, k, v: b h n d. Each chunk only keeps a [b, h, chunk, n] score block alive,
+    # with a causal mask a chunk also only needs the keys up to its last query
+    seq_len = q.shape[-2]
+    out = torch.empty_like(q)
+    for start in range(0, seq_len, chunk_size):
+        end = min(start + chunk_size, seq_len)
+        if is_causal:
+            mask = torch.ones(end - start, end, dtype=torch.bool, device=q.device).tril(diagonal=start)
+            out[..., start:end, :] = F.scaled_dot_product_attention(
+                q[..., start:end, :], k[..., :end, :], v[..., :end, :], attn_mask=mask
+            )
+        else:
+            out[..., start:end, :] = F.scaled_dot_product_attention(q[..., start:end, :], k, v)
+    return out
+
+
+def attention(q, k, v, backend="sdpa", is_causal=False, chunk_size=1024):
+    _report(backend, q, k, v, is_causal, chunk_size)
+    if backend == "sdpa":
+        return F.scaled_dot_product_attention(q, k, v, is_causal=is_causal)
+    if backend == "chunked":
+        return chunked_attention(q, k, v, is_causal=is_causal, chunk_size=chunk_size)
+    with _sdpa_kernel_context(backend):
+        return F.scaled_dot_product_attention(q, k, v, is_causal=is_causal)
+
+
+def _hf_attention_forward(module, query, key, value, attention_mask, dropout=0.0, scaling=None, is_causal=None, **kwargs):
+    # follows transformers' sdpa_attention_forward: no mask and more than one query means causal
+    if attention_mask is not None:
+        raise ValueError("DiffRhythm attention backends do not support an attention mask")
+    groups = getattr(module, "num_key_value_groups", 1)
+    if groups > 1:
+        key = key.repeat_interleave(groups, dim=1)
+        value = value.repeat_interleave(groups, dim=1)
+    if is_causal is None:
+        is_causal = query.shape[2] > 1 and getattr(module, "is_causal", True)
+    backend = module.config.attn_backend
+    out = attention(query, key, value, backend=backend, is_causal=is_causal, chunk_size=module.config.attn_chunk_size)
+    return out.transpose(1, 2).contiguous(), None
+
+
+def hf_attn_implementation(backend):
+    """
+    Name to put in LlamaConfig._attn_implementation for the backend,
+    the non-default backends are registered with transformers on first use.
+    """
+    if backend not in ATTENTION_BACKENDS:
+        raise ValueError(f"Unknown attention backend {backend}, expected one of {ATTENTION_BACKENDS}")
+    if backend == "sdpa":
+        return "sdpa"
+
+    name = "diffrhythm_attention"
+    try:
+        from transformers import AttentionInterface
+
+        AttentionInterface.register(name, _hf_attention_forward)
+    except ImportError:
+        from transformers.modeling_utils import ALL_ATTENTION_FUNCTIONS
+
+        ALL_ATTENTION_FUNCTIONS[name] = _hf_attention_forward
+    return name
@@ -0,0 +1,93 @@
+"""
+Progress, timing and cancellation hooks for sampling and decoding.
+
+CFM.sample and decode_audio report their work as a stage made of steps:
+sample - one step per DiT evaluation (positive and negative cfg pass together)
+decode - one step per VAE chunk, a single step without chunking
+
+Step times are wall times with the device synchronized, so they include the GPU work of the step.
+"""
+
+from __future__ import annotations
+
+import time
+
+from model.compile_utils import _synchronize
+
+
+class SamplingAborted(Exception):
+    """Raised when a callback asks to stop the generation."""
+
+    def __init__(self, step, stage="sample"):
+        super().__init__(f"{stage} aborted at step {step}")
+        self.step = step
+        self.stage = stage
+
+
+class SamplingCallback:
+    """
+    Base class for the hooks, every method is optional.
+    on_step returning False stops the run with SamplingAborted, raising from it stops it with that exception
+    (e.g. ComfyUI's interrupt), either way before the next step starts.
+    """
+
+    def on_stage_start(self, stage, total):
+        pass
+
+    def on_step(self, stage, step, total, elapsed):
+        pass
+
+    def on_stage_end(self, stage, elapsed):
+        pass
+
+
+class CallbackList(SamplingCallback):
+    def __init__(self, *callbacks):
+        self.callbacks = [c for c in callbacks if c is not None]
+
+    def on_stage_start(self, stage, total):
+        for c in self.callbacks:
+            c.on_stage_start(stage, total)
+
+    def on_step(self, stage, step, total, elapsed):
+        results = [c.on_step(stage, step, total, elapsed) for c in self.callbacks]
+        if any(r is False for r in results):
+            return False
+
+    def on_stage_end(self, stage, elapsed):
+        for c in self.callbacks:
+            c.on_stage_end(stage, elapsed)
+
+
+class StageTimer:
+    """Reports one stage to a callback, does nothing without one."""
+
+    def __init__(self, callback, stage, total=1, device=None):
+        self.callback = callback
+        self.stage = stage
+        self.total = total
+        self.device = device
+        self.step_count = 0
+
+    def __enter__(self):
+        if self.callback is not None:
+            self.callback.on_stage_start(self.stage, self.total)
+            self.start = self.last = time.perf_counter()
+        return self
+
+    def step(self):
+        if self.callback is None:
+            return
+        if self.device is not None:
+            _synchronize(self.device)
+        now = time.perf_counter()
+        self.step_count += 1
+        if self.callback.on_step(self.stage, self.step_count, self.total, now - self.last) is False:
+            raise SamplingAborted(self.step_count, self.stage)
+        # time spent in the callback itself is not charged to the next step
+        self.last = time.perf_counter()
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.callback is not None and exc_type is None:
+            self.callback.on_stage_end(self.stage, time.perf_counter() - self.start)
+        return False
@@ -20,6 +20,8 @@ from torch.nn.utils.rnn import pad_sequence
 from torchdiffeq import odeint
 
 from model.modules import MelSpec
+from model.compile_utils import CompiledStep, enable_compile_cache
+from model.callbacks import SamplingAborted, StageTimer
 from model.utils import (
     default,
     exists,
@@ -86,6 +88,14 @@ class CFM(nn.Module):
 
         self.use_style_prompt = use_style_prompt
 
+        # set by enable_compile, kept off the module tree so state_dict is unchanged
+        self._compiled_step = None
+
+    def enable_compile(self, mode=None, backend="inductor", cache_dir=None):
+        if cache_dir is not None:
+            enable_compile_cache(cache_dir)
+        self._compiled_step = CompiledStep(self.transformer.forward, mode=mode, backend=backend)
+
     @property
     def device(self):
         return next(self.parameters()).device
@@ -104,7 +114,7 @@ class CFM(nn.Module):
         steps=32,
         cfg_strength=4.0,
         sway_sampling_coef=None,
-        seed: int | None = None,
+        seed: int | list[int] | None = None,
         max_duration=6144,
         vocoder: Callable[[float["b d n"]], float["b nw"]] | None = None,  # noqa: F722
         no_ref_audio=False,
@@ -113,10 +123,19 @@ class CFM(nn.Module):
         edit_mask=None,
         start_time=None,
         latent_pred_start_frame=0,
-        latent_pred_end_frame=2048,
+        latent_pred_end_frame=None,
         vocal_flag=False,
-        odeint_method="euler"
+        odeint_method="euler",
+        use_cond=False,
+        preview_callback=None,
+        preview_every=8,
+        callback=None,
     ):
+        # use_cond: let the model see cond outside [latent_pred_start_frame, latent_pred_end_frame),
+        # for continuation and span editing. Otherwise cond is only pasted back over the output.
+        # preview_callback(step, estimate) is called every preview_every steps with the current estimate
+        # of the final latent, x + (1 - t) * v, returning False from it aborts sampling.
+        # callback: a SamplingCallback, gets the progress and timing of every step and can cancel between steps.
         self.eval()
         
         self.odeint_kwargs = dict(method=odeint_method)
@@ -157,12 +176,16 @@ class CFM(nn.Module):
             cond_mask = cond_mask & edit_mask
 
         latent_pred_start_frame = torch.tensor([latent_pred_start_frame]).to(cond.device)
-        latent_pred_end_frame = duration
+        latent_pred_end_frame = default(latent_pred_end_frame, duration)
         latent_pred_end_frame = torch.tensor([latent_pred_end_frame]).to(cond.device)
         fixed_span_mask = custom_mask_from_start_end_indices(cond_seq_len, latent_pred_start_frame, latent_pred_end_frame, device=cond.device, max_seq_len=duration)
 
         fixed_span_mask = fixed_span_mask.unsqueeze(-1)
-        step_cond = torch.where(fixed_span_mask, torch.zeros_like(cond), cond)
+
+        # the model only sees cond with use_cond, and an all-zero reference adds nothing to the input projection
+        # (W_cond @ 0 folds into the bias), so without a reference no cond tensor is carried through the steps
+        use_cond = use_cond and bool(cond.any())
+        step_cond = torch.where(fixed_span_mask, torch.zeros_like(cond), cond) if use_cond else None
 
         if isinstance(duration, int):
             duration = torch.full((batch,), duration, device=device, dtype=torch.long)
@@ -185,8 +208,8 @@ class CFM(nn.Module):
         if no_ref_audio:
             cond = torch.zeros_like(cond)
         
-        start_time_embed, positive_text_embed, positive_text_residuals = self.transformer.forward_timestep_invariant(text, step_cond.shape[1], drop_text=False, start_time=start_time)
-        _, negative_text_embed, negative_text_residuals = self.transformer.forward_timestep_invariant(text, step_cond.shape[1], drop_text=True, start_time=start_time)
+        start_time_embed, positive_text_embed, positive_text_residuals = self.transformer.forward_timestep_invariant(text, cond.shape[1], drop_text=False, start_time=start_time)
+        _, negative_text_embed, negative_text_residuals = self.transformer.forward_timestep_invariant(text, cond.shape[1], drop_text=True, start_time=start_time)
 
         if vocal_flag:
             style_prompt = negative_style_prompt
@@ -194,31 +217,45 @@ class CFM(nn.Module):
             
         text_embed = torch.cat([positive_text_embed, negative_text_embed], 0)
         text_residuals = [torch.cat([a, b], 0) for a, b in zip(positive_text_residuals, negative_text_residuals)]
-        step_cond = torch.cat([step_cond, step_cond], 0)
+        if use_cond:
+            step_cond = torch.cat([step_cond, step_cond], 0)
         style_prompt = torch.cat([style_prompt, negative_style_prompt], 0)
         start_time_embed = torch.cat([start_time_embed, start_time_embed], 0)
             
 
+        transformer = self._compiled_step if self._compiled_step is not None else self.transformer
+
+        step = 0
+
         def fn(t, x):
-            x = torch.cat([x, x], 0)
-            pred = self.transformer(
-                x=x, text_embed=text_embed, text_residuals=text_residuals, cond=step_cond, time=t, 
-                drop_audio_cond=True, drop_prompt=False, style_prompt=style_prompt, start_time=start_time_embed
+            nonlocal step
+            pred = transformer(
+                x=torch.cat([x, x], 0), text_embed=text_embed, text_residuals=text_residuals, cond=step_cond, time=t, 
+                drop_audio_cond=not use_cond, drop_prompt=False, style_prompt=style_prompt, start_time=start_time_embed
             )
 
             positive_pred, negative_pred = pred.chunk(2, 0)
             cfg_pred = positive_pred + (positive_pred - negative_pred) * cfg_strength
 
+            step += 1
+            if exists(preview_callback) and preview_every > 0 and step % preview_every == 0:
+                estimate = torch.where(fixed_span_mask, x + (1 - t) * cfg_pred, cond)
+                if preview_callback(step, estimate) is False:
+                    raise SamplingAborted(step)
+
+            timer.step()
             return cfg_pred
 
         # noise input
         # to make sure batch inference result is same with different batch size, and for sure single inference
         # still some difference maybe due to convolutional layers
+        # a list of seeds gives every item of the batch its own noise, the same it would get sampled alone
+        seeds = seed if isinstance(seed, (list, tuple)) else [seed] * batch
         y0 = []
-        for dur in duration:
-            if exists(seed):
-                torch.manual_seed(seed)
-            y0.append(torch.randn(dur, self.num_channels, device=self.device, dtype=step_cond.dtype))
+        for dur, item_seed in zip(duration, seeds):
+            if exists(item_seed):
+                torch.manual_seed(item_seed)
+            y0.append(torch.randn(dur, self.num_channels, device=self.device, dtype=cond.dtype))
         y0 = pad_sequence(y0, padding_value=0, batch_first=True)
 
         t_start = 0
@@ -229,11 +266,16 @@ class CFM(nn.Module):
             y0 = (1 - t_start) * y0 + t_start * test_cond
             steps = int(steps * (1 - t_start))
 
-        t = torch.linspace(t_start, 1, steps, device=self.device, dtype=step_cond.dtype)
+        t = torch.linspace(t_start, 1, steps, device=self.device, dtype=cond.dtype)
         if sway_sampling_coef is not None:
             t = t + sway_sampling_coef * (torch.cos(torch.pi / 2 * t) - 1 + t)
 
-        trajectory = odeint(fn, y0, t, **self.odeint_kwargs)
+        # every interval of t costs one DiT evaluation with euler, two with midpoint, four with rk4
+        evals_per_step = {"midpoint": 2, "rk4": 4}.get(self.odeint_kwargs["method"], 1)
+        with StageTimer(callback, "sample", total=(len(t) - 1) * evals_per_step, device=device) as timer:
+            trajectory = odeint(fn, y0, t, **self.odeint_kwargs)
+        if self._compiled_step is not None:
+            self._compiled_step.report(device)
 
         sampled = trajectory[-1]
         out = sampled
@@ -299,9 +341,9 @@ class CFM(nn.Module):
 
         # if want rigourously mask out padding, record in collate_fn in dataset.py, and pass in here
         # adding mask will use more memory, thus also need to adjust batchsampler with scaled down threshold for long sequences
-        pred = self.transformer(
+        pred = self.transformer.forward_train(
             x=φ, cond=cond, text=text, time=time, drop_audio_cond=drop_audio_cond, drop_text=drop_text, drop_prompt=drop_prompt,
-            style_prompt=style_prompt, style_prompt_lens=style_prompt_lens, grad_ckpt=grad_ckpt, start_time=start_time
+            style_prompt=style_prompt, grad_ckpt=grad_ckpt, start_time=start_time
         )
 
         # flow matching loss
@@ -0,0 +1,216 @@
+"""
+Asynchronous, sharded safetensors checkpoints for the Trainer.
+
+A checkpoint is a directory, model_<step>/ or model_last/, holding
+
+checkpoint.json                  the step, the structure of the saved state with every tensor
+                                 replaced by its key (optimizer param_groups, scheduler state ...)
+                                 and the key -> shard file map
+state-00001-of-0000N.safetensors the tensors, split into shards of at most max_shard_bytes
+
+save() only copies the tensors to host memory (pinned when training on GPU, allocated per save
+unless reuse_buffers keeps them for the next one at the cost of holding a full copy between saves),
+serialization runs on a background thread into <name>.tmp/ which is renamed into place once
+every file is on disk, so a crash never leaves a half-written checkpoint under a real name.
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import shutil
+import threading
+
+import torch
+
+CHECKPOINT_FILE = "checkpoint.json"
+
+
+def _flatten(obj, prefix, tensors):
+    """JSON-able structure of obj with tensors moved to tensors[key], non-str dict keys and tuples kept"""
+    if torch.is_tensor(obj):
+        tensors[prefix] = obj
+        return {"__tensor__": prefix}
+    if isinstance(obj, dict):
+        if all(isinstance(k, str) for k in obj):
+            return {k: _flatten(v, f"{prefix}.{k}", tensors) for k, v in obj.items()}
+        return {"__items__": [[k, _flatten(v, f"{prefix}.{k}", tensors)] for k, v in obj.items()]}
+    if isinstance(obj, tuple):
+        return {"__tuple__": [_flatten(v, f"{prefix}.{i}", tensors) for i, v in enumerate(obj)]}
+    if isinstance(obj, list):
+        return [_flatten(v, f"{prefix}.{i}", tensors) for i, v in enumerate(obj)]
+    return obj
+
+
+def _unflatten(obj, tensors):
+    if isinstance(obj, dict):
+        if "__tensor__" in obj:
+            return tensors[obj["__tensor__"]]
+        if "__items__" in obj:
+            return {k: _unflatten(v, tensors) for k, v in obj["__items__"]}
+        if "__tuple__" in obj:
+            return tuple(_unflatten(v, tensors) for v in obj["__tuple__"])
+        return {k: _unflatten(v, tensors) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [_unflatten(v, tensors) for v in obj]
+    return obj
+
+
+def _fsync(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def is_checkpoint_dir(path):
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, CHECKPOINT_FILE))
+
+
+def checkpoint_step(path):
+    with open(os.path.join(path, CHECKPOINT_FILE), "r", encoding="utf-8") as f:
+        return json.load(f)["step"]
+
+
+def load_checkpoint_dir(path, device="cpu", keys=None):
+    """
+    The state dict saved by AsyncCheckpointer.save, with its original nesting.
+    keys limits it to those top level entries, e.g. ["ema_model_state_dict"] reads only the EMA weights.
+    """
+    from safetensors import safe_open
+
+    with open(os.path.join(path, CHECKPOINT_FILE), "r", encoding="utf-8") as f:
+        meta = json.load(f)
+    state = meta["state"]
+    if keys is not None:
+        state = {k: v for k, v in state.items() if k in keys}
+
+    # tensor keys are state.<top level key>[.<nested keys>], see _flatten
+    shards = {}
+    for key, shard in meta["weight_map"].items():
+        if key.split(".", 2)[1] in state:
+            shards.setdefault(shard, []).append(key)
+    tensors = {}
+    for shard, shard_keys in sorted(shards.items()):
+        with safe_open(os.path.join(path, shard), framework="pt", device=device) as f:
+            tensors.update({key: f.get_tensor(key) for key in shard_keys})
+    return _unflatten(state, tensors)
+
+
+class AsyncCheckpointer:
+    def __init__(
+        self, checkpoint_path, keep_last_n=None, max_shard_bytes=2 * 2**30, pin_memory=None, reuse_buffers=False
+    ):
+        self.checkpoint_path = checkpoint_path
+        self.keep_last_n = keep_last_n
+        self.max_shard_bytes = max_shard_bytes
+        self.pin_memory = torch.cuda.is_available() if pin_memory is None else pin_memory
+        self.reuse_buffers = reuse_buffers
+        # with reuse_buffers, host copies of the last snapshot, reused by the next one once its write is done
+        self._buffers = {}
+        self._thread = None
+        self._error = None
+
+    def _snapshot(self, tensors):
+        host = {}
+        for key, tensor in tensors.items():
+            tensor = tensor.detach()
+            buffer = self._buffers.get(key)
+            if buffer is None or buffer.shape != tensor.shape or buffer.dtype != tensor.dtype:
+                buffer = torch.empty(tensor.shape, dtype=tensor.dtype, device="cpu", pin_memory=self.pin_memory)
+                if self.reuse_buffers:
+                    self._buffers[key] = buffer
+            buffer.copy_(tensor, non_blocking=True)
+            host[key] = buffer
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        for key in set(self._buffers) - set(tensors):
+            del self._buffers[key]
+        return host
+
+    def save(self, state, name, step):
+        """Snapshots state (nested dicts / lists of tensors and plain values) and writes it in the background"""
+        # the buffers are still being written while the previous save runs
+        self.wait()
+        tensors = {}
+        structure = _flatten(state, "state", tensors)
+        host = self._snapshot(tensors)
+        self._thread = threading.Thread(
+            target=self._write_guarded, args=(host, structure, name, step), name="checkpoint-writer", daemon=False
+        )
+        self._thread.start()
+
+    def _write_guarded(self, host, structure, name, step):
+        try:
+            self._write(host, structure, name, step)
+        except BaseException as e:
+            self._error = e
+
+    def _write(self, host, structure, name, step):
+        from safetensors.torch import save_file
+
+        os.makedirs(self.checkpoint_path, exist_ok=True)
+        final_dir = os.path.join(self.checkpoint_path, name)
+        tmp_dir = f"{final_dir}.tmp"
+        if os.path.exists(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        os.makedirs(tmp_dir)
+
+        shards = [[]]
+        shard_bytes = 0
+        for key, tensor in host.items():
+            size = tensor.numel() * tensor.element_size()
+            if shards[-1] and shard_bytes + size > self.max_shard_bytes:
+                shards.append([])
+                shard_bytes = 0
+            shards[-1].append(key)
+            shard_bytes += size
+
+        weight_map = {}
+        for i, keys in enumerate(shards):
+            shard_name = f"state-{i + 1:05d}-of-{len(shards):05d}.safetensors"
+            shard_path = os.path.join(tmp_dir, shard_name)
+            save_file({key: host[key] for key in keys}, shard_path, metadata={"format": "pt"})
+            _fsync(shard_path)
+            weight_map.update({key: shard_name for key in keys})
+
+        meta_path = os.path.join(tmp_dir, CHECKPOINT_FILE)
+        with open(meta_path, "w", encoding="utf-8") as f:
+            json.dump({"step": step, "state": structure, "weight_map": weight_map}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        _fsync(tmp_dir)
+
+        # a directory rename can't replace an existing one, model_last is moved aside first
+        old_dir = f"{final_dir}.old"
+        if os.path.exists(final_dir):
+            if os.path.exists(old_dir):
+                shutil.rmtree(old_dir)
+            os.replace(final_dir, old_dir)
+        os.replace(tmp_dir, final_dir)
+        _fsync(self.checkpoint_path)
+        if os.path.exists(old_dir):
+            shutil.rmtree(old_dir)
+
+        self._prune()
+
+    def _prune(self):
+        if not self.keep_last_n:
+            return
+        steps = []
+        for name in os.listdir(self.checkpoint_path):
+            path = os.path.join(self.checkpoint_path, name)
+            if name.startswith("model_") and name[len("model_"):].isdigit() and is_checkpoint_dir(path):
+                steps.append((int(name[len("model_"):]), path))
+        for _, path in sorted(steps)[: -self.keep_last_n]:
+            shutil.rmtree(path)
+
+    def wait(self):
+        """Blocks until the last save is on disk, raising its error if it failed"""
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError("Writing the checkpoint failed") from error
@@ -0,0 +1,111 @@
+"""
+torch.compile helpers for the sampling loop.
+
+The per-step DiT forward runs with fixed shapes (2048 or 6144 frames, batch 2 x N for cfg),
+so it compiles once and is reused for every step and every later sample call.
+"""
+
+from __future__ import annotations
+
+import logging
+import os
+import time
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+# eager step time per (device type, input shape, dtype), measured once per process for the compile report
+_EAGER_STEP_TIMES = {}
+
+
+def enable_compile_cache(cache_dir):
+    # inductor reads the cache dir from the environment on each lookup,
+    # the fx graph cache makes compiled kernels reusable across processes
+    os.makedirs(cache_dir, exist_ok=True)
+    os.environ.setdefault("TORCHINDUCTOR_CACHE_DIR", cache_dir)
+    try:
+        import torch._inductor.config as inductor_config
+
+        inductor_config.fx_graph_cache = True
+    except Exception as e:
+        logger.warning("inductor cache config unavailable: %s", e)
+
+
+def _synchronize(device):
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    elif device.type == "mps":
+        torch.mps.synchronize()
+
+
+class CompiledStep:
+    """
+    Calls a compiled version of `fn`, falling back to eager for the rest of the process
+    if compilation or the compiled call fails.
+    The first call, which compiles, is timed apart from the later ones to report the compile cost,
+    and the first CompiledStep of the process for a given input shape also times one eager call
+    to report the per-step saving against it.
+    """
+
+    def __init__(self, fn, mode=None, backend="inductor"):
+        self.eager_fn = fn
+        self.compiled_fn = torch.compile(fn, mode=mode, backend=backend, dynamic=False)
+        self.failed = False
+
+        self.first_call_time = None
+        self.steady_start = None
+        self.steady_calls = 0
+        self.reported = False
+
+    def __call__(self, *args, **kwargs):
+        if self.failed:
+            return self.eager_fn(*args, **kwargs)
+
+        x = args[0] if args else kwargs["x"]
+        device = x.device
+        first_call = self.first_call_time is None
+        if first_call:
+            self.eager_key = (device.type, tuple(x.shape), x.dtype)
+            _synchronize(device)
+            if self.eager_key not in _EAGER_STEP_TIMES:
+                start = time.perf_counter()
+                self.eager_fn(*args, **kwargs)
+                _synchronize(device)
+                _EAGER_STEP_TIMES[self.eager_key] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        try:
+            out = self.compiled_fn(*args, **kwargs)
+        except Exception as e:
+            logger.warning("torch.compile failed, falling back to eager sampling: %s", e)
+            self.failed = True
+            return self.eager_fn(*args, **kwargs)
+
+        if first_call:
+            _synchronize(device)
+            self.first_call_time = time.perf_counter() - start
+        else:
+            if self.steady_start is None:
+                self.steady_start = start
+            self.steady_calls += 1
+        return out
+
+    def report(self, device):
+        if self.failed or self.reported or self.steady_calls == 0:
+            return
+        _synchronize(device)
+        step_time = (time.perf_counter() - self.steady_start) / self.steady_calls
+        # the first call is one step plus the compilation
+        compile_time = max(self.first_call_time - step_time, 0.0)
+        eager_time = _EAGER_STEP_TIMES[self.eager_key]
+        saved = eager_time - step_time
+        msg = "compiled sampling: compile %.2f s, eager %.1f ms/step, compiled %.1f ms/step" % (
+            compile_time, eager_time * 1000, step_time * 1000
+        )
+        if saved > 0:
+            msg += ", saves %.1f ms/step, pays off after %.0f steps" % (saved * 1000, compile_time / saved)
+        else:
+            msg += ", no faster than eager"
+        logger.info(msg)
+        self.reported = True
@@ -13,21 +13,33 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
+import numpy as np
 import torch
 import random
 
+from model.sample_index import SampleIndex, build_sample_index, index_path, scan_shards
+from model.shards import ShardReader
+
 class DiffusionDataset(torch.utils.data.Dataset):
-    def __init__(self, file_path, max_frames=2048, min_frames=512, sampling_rate=44100, downsample_rate=2048, precision='fp16'):
+    def __init__(self, file_path, max_frames=2048, min_frames=512, sampling_rate=44100, downsample_rate=2048, precision='fp16', max_retries=8):
 
         self.max_frames = max_frames
         self.min_frames = min_frames
+        self.max_retries = max_retries
         self.sampling_rate = sampling_rate
         self.downsample_rate = 2048
         self.max_secs = max_frames / (sampling_rate / downsample_rate)
 
+        # either a train.scp of per-item .pt files or a directory of packed shards (model/shards.py)
         self.file_path = file_path
-        with open(file_path, 'r') as f:
-            self.file_lst = [line.strip() for line in f.readlines()]
+        if ShardReader.is_shard_dir(file_path):
+            self.shards = ShardReader(file_path)
+            self.file_lst = list(range(len(self.shards)))
+        else:
+            self.shards = None
+            with open(file_path, 'r') as f:
+                self.file_lst = [line.strip() for line in f.readlines()]
 
         self.pad_token_id = 0
         self.comma_token_id = 1
@@ -41,18 +53,38 @@ class DiffusionDataset(torch.utils.data.Dataset):
         elif precision == 'fp32':
             self.feature_dtype = torch.float32
 
-        random.seed(42)
-        random.shuffle(self.file_lst)
+        # only items with a usable crop are sampled when there's a sample index (model/sample_index.py)
+        self.sample_index = self.load_sample_index()
+        if self.sample_index is not None:
+            self.index_lst = self.sample_index.valid_items().tolist()
+            print(f"DiffusionDataset: {self.sample_index.report()}")
+        else:
+            self.index_lst = list(range(len(self.file_lst)))
 
-    def load_item(self, item, field):
-        try:
-            item, reader_idx = item[field]
-            item = self.lance_connections[reader_idx].get_datas_by_rowids([item._rowid])[0]
-        except Exception as e:
-            return None
-        return item
+        random.seed(42)
+        random.shuffle(self.index_lst)
+
+    def load_sample_index(self):
+        path = index_path(self.file_path, self.max_frames, self.min_frames)
+        frames_per_sec = self.sampling_rate / self.downsample_rate
+        if os.path.exists(path):
+            sample_index = SampleIndex.load(path)
+            if len(sample_index) == len(self.file_lst) and abs(sample_index.frames_per_sec - frames_per_sec) < 1e-6:
+                return sample_index
+            print(f"DiffusionDataset: {path} doesn't match the data, rebuild it with python -m model.sample_index")
+        if self.shards is not None:
+            # cheap for shards, it only reads the shard index
+            return build_sample_index(scan_shards(self.shards), self.max_frames, self.min_frames, frames_per_sec)
+        print(f"DiffusionDataset: no sample index for {self.file_path}, unusable items are skipped by retrying, "
+              "run python -m model.sample_index to index it")
+        return None
+
+    def load_item(self, item):
+        """lrc_with_time, style prompt [d], latent length and a reader for latent frames [start, end) as [d, t]"""
+        if self.shards is not None:
+            read_latent = lambda start, end: self.shards.latent(item, start, end)
+            return self.shards.lrc(item), self.shards.style(item), self.shards.latent_len(item), read_latent
 
-    def get_triple(self, item):
         utt, lrc_path, latent_path, style_path = item.split("|")
 
         time_lrc = torch.load(lrc_path, map_location='cpu')
@@ -66,11 +98,44 @@ class DiffusionDataset(torch.utils.data.Dataset):
         prompt = torch.load(style_path, map_location='cpu') # [b, d]
         prompt = prompt.squeeze(0)
 
-        max_start_frame = max(0, latent.shape[-1] - self.max_frames)
-        start_frame = random.randint(0, max_start_frame)
+        read_latent = lambda start, end: latent[:, start:end]
+        return lrc_with_time, prompt, latent.shape[-1], read_latent
+
+    def crop_from_timeline(self, idx, start_frame=None):
+        """get_triple for shards with a lyric timeline: the crop's lrc is a slice of it, no per line work"""
+        latent_len = self.shards.latent_len(idx)
+        if start_frame is None:
+            start_frame = random.randint(0, max(0, latent_len - self.max_frames))
         start_time = start_frame * self.downsample_rate / self.sampling_rate
-        normalized_start_time = start_frame / latent.shape[-1]
-        latent = latent[:, start_frame:]
+        normalized_start_time = start_frame / latent_len
+
+        # lines starting inside the crop, the last one only marks where the latent ends
+        times = self.shards.line_times(idx) - start_time
+        lines = np.nonzero((times >= 0) & (times < self.max_secs))[0]
+        if len(lines) == 0:
+            raise ValueError("no lyric line starts in the crop")
+        latent_end_time = float(times[lines[-1]])
+
+        window = self.shards.timeline(idx, start_frame, start_frame + self.max_frames)
+        tokens = np.where(np.isin(window[:, 1], lines[:-1]), window[:, 0], 0)
+        lrc = torch.from_numpy(tokens.astype(np.int64))
+
+        latent = self.shards.latent(idx, start_frame, start_frame + int(latent_end_time * self.sampling_rate / self.downsample_rate))
+        latent = latent.to(self.feature_dtype)
+        prompt = self.shards.style(idx).to(self.feature_dtype)
+
+        return prompt, lrc, latent, normalized_start_time
+
+    def get_triple(self, item, start_frame=None):
+        if self.shards is not None and self.shards.has_timeline:
+            return self.crop_from_timeline(item, start_frame)
+
+        lrc_with_time, prompt, latent_len, read_latent = self.load_item(item)
+
+        if start_frame is None:
+            start_frame = random.randint(0, max(0, latent_len - self.max_frames))
+        start_time = start_frame * self.downsample_rate / self.sampling_rate
+        normalized_start_time = start_frame / latent_len
 
         lrc_with_time = [(time_start - start_time, line) for (time_start, line) in lrc_with_time if (time_start - start_time) >= 0] # empty for pure music
         lrc_with_time = [(time_start, line) for (time_start, line) in lrc_with_time if time_start < self.max_secs] # drop time longer than max_secs
@@ -78,7 +143,7 @@ class DiffusionDataset(torch.utils.data.Dataset):
         if len(lrc_with_time) >= 1:
             latent_end_time = lrc_with_time[-1][0]
         else:
-            raise
+            raise ValueError("no lyric line starts in the crop")
 
         lrc_with_time = lrc_with_time[:-1] if len(lrc_with_time) >= 1 else lrc_with_time # drop last, can be empty
 
@@ -103,7 +168,8 @@ class DiffusionDataset(torch.utils.data.Dataset):
             tokens_count += num_tokens
             last_end_pos = frame_start + frame_len
 
-        latent = latent[:, :int(latent_end_time * self.sampling_rate / self.downsample_rate)]
+        # only the cropped frames are read, from the shards that is one contiguous slice
+        latent = read_latent(start_frame, start_frame + int(latent_end_time * self.sampling_rate / self.downsample_rate))
 
         latent = latent.to(self.feature_dtype)
         prompt = prompt.to(self.feature_dtype)
@@ -111,12 +177,27 @@ class DiffusionDataset(torch.utils.data.Dataset):
         return prompt, lrc, latent, normalized_start_time
 
     def __getitem__(self, index):
+        if self.sample_index is not None:
+            # the index only holds items with a crop start that get_triple accepts, a file changed or
+            # corrupted since indexing is still skipped for another indexed item, a few times at most
+            pos = self.index_lst[index]
+            for attempt in range(self.max_retries + 1):
+                try:
+                    start_frame = self.sample_index.sample_start(pos, random)
+                    prompt, lrc, latent, start_time = self.get_triple(self.file_lst[pos], start_frame)
+                    return {'prompt': prompt, "lrc": lrc, "latent": latent, "start_time": start_time}
+                except Exception as e:
+                    if attempt == self.max_retries:
+                        raise
+                    print(f"DiffusionDataset: skipping item {self.file_lst[pos]}: {e}")
+                    pos = random.choice(self.index_lst)
+
         idx = index
         while True:
             try:
-                prompt, lrc, latent, start_time = self.get_triple(self.file_lst[idx])
-                if latent.shape[-1] < self.min_frames: # Too short
-                    raise
+                prompt, lrc, latent, start_time = self.get_triple(self.file_lst[self.index_lst[idx]])
+                if latent.shape[-1] < self.min_frames:
+                    raise ValueError("crop shorter than min_frames")
                 item = {'prompt': prompt, "lrc": lrc, "latent": latent, "start_time": start_time}
                 return item
             except Exception as e:
@@ -124,45 +205,116 @@ class DiffusionDataset(torch.utils.data.Dataset):
                 continue
 
     def __len__(self):
-        return len(self.file_lst)
+        return len(self.index_lst)
+
+    def frame_lengths(self):
+        """Upper bound of every item's cropped length in frames, in dataset order, for DynamicBatchSampler"""
+        if self.sample_index is not None:
+            return [min(int(self.sample_index.latent_len[pos]), self.max_frames) for pos in self.index_lst]
+        if self.shards is None:
+            # the latent length of an scp item is only known after loading it, index it to batch by length
+            print("DiffusionDataset: item lengths unknown for a train.scp, every item counts as max_frames")
+            return [self.max_frames] * len(self.index_lst)
+        return [min(self.shards.latent_len(pos), self.max_frames) for pos in self.index_lst]
 
     def custom_collate_fn(self, batch):
-        latent_list = [item['latent'] for item in batch]
-        prompt_list = [item['prompt'] for item in batch]
-        lrc_list = [item['lrc'] for item in batch]
-        start_time_list = [item['start_time'] for item in batch]
-
-        latent_lengths = torch.LongTensor([latent.shape[-1] for latent in latent_list])
-        prompt_lengths = torch.LongTensor([prompt.shape[-1] for prompt in prompt_list])
-        lrc_lengths = torch.LongTensor([lrc.shape[-1] for lrc in lrc_list])
-
-        max_prompt_length = prompt_lengths.amax()
-
-        padded_prompt_list = []
-        for prompt in prompt_list:
-            padded_prompt = torch.nn.functional.pad(prompt, (0, max_prompt_length - prompt.shape[-1]))
-            padded_prompt_list.append(padded_prompt)
-
-        padded_latent_list = []
-        for latent in latent_list:
-            padded_latent = torch.nn.functional.pad(latent, (0, self.max_frames - latent.shape[-1]))
-            padded_latent_list.append(padded_latent)
-
-        padded_start_time_list = []
-        for start_time in start_time_list:
-            padded_start_time = start_time
-            padded_start_time_list.append(padded_start_time)
-
-        prompt_tensor = torch.stack(padded_prompt_list)
-        lrc_tensor = torch.stack(lrc_list)
-        latent_tensor = torch.stack(padded_latent_list)
-        start_time_tensor = torch.tensor(padded_start_time_list)
+        batch_size = len(batch)
+        latent_lengths = torch.LongTensor([item['latent'].shape[-1] for item in batch])
+        prompt_lengths = torch.LongTensor([item['prompt'].shape[-1] for item in batch])
+
+        # pad to the longest item of the batch, lyric tokens may run a few frames past the last latent frame
+        lrc_ends = [int(item['lrc'].nonzero().max()) + 1 if item['lrc'].any() else 0 for item in batch]
+        max_length = max(int(latent_lengths.amax()), max(lrc_ends))
+        lrc_lengths = torch.full((batch_size,), max_length, dtype=torch.long)
+
+        # the items are copied once into zeroed batch tensors, pinned right away when collating in the
+        # main process (the DataLoader pins batches coming from workers itself)
+        pin = torch.cuda.is_available() and torch.utils.data.get_worker_info() is None
+        latent_dim = batch[0]['latent'].shape[0]
+        prompt_tensor = torch.zeros((batch_size, int(prompt_lengths.amax())), dtype=batch[0]['prompt'].dtype, pin_memory=pin)
+        lrc_tensor = torch.zeros((batch_size, max_length), dtype=torch.long, pin_memory=pin)
+        latent_tensor = torch.zeros((batch_size, latent_dim, max_length), dtype=batch[0]['latent'].dtype, pin_memory=pin)
+        for i, item in enumerate(batch):
+            prompt_tensor[i, :prompt_lengths[i]] = item['prompt']
+            lrc = item['lrc'][:max_length]
+            lrc_tensor[i, :lrc.shape[-1]] = lrc
+            latent_tensor[i, :, :latent_lengths[i]] = item['latent']
+
+        start_time_tensor = torch.tensor([item['start_time'] for item in batch])
 
         return {'prompt': prompt_tensor, 'lrc': lrc_tensor, 'latent': latent_tensor, \
                 "prompt_lengths": prompt_lengths, "lrc_lengths": lrc_lengths, "latent_lengths": latent_lengths, \
                 "start_time": start_time_tensor}
 
 
+class DynamicBatchSampler(torch.utils.data.Sampler):
+    """
+    Packs items into batches of at most frames_threshold padded frames (batch size times its longest item)
+    and max_samples items. Items are bucketed by length, sorted inside a bucket so a batch pads little,
+    and the batch order is shuffled across buckets every epoch.
+
+    The sampler yields the batches of all processes: every num_replicas consecutive batches come from
+    the same bucket, so when accelerate deals them out to the processes their step times stay close,
+    and the batch count is a multiple of num_replicas.
+    """
+
+    def __init__(self, lengths, frames_threshold, max_samples=0, num_replicas=1, bucket_frames=256, shuffle=True, seed=0):
+        self.lengths = list(lengths)
+        self.frames_threshold = frames_threshold
+        self.max_samples = max_samples
+        self.num_replicas = num_replicas
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+
+        too_long = [i for i, length in enumerate(self.lengths) if length > frames_threshold]
+        if too_long:
+            raise ValueError(f"{len(too_long)} items are longer than frames_threshold={frames_threshold}")
+
+        buckets = {}
+        for idx, length in enumerate(self.lengths):
+            buckets.setdefault(length // bucket_frames, []).append(idx)
+        self.buckets = [buckets[key] for key in sorted(buckets)]
+
+        # the batch boundaries only depend on the sorted lengths, so the count is the same every epoch
+        self.num_batches = sum(len(self._pack(bucket)) // num_replicas * num_replicas for bucket in self.buckets)
+
+    def _pack(self, indices):
+        batches = []
+        batch = []
+        for idx in sorted(indices, key=lambda i: self.lengths[i]):
+            full = self.max_samples > 0 and len(batch) >= self.max_samples
+            if batch and (full or (len(batch) + 1) * self.lengths[idx] > self.frames_threshold):
+                batches.append(batch)
+                batch = []
+            batch.append(idx)
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        generator = random.Random(self.seed + self.epoch)
+        groups = []
+        for bucket in self.buckets:
+            bucket = list(bucket)
+            if self.shuffle:
+                # a different order among items of equal length, the stable sort in _pack keeps it
+                generator.shuffle(bucket)
+            batches = self._pack(bucket)
+            usable = len(batches) // self.num_replicas * self.num_replicas
+            groups.extend(batches[i : i + self.num_replicas] for i in range(0, usable, self.num_replicas))
+        if self.shuffle:
+            generator.shuffle(groups)
+        for group in groups:
+            yield from group
+
+    def __len__(self):
+        return self.num_batches
+
+
 if __name__ == "__main__":
     dd = DiffusionDataset("../dataset/train.scp", 2048, 512)
     x = dd[0]
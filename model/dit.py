@@ -17,12 +17,15 @@ from transformers.models.llama.modeling_llama import LlamaDecoderLayer, LlamaRot
 from transformers.models.llama import LlamaConfig
 from torch.utils.checkpoint import checkpoint
 
+from model.attention import hf_attn_implementation
+
 from model.modules import (
     TimestepEmbedding,
     ConvNeXtV2Block,
     ConvPositionEmbedding,
     DiTBlock,
     AdaLayerNormZero_Final,
+    LlamaInferenceBlock,
     precompute_freqs_cis,
     get_pos_embed_indices,
 )
@@ -73,14 +76,22 @@ class InputEmbedding(nn.Module):
         super().__init__()
         self.proj = nn.Linear(mel_dim * 2 + text_dim + cond_dim * 2, out_dim)
         self.conv_pos_embed = ConvPositionEmbedding(dim=out_dim)
+        self.split_sizes = [mel_dim, mel_dim, text_dim, cond_dim, cond_dim]
 
     def forward(self, x: float["b n d"], cond: float["b n d"], text_embed: float["b n d"], style_emb, time_emb, drop_audio_cond=False):  # noqa: F722
-        if drop_audio_cond:  # cfg for cond audio
-            cond = torch.zeros_like(cond)
-
-        style_emb = style_emb.unsqueeze(1).repeat(1, x.shape[1], 1)
-        time_emb = time_emb.unsqueeze(1).repeat(1, x.shape[1], 1)
-        x = self.proj(torch.cat((x, cond, text_embed, style_emb, time_emb), dim=-1))
+        # same as proj over cat((x, cond, text_embed, style, time)) with style and time repeated over frames,
+        # but the per-sequence style / time part is projected once and broadcast over frames.
+        # A dropped cond is zeros, its part of the projection is skipped
+        w_x, w_cond, w_text, w_style, w_time = self.proj.weight.split(self.split_sizes, dim=-1)
+
+        # torch.cat used to promote the (always half) style prompt to the model dtype, F.linear doesn't
+        style_emb = style_emb.to(w_style.dtype)
+        time_emb = time_emb.to(w_time.dtype)
+        seq_bias = F.linear(style_emb, w_style, self.proj.bias) + F.linear(time_emb, w_time)
+        x = F.linear(x, w_x).add_(F.linear(text_embed, w_text))
+        if cond is not None and not drop_audio_cond:  # cfg for cond audio, None is an all-zero cond
+            x.add_(F.linear(cond, w_cond))
+        x.add_(seq_bias.unsqueeze(1))
         x = self.conv_pos_embed(x) + x
         return x
 
@@ -105,6 +116,9 @@ class DiT(nn.Module):
         long_skip_connection=False,
         use_style_prompt=False,
         max_pos=2048,
+        fused_blocks=False,
+        attn_backend="sdpa",
+        attn_chunk_size=1024,
     ):
         super().__init__()
 
@@ -121,10 +135,14 @@ class DiT(nn.Module):
         self.depth = depth
 
         llama_config = LlamaConfig(hidden_size=dim, intermediate_size=dim * ff_mult, hidden_act='silu', max_position_embeddings=max_pos)
-        llama_config._attn_implementation = 'sdpa'
+        llama_config._attn_implementation = hf_attn_implementation(attn_backend)
+        llama_config.attn_backend = attn_backend
+        llama_config.attn_chunk_size = attn_chunk_size
 
+        # fused_blocks swaps in the lean inference block, keep the HF layer for training
+        block_cls = LlamaInferenceBlock if fused_blocks else LlamaDecoderLayer
         self.transformer_blocks = nn.ModuleList(
-            [LlamaDecoderLayer(llama_config, layer_idx=i) for i in range(depth)]
+            [block_cls(llama_config, layer_idx=i) for i in range(depth)]
         )
         self.rotary_emb = LlamaRotaryEmbedding(config=llama_config)
         self.long_skip_connection = nn.Linear(dim * 2, dim, bias=False) if long_skip_connection else None
@@ -160,12 +178,13 @@ class DiT(nn.Module):
         x: float["b n d"],  # nosied input audio  # noqa: F722
         text_embed: int["b nt"],  # text  # noqa: F722
         text_residuals,
-        cond: float["b n d"],  # masked cond audio  # noqa: F722
+        cond: float["b n d"] | None,  # masked cond audio, None for no reference  # noqa: F722
         time: float["b"] | float[""],  # time step  # noqa: F821 F722
         drop_audio_cond,  # cfg for cond audio
         drop_prompt=False,
         style_prompt=None, # [b d t]
         start_time=None,
+        grad_ckpt=0,
     ):
         batch, seq_len = x.shape[0], x.shape[1]
         if time.ndim == 0:
@@ -188,8 +207,13 @@ class DiT(nn.Module):
         pos_ids = pos_ids.unsqueeze(0).repeat(x.shape[0], 1)
         rotary_embed = self.rotary_emb(x, pos_ids)
 
+        # grad_ckpt=k recomputes the activations of every k-th block in backward, True means every block
+        ckpt_every = int(grad_ckpt) if self.training and torch.is_grad_enabled() else 0
         for i, block in enumerate(self.transformer_blocks):
-            x, *_ = block(x, position_embeddings=rotary_embed)
+            if ckpt_every > 0 and i % ckpt_every == 0:
+                x, *_ = checkpoint(block, x, position_embeddings=rotary_embed, use_reentrant=False)
+            else:
+                x, *_ = block(x, position_embeddings=rotary_embed)
             if i < self.depth // 2:
                 x = x + text_residuals[i]
 
@@ -200,3 +224,25 @@ class DiT(nn.Module):
         output = self.proj_out(x)
 
         return output
+
+    def forward_train(
+        self,
+        x: float["b n d"],  # nosied input audio  # noqa: F722
+        text: int["b nt"],  # text  # noqa: F722
+        cond: float["b n d"],  # masked cond audio  # noqa: F722
+        time: float["b"] | float[""],  # time step  # noqa: F821 F722
+        drop_audio_cond=False,
+        drop_text=False,
+        drop_prompt=False,
+        style_prompt=None,
+        start_time=None,
+        grad_ckpt=0,
+    ):
+        """Training forward from raw lyric tokens, CFM.sample precomputes the text embedding once instead"""
+        start_time_embed, text_embed, text_residuals = self.forward_timestep_invariant(
+            text, x.shape[1], drop_text=drop_text, start_time=start_time
+        )
+        return self.forward(
+            x, text_embed, text_residuals, cond, time, drop_audio_cond,
+            drop_prompt=drop_prompt, style_prompt=style_prompt, start_time=start_time_embed, grad_ckpt=grad_ckpt,
+        )
@@ -0,0 +1,215 @@
+"""
+A lighter EMA of the training weights than ema_pytorch.EMA, with the same state_dict layout
+(initted, step, ema_model.*), so checkpoints load in either and in diffrhythm_utils.load_checkpoint.
+
+The schedule and the decay are ema_pytorch's, so the same ema_kwargs give the same average in either:
+the first update copies the weights, then every `update_every` steps the weights are copied until
+`update_after_step` and averaged after it, once, with the decay 1 - (1 + epoch / inv_gamma) ** -power
+clamped to [min_value, beta]. beta is thus the decay of one update, not of one optimizer step.
+The average is a single fused torch._foreach_lerp_.
+
+mode
+    "device"   EMA weights next to the model
+    "cpu"      EMA weights in host memory, the weights are copied to pinned buffers and averaged on a
+               background thread while training goes on
+    "sharded"  every process of a DDP run averages 1 / world_size of the parameters, gather() collects
+               them on rank 0 before a checkpoint and scatter() hands a loaded EMA back out
+"""
+
+from __future__ import annotations
+
+import copy
+import threading
+
+import torch
+from torch import nn
+
+EMA_MODES = ["device", "cpu", "sharded"]
+
+
+class FastEMA(nn.Module):
+    def __init__(
+        self,
+        model: nn.Module,
+        beta=0.9999,
+        update_after_step=100,
+        update_every=10,
+        inv_gamma=1.0,
+        power=2 / 3,
+        min_value=0.0,
+        mode="device",
+        rank=0,
+        world_size=1,
+        **kwargs,  # the other ema_pytorch options, e.g. include_online_model, don't apply here
+    ):
+        super().__init__()
+        if mode not in EMA_MODES:
+            raise ValueError(f"Unknown EMA mode {mode}, expected one of {EMA_MODES}")
+        self.beta = beta
+        self.update_after_step = update_after_step
+        self.update_every = update_every
+        self.inv_gamma = inv_gamma
+        self.power = power
+        self.min_value = min_value
+        self.mode = mode
+        self.rank = rank if mode == "sharded" else 0
+        self.world_size = world_size if mode == "sharded" else 1
+
+        # kept out of the module tree, the online model isn't part of the EMA state
+        self._online = [model]
+        params = list(model.parameters())
+        self._num_params = len(params)
+        self._owned = self._owned_by(self.rank)
+
+        self.register_buffer("initted", torch.tensor(False))
+        self.register_buffer("step", torch.tensor(0))
+        if self.rank == 0:
+            self.ema_model = copy.deepcopy(model)
+            self.ema_model.requires_grad_(False)
+            if mode == "cpu":
+                self.ema_model.to("cpu")
+            ema_params = list(self.ema_model.parameters())
+            self._shard = [ema_params[i] for i in self._owned]
+        else:
+            # the other ranks only keep their share
+            self.ema_model = None
+            self._shard = [params[i].detach().clone() for i in self._owned]
+
+        # host side mirrors of the buffers, so an update never reads the device
+        self._step = 0
+        self._initted = False
+        self._pinned = None
+        self._thread = None
+
+    @property
+    def online_params(self):
+        params = list(self._online[0].parameters())
+        return [params[i].detach() for i in self._owned]
+
+    def decay_at(self, step):
+        epoch = step - self.update_after_step - 1
+        if epoch <= 0:
+            return 0.0
+        value = 1 - (1 + epoch / self.inv_gamma) ** -self.power
+        return min(max(value, self.min_value), self.beta)
+
+    def wait(self):
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    @torch.no_grad()
+    def copy_params_from_model_to_ema(self):
+        self.wait()
+        for ema, online in zip(self._shard, self.online_params):
+            ema.copy_(online)
+        self._copy_buffers()
+
+    def _copy_buffers(self):
+        if self.ema_model is None:
+            return
+        for ema, online in zip(self.ema_model.buffers(), self._online[0].buffers()):
+            ema.copy_(online)
+
+    @torch.no_grad()
+    def update(self):
+        # step by step the same as ema_pytorch.EMA.update
+        step = self._step
+        self._step += 1
+        if not self._initted:
+            self.copy_params_from_model_to_ema()
+            self._initted = True
+            return
+        if step % self.update_every != 0:
+            return
+        if step <= self.update_after_step:
+            self.copy_params_from_model_to_ema()
+            return
+        self._lerp(1.0 - self.decay_at(self._step))
+
+    def _lerp(self, weight):
+        if self.mode != "cpu":
+            online = [p.to(ema.dtype) for ema, p in zip(self._shard, self.online_params)]
+            torch._foreach_lerp_(self._shard, online, weight)
+            self._copy_buffers()
+            return
+
+        # the pinned copies are reused, the previous average has to be done with them
+        self.wait()
+        online = self.online_params
+        if self._pinned is None:
+            self._pinned = [
+                torch.empty(ema.shape, dtype=ema.dtype, pin_memory=torch.cuda.is_available()) for ema in self._shard
+            ]
+        for buffer, p in zip(self._pinned, online):
+            buffer.copy_(p, non_blocking=True)
+        event = None
+        if torch.cuda.is_available() and online and online[0].is_cuda:
+            event = torch.cuda.Event()
+            event.record()
+        self._copy_buffers()
+
+        def average():
+            if event is not None:
+                event.synchronize()
+            torch._foreach_lerp_(self._shard, self._pinned, weight)
+
+        self._thread = threading.Thread(target=average, name="ema-update", daemon=True)
+        self._thread.start()
+
+    def _owned_by(self, rank):
+        return [i for i in range(self._num_params) if i % self.world_size == rank]
+
+    @torch.no_grad()
+    def gather(self, dst=0):
+        """Collective, sharded mode: every rank sends its share of the EMA to rank 0"""
+        if self.mode != "sharded" or self.world_size == 1:
+            return
+        import torch.distributed as dist
+
+        ema_params = list(self.ema_model.parameters()) if self.ema_model is not None else None
+        for rank in range(1, self.world_size):
+            owned = self._owned_by(rank)
+            if self.rank == rank:
+                dist.send(torch.cat([p.reshape(-1) for p in self._shard]), dst)
+            elif self.rank == dst:
+                flat = torch.empty(
+                    sum(ema_params[i].numel() for i in owned), dtype=ema_params[0].dtype, device=ema_params[0].device
+                )
+                dist.recv(flat, rank)
+                for i, chunk in zip(owned, flat.split([ema_params[i].numel() for i in owned])):
+                    ema_params[i].copy_(chunk.view_as(ema_params[i]))
+
+    @torch.no_grad()
+    def scatter(self, src=0):
+        """Collective, sharded mode: rank 0 hands every rank its share of a loaded EMA"""
+        if self.mode != "sharded" or self.world_size == 1:
+            return
+        import torch.distributed as dist
+
+        state = torch.tensor([self._step, int(self._initted)], device=self._shard[0].device)
+        dist.broadcast(state, src)
+        self._step, self._initted = int(state[0]), bool(state[1])
+        ema_params = list(self.ema_model.parameters()) if self.ema_model is not None else None
+        for rank in range(1, self.world_size):
+            owned = self._owned_by(rank)
+            if self.rank == src:
+                dist.send(torch.cat([ema_params[i].reshape(-1) for i in owned]), rank)
+            elif self.rank == rank:
+                flat = torch.empty(sum(p.numel() for p in self._shard), dtype=self._shard[0].dtype, device=self._shard[0].device)
+                dist.recv(flat, src)
+                for p, chunk in zip(self._shard, flat.split([p.numel() for p in self._shard])):
+                    p.copy_(chunk.view_as(p))
+
+    def state_dict(self, *args, **kwargs):
+        self.wait()
+        self.step.fill_(self._step)
+        self.initted.fill_(self._initted)
+        return super().state_dict(*args, **kwargs)
+
+    def load_state_dict(self, state_dict, strict=True, **kwargs):
+        self.wait()
+        result = super().load_state_dict(state_dict, strict=strict, **kwargs)
+        self._step = int(self.step)
+        self._initted = bool(self.initted)
+        return result
@@ -28,6 +28,8 @@ import torchaudio
 
 from x_transformers.x_transformers import apply_rotary_pos_emb
 
+from model.attention import attention
+
 
 
 class FiLMLayer(nn.Module):
@@ -603,6 +605,142 @@ class MMDiTBlock(nn.Module):
         return c, x
 
 
+# Inference-only replacement for transformers' LlamaDecoderLayer
+# same math and weights, but with fused qkv / gate-up projections and a direct sdpa call
+
+
+class LlamaRMSNorm(nn.Module):
+    def __init__(self, dim, eps=1e-6):
+        super().__init__()
+        self.weight = nn.Parameter(torch.ones(dim))
+        self.eps = eps
+
+    def forward(self, x):
+        input_dtype = x.dtype
+        x = x.to(torch.float32)
+        variance = x.pow(2).mean(-1, keepdim=True)
+        x = x * torch.rsqrt(variance + self.eps)
+        return self.weight * x.to(input_dtype)
+
+
+def rotate_half(x):
+    x1, x2 = x.chunk(2, dim=-1)
+    return torch.cat((-x2, x1), dim=-1)
+
+
+def apply_llama_rotary_pos_emb(q, k, cos, sin):
+    # q, k: b h n d; cos, sin: b n d
+    cos = cos.unsqueeze(1)
+    sin = sin.unsqueeze(1)
+    return q * cos + rotate_half(q) * sin, k * cos + rotate_half(k) * sin
+
+
+class LlamaInferenceBlock(nn.Module):
+    """
+    Weight compatible drop-in for LlamaDecoderLayer, called as block(x, position_embeddings=(cos, sin)).
+    Checkpoints in HF layout (self_attn.q_proj / k_proj / v_proj, mlp.gate_proj / up_proj) are remapped
+    onto the fused projections on load, and state_dict() emits the HF layout again.
+    """
+
+    def __init__(self, config, layer_idx=None):
+        super().__init__()
+        self.layer_idx = layer_idx
+        self.hidden_size = config.hidden_size
+        self.num_heads = config.num_attention_heads
+        self.num_kv_heads = getattr(config, "num_key_value_heads", None) or self.num_heads
+        self.head_dim = getattr(config, "head_dim", None) or self.hidden_size // self.num_heads
+        self.intermediate_size = config.intermediate_size
+        attention_bias = getattr(config, "attention_bias", False)
+        mlp_bias = getattr(config, "mlp_bias", False)
+
+        # HF's sdpa attention runs causal when no attention mask is given, which is how DiT calls it
+        self.is_causal = True
+        self.attn_backend = getattr(config, "attn_backend", "sdpa")
+        self.attn_chunk_size = getattr(config, "attn_chunk_size", 1024)
+
+        self.input_layernorm = LlamaRMSNorm(self.hidden_size, eps=config.rms_norm_eps)
+        self.qkv_proj = nn.Linear(
+            self.hidden_size, (self.num_heads + 2 * self.num_kv_heads) * self.head_dim, bias=attention_bias
+        )
+        self.o_proj = nn.Linear(self.num_heads * self.head_dim, self.hidden_size, bias=attention_bias)
+
+        self.post_attention_layernorm = LlamaRMSNorm(self.hidden_size, eps=config.rms_norm_eps)
+        self.gate_up_proj = nn.Linear(self.hidden_size, 2 * self.intermediate_size, bias=mlp_bias)
+        self.down_proj = nn.Linear(self.intermediate_size, self.hidden_size, bias=mlp_bias)
+
+        self._register_state_dict_hook(LlamaInferenceBlock._to_hf_state_dict)
+
+    # (fused name, [hf names]) pairs, order matters for the concatenation
+    FUSED_KEYS = (
+        ("qkv_proj", ["self_attn.q_proj", "self_attn.k_proj", "self_attn.v_proj"]),
+        ("o_proj", ["self_attn.o_proj"]),
+        ("gate_up_proj", ["mlp.gate_proj", "mlp.up_proj"]),
+        ("down_proj", ["mlp.down_proj"]),
+    )
+
+    def _load_from_state_dict(self, state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys, error_msgs):
+        for fused, hf_names in self.FUSED_KEYS:
+            for suffix in ("weight", "bias"):
+                hf_keys = [f"{prefix}{name}.{suffix}" for name in hf_names]
+                present = [k for k in hf_keys if k in state_dict]
+                if len(present) == len(hf_keys):
+                    state_dict[f"{prefix}{fused}.{suffix}"] = torch.cat([state_dict.pop(k) for k in hf_keys], dim=0)
+                elif present:
+                    # a half remapped projection would load as random weights, even with strict=False
+                    error_msgs.append(
+                        f"{prefix}{fused}.{suffix}: checkpoint has {present} but not {sorted(set(hf_keys) - set(present))}"
+                    )
+        super()._load_from_state_dict(state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys, error_msgs)
+
+    @staticmethod
+    def _to_hf_state_dict(module, state_dict, prefix, local_metadata):
+        q_size = module.num_heads * module.head_dim
+        kv_size = module.num_kv_heads * module.head_dim
+        split_sizes = {
+            "qkv_proj": [q_size, kv_size, kv_size],
+            "o_proj": None,
+            "gate_up_proj": [module.intermediate_size, module.intermediate_size],
+            "down_proj": None,
+        }
+        for fused, hf_names in module.FUSED_KEYS:
+            for suffix in ("weight", "bias"):
+                key = f"{prefix}{fused}.{suffix}"
+                # quantized projections keep their own layout
+                if key not in state_dict or not state_dict[key].is_floating_point():
+                    continue
+                value = state_dict.pop(key)
+                parts = [value] if split_sizes[fused] is None else value.split(split_sizes[fused], dim=0)
+                for name, part in zip(hf_names, parts):
+                    state_dict[f"{prefix}{name}.{suffix}"] = part
+        return state_dict
+
+    def forward(self, hidden_states, position_embeddings=None, **kwargs):
+        batch, seq_len, _ = hidden_states.shape
+
+        # attention
+        x = self.input_layernorm(hidden_states)
+        qkv = self.qkv_proj(x).view(batch, seq_len, -1, self.head_dim).transpose(1, 2)
+        q, k, v = qkv.split([self.num_heads, self.num_kv_heads, self.num_kv_heads], dim=1)
+        if position_embeddings is not None:
+            cos, sin = position_embeddings
+            q, k = apply_llama_rotary_pos_emb(q, k, cos, sin)
+        if self.num_kv_heads != self.num_heads:
+            k = k.repeat_interleave(self.num_heads // self.num_kv_heads, dim=1)
+            v = v.repeat_interleave(self.num_heads // self.num_kv_heads, dim=1)
+        x = attention(
+            q, k, v, backend=self.attn_backend, is_causal=self.is_causal and seq_len > 1, chunk_size=self.attn_chunk_size
+        )
+        x = x.transpose(1, 2).reshape(batch, seq_len, -1)
+        hidden_states = self.o_proj(x).add_(hidden_states)
+
+        # mlp
+        x = self.post_attention_layernorm(hidden_states)
+        gate, up = self.gate_up_proj(x).chunk(2, dim=-1)
+        hidden_states = self.down_proj(F.silu(gate) * up).add_(hidden_states)
+
+        return (hidden_states,)
+
+
 # time step conditioning embedding
 
 
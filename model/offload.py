@@ -0,0 +1,183 @@
+"""
+Low-VRAM offloading for the inference pipeline.
+
+The CFM, MuQ-MuLan and the VAE are used strictly one after another (style embedding, sampling, decoding),
+so only the active stage needs its weights on the accelerator. Every offloaded tensor keeps a pinned host copy,
+moving a stage on and off the device just swaps `.data` between the host copy and a device copy,
+nothing is copied back since inference never changes the weights.
+
+modes:
+none  - every stage stays on the device
+stage - only the active stage is on the device, the next one is prefetched on a side stream
+layer - like stage, and the DiT transformer blocks are streamed in one at a time during sampling
+"""
+
+from __future__ import annotations
+
+from contextlib import contextmanager
+
+import torch
+
+
+OFFLOAD_MODES = ["none", "stage", "layer"]
+
+
+class ModuleOffloader:
+    def __init__(self, module, device, exclude=()):
+        self.device = torch.device(device)
+        self.use_streams = self.device.type == "cuda"
+
+        exclude = {id(t) for t in exclude}
+        seen = set()
+        self.tensors = []
+        for t in list(module.parameters()) + list(module.buffers()):
+            if id(t) in seen or id(t) in exclude:
+                continue
+            seen.add(id(t))
+            self.tensors.append(t)
+
+        self.host_tensors = []
+        for t in self.tensors:
+            host = t.data.to("cpu")
+            if self.use_streams:
+                host = host.pin_memory()
+            t.data = host
+            self.host_tensors.append(host)
+
+        self.on_device = False
+        self.ready_event = None
+
+    def load(self, stream=None):
+        if self.on_device:
+            return
+        if stream is not None and self.use_streams:
+            with torch.cuda.stream(stream):
+                for t, host in zip(self.tensors, self.host_tensors):
+                    t.data = host.to(self.device, non_blocking=True)
+                self.ready_event = torch.cuda.Event()
+                self.ready_event.record(stream)
+        else:
+            for t, host in zip(self.tensors, self.host_tensors):
+                t.data = host.to(self.device, non_blocking=self.use_streams)
+        self.on_device = True
+
+    def wait(self):
+        # make the compute stream wait for a prefetch, and tell the allocator the copies are used there
+        if self.ready_event is None:
+            return
+        current = torch.cuda.current_stream(self.device)
+        current.wait_event(self.ready_event)
+        for t in self.tensors:
+            t.data.record_stream(current)
+        self.ready_event = None
+
+    def offload(self):
+        if not self.on_device:
+            return
+        for t, host in zip(self.tensors, self.host_tensors):
+            t.data = host
+        self.on_device = False
+        self.ready_event = None
+
+
+class LayerStreamer:
+    """
+    Keeps the given blocks on the host and loads each one right before it runs, prefetching the next block
+    (wrapping around to the first one for the next sampling step) and dropping it again right after.
+    """
+
+    def __init__(self, blocks, device, stream=None):
+        self.offloaders = [ModuleOffloader(block, device) for block in blocks]
+        self.stream = stream
+        self.active = False
+        self.handles = []
+        for i, block in enumerate(blocks):
+            self.handles.append(block.register_forward_pre_hook(self._pre_hook(i)))
+            self.handles.append(block.register_forward_hook(self._post_hook(i)))
+
+    def _pre_hook(self, i):
+        def hook(module, args):
+            if not self.active:
+                return
+            current = self.offloaders[i]
+            current.load()
+            current.wait()
+            self.offloaders[(i + 1) % len(self.offloaders)].load(self.stream)
+        return hook
+
+    def _post_hook(self, i):
+        def hook(module, args, output):
+            if self.active and len(self.offloaders) > 1:
+                self.offloaders[i].offload()
+        return hook
+
+    def start(self):
+        self.active = True
+
+    def stop(self):
+        self.active = False
+        for offloader in self.offloaders:
+            offloader.offload()
+
+    def tensors(self):
+        return [t for offloader in self.offloaders for t in offloader.tensors]
+
+
+class OffloadScheduler:
+    def __init__(self, device, mode="stage"):
+        if mode not in OFFLOAD_MODES:
+            raise ValueError(f"Unknown offload mode {mode}, expected one of {OFFLOAD_MODES}")
+        self.device = torch.device(device)
+        # nothing to offload to on a CPU-only run
+        self.mode = mode if self.device.type != "cpu" else "none"
+        self.stream = torch.cuda.Stream(self.device) if self.device.type == "cuda" and self.mode != "none" else None
+        self.stages = {}
+        self.streamers = {}
+
+    def register(self, name, module, layers=None):
+        """
+        Registers a pipeline stage. With mode "layer", `layers` (e.g. the DiT transformer blocks)
+        are streamed block by block instead of being loaded with the rest of the stage.
+        """
+        if self.mode == "none":
+            module.to(self.device)
+            return
+        exclude = ()
+        if self.mode == "layer" and layers is not None:
+            streamer = LayerStreamer(layers, self.device, stream=self.stream)
+            self.streamers[name] = streamer
+            exclude = streamer.tensors()
+        self.stages[name] = ModuleOffloader(module, self.device, exclude=exclude)
+
+    def ensure(self, name):
+        # bring a stage onto the device next to the active one, e.g. the VAE for previews during sampling
+        if self.mode == "none":
+            return
+        self.stages[name].load()
+        self.stages[name].wait()
+
+    @contextmanager
+    def stage(self, name, prefetch=None):
+        if self.mode == "none":
+            yield
+            return
+
+        for other, offloader in self.stages.items():
+            if other != name:
+                offloader.offload()
+
+        offloader = self.stages[name]
+        offloader.load()
+        offloader.wait()
+        streamer = self.streamers.get(name)
+        if streamer is not None:
+            streamer.start()
+
+        if prefetch is not None:
+            self.stages[prefetch].load(self.stream)
+
+        try:
+            yield
+        finally:
+            if streamer is not None:
+                streamer.stop()
@@ -0,0 +1,292 @@
+"""
+Quantized inference for the DiT, mainly for CPU-only nodes.
+
+modes:
+int8_dynamic     - torch dynamic quantization, int8 weights and per-batch int8 activations (CPU only)
+int8_weight_only - int8 weights with per-channel scales, multiplied by torch's int8 weight kernel on CPU
+                   and dequantized on the fly elsewhere
+int4_weight_only - int4 weights packed two per byte with group-wise scales, dequantized on the fly
+
+Dequantizing on the fly builds a full precision copy of each weight for every call, so it only cuts
+the resident size of the model: it is slower than the unquantized DiT and the peak memory of a layer
+is unchanged. int8_dynamic is the mode that also runs faster on CPU.
+
+Only the Llama block projections and the text fusion linears are quantized,
+embeddings, norms and the output projection stay in full precision.
+"""
+
+from __future__ import annotations
+
+import os
+
+import torch
+from torch import nn
+import torch.nn.functional as F
+
+
+QUANT_MODES = ["none", "int8_dynamic", "int8_weight_only", "int4_weight_only"]
+
+# int8 weight x float activation matmul with the per-channel scale fused, no dequantized weight copy
+_HAS_INT8PACK_MM = hasattr(torch, "_weight_int8pack_mm")
+
+
+class WeightOnlyInt8Linear(nn.Module):
+    def __init__(self, in_features, out_features, bias=True):
+        super().__init__()
+        self.in_features = in_features
+        self.out_features = out_features
+        self.register_buffer("weight", torch.zeros(out_features, in_features, dtype=torch.int8))
+        self.register_buffer("scale", torch.ones(out_features))
+        self.register_buffer("bias", torch.zeros(out_features) if bias else None)
+
+    @classmethod
+    def from_linear(cls, linear: nn.Linear):
+        module = cls(linear.in_features, linear.out_features, bias=linear.bias is not None)
+        w = linear.weight.detach().float()
+        scale = w.abs().amax(dim=1).clamp(min=1e-8) / 127
+        module.weight.copy_(torch.round(w / scale[:, None]).clamp(-127, 127).to(torch.int8))
+        module.scale.copy_(scale)
+        if linear.bias is not None:
+            module.bias.copy_(linear.bias.detach().float())
+        return module.to(linear.weight.device)
+
+    def forward(self, x):
+        if _HAS_INT8PACK_MM and x.device.type == "cpu":
+            out = torch._weight_int8pack_mm(x.reshape(-1, self.in_features).contiguous(), self.weight, self.scale.to(x.dtype))
+            out = out.view(*x.shape[:-1], self.out_features)
+        else:
+            # per output channel scale commutes with the matmul
+            out = F.linear(x, self.weight.to(x.dtype)) * self.scale.to(x.dtype)
+        if self.bias is not None:
+            out = out + self.bias.to(x.dtype)
+        return out
+
+
+class WeightOnlyInt4Linear(nn.Module):
+    def __init__(self, in_features, out_features, bias=True, group_size=128):
+        super().__init__()
+        assert in_features % group_size == 0 and group_size % 2 == 0
+        self.in_features = in_features
+        self.out_features = out_features
+        self.group_size = group_size
+        self.register_buffer("weight", torch.zeros(out_features, in_features // 2, dtype=torch.uint8))
+        self.register_buffer("scale", torch.ones(out_features, in_features // group_size))
+        self.register_buffer("bias", torch.zeros(out_features) if bias else None)
+
+    @classmethod
+    def from_linear(cls, linear: nn.Linear, group_size=128):
+        module = cls(linear.in_features, linear.out_features, bias=linear.bias is not None, group_size=group_size)
+        w = linear.weight.detach().float().view(linear.out_features, -1, group_size)
+        scale = w.abs().amax(dim=-1).clamp(min=1e-8) / 7
+        q = torch.round(w / scale[..., None]).clamp(-8, 7).to(torch.int8).view(linear.out_features, -1)
+        nibbles = (q & 0xF).to(torch.uint8)  # two's complement low 4 bits
+        module.weight.copy_(nibbles[:, 0::2] | (nibbles[:, 1::2] << 4))
+        module.scale.copy_(scale)
+        if linear.bias is not None:
+            module.bias.copy_(linear.bias.detach().float())
+        return module.to(linear.weight.device)
+
+    def dequantize(self, dtype):
+        low = (self.weight & 0xF).to(torch.int8)
+        high = (self.weight >> 4).to(torch.int8)
+        q = torch.stack((low, high), dim=-1).view(self.out_features, -1)
+        q = torch.where(q > 7, q - 16, q)  # sign extend the nibbles
+        w = q.view(self.out_features, -1, self.group_size).to(dtype) * self.scale.to(dtype)[..., None]
+        return w.view(self.out_features, self.in_features)
+
+    def forward(self, x):
+        out = F.linear(x, self.dequantize(x.dtype))
+        if self.bias is not None:
+            out = out + self.bias.to(x.dtype)
+        return out
+
+
+def _dynamic_int8_linear(linear: nn.Linear):
+    from torch.ao.nn.quantized.dynamic import Linear as DynamicQuantizedLinear
+    from torch.ao.quantization import default_dynamic_qconfig
+
+    linear = linear.float()
+    linear.qconfig = default_dynamic_qconfig
+    return DynamicQuantizedLinear.from_float(linear)
+
+
+def _empty_quantized_linear(linear: nn.Linear, mode):
+    bias = linear.bias is not None
+    if mode == "int8_dynamic":
+        from torch.ao.nn.quantized.dynamic import Linear as DynamicQuantizedLinear
+
+        return DynamicQuantizedLinear(linear.in_features, linear.out_features, bias_=bias, dtype=torch.qint8)
+    elif mode == "int8_weight_only":
+        return WeightOnlyInt8Linear(linear.in_features, linear.out_features, bias=bias)
+    elif mode == "int4_weight_only":
+        return WeightOnlyInt4Linear(linear.in_features, linear.out_features, bias=bias)
+
+
+def _quantize_linear(linear: nn.Linear, mode):
+    if mode == "int8_dynamic":
+        return _dynamic_int8_linear(linear)
+    elif mode == "int8_weight_only":
+        return WeightOnlyInt8Linear.from_linear(linear)
+    elif mode == "int4_weight_only":
+        return WeightOnlyInt4Linear.from_linear(linear)
+
+
+def quantization_targets(dit):
+    # (qualified name, parent module, attribute name) of every linear to quantize
+    targets = []
+    for root_name in ("transformer_blocks", "text_fusion_linears"):
+        root = getattr(dit, root_name)
+        for parent_name, parent in root.named_modules():
+            for child_name, child in parent.named_children():
+                if isinstance(child, nn.Linear):
+                    name = ".".join(filter(None, [root_name, parent_name, child_name]))
+                    targets.append((name, parent, child_name))
+    return targets
+
+
+def _plain_state(module, mode):
+    # plain tensors only, so the cache is a safetensors file: the dynamic linear's packed params are
+    # stored as the int8 weight and its per-tensor scale and zero point
+    if mode != "int8_dynamic":
+        return module.state_dict()
+    weight, bias = module._weight_bias()
+    state = {
+        "weight": weight.int_repr(),
+        "scale": torch.tensor(weight.q_scale(), dtype=torch.float64),
+        "zero_point": torch.tensor(weight.q_zero_point()),
+    }
+    if bias is not None:
+        state["bias"] = bias
+    return state
+
+
+def _load_plain_state(module, state, mode):
+    if mode != "int8_dynamic":
+        module.load_state_dict(state)
+        return
+    weight = torch._make_per_tensor_quantized_tensor(state["weight"], state["scale"].item(), int(state["zero_point"]))
+    module.set_weight_bias(weight, state.get("bias"))
+
+
+def _source_stamp(source_path):
+    # a replaced checkpoint changes size or mtime, either invalidates the cache
+    if source_path is None:
+        return ""
+    stat = os.stat(source_path)
+    return f"{stat.st_size}:{stat.st_mtime_ns}"
+
+
+def _read_cache(cache_path, mode, stamp, names):
+    from safetensors import safe_open
+
+    try:
+        with safe_open(cache_path, framework="pt") as f:
+            metadata = f.metadata() or {}
+            if metadata.get("mode") != mode or metadata.get("source") != stamp:
+                return None
+            tensors = {key: f.get_tensor(key) for key in f.keys()}
+    except Exception as e:
+        print(f"Unreadable quantization cache {cache_path}: {e}")
+        return None
+
+    states = {name: {} for name in names}
+    for key, tensor in tensors.items():
+        name, _, param = key.rpartition(".")
+        if name not in states:
+            return None
+        states[name][param] = tensor
+    if not all(states.values()):
+        return None
+    return states
+
+
+@torch.no_grad()
+def quantize_dit(dit, mode, cache_path=None, source_path=None):
+    """
+    Swaps the DiT linears for quantized ones in place.
+    With cache_path, quantized weights are read from it when present and written to it otherwise,
+    as safetensors. source_path is the checkpoint the weights came from, the cache is only used
+    while that file has the size and mtime it had when the cache was written.
+    """
+    if mode not in QUANT_MODES:
+        raise ValueError(f"Unknown quantization mode {mode}, expected one of {QUANT_MODES}")
+    if mode == "none":
+        return dit
+
+    targets = quantization_targets(dit)
+    stamp = _source_stamp(source_path)
+
+    if cache_path is not None and os.path.exists(cache_path):
+        states = _read_cache(cache_path, mode, stamp, [name for name, _, _ in targets])
+        if states is not None:
+            for name, parent, child_name in targets:
+                linear = getattr(parent, child_name)
+                module = _empty_quantized_linear(linear, mode)
+                _load_plain_state(module, states[name], mode)
+                setattr(parent, child_name, module.to(linear.weight.device))
+            return dit
+        print(f"Ignoring stale quantization cache {cache_path}")
+
+    tensors = {}
+    for name, parent, child_name in targets:
+        module = _quantize_linear(getattr(parent, child_name), mode)
+        setattr(parent, child_name, module)
+        for param, tensor in _plain_state(module, mode).items():
+            tensors[f"{name}.{param}"] = tensor.detach().cpu().contiguous()
+
+    if cache_path is not None:
+        from safetensors.torch import save_file
+
+        tmp_path = f"{cache_path}.tmp"
+        save_file(tensors, tmp_path, metadata={"format": "pt", "mode": mode, "source": stamp})
+        os.replace(tmp_path, cache_path)
+
+    return dit
+
+
+def _random_dit_inputs(dit, frames, generator, dtype):
+    batch = 2
+    mel_dim = dit.proj_out.out_features
+    num_tokens = dit.text_embed.text_embed.num_embeddings
+    x = torch.randn(batch, frames, mel_dim, generator=generator).to(dtype)
+    text = torch.randint(0, num_tokens, (batch, frames), generator=generator)
+    style_prompt = torch.randn(batch, 512, generator=generator).to(dtype)
+    time = torch.rand(batch, generator=generator).to(dtype)
+    start_time = torch.zeros(batch, dtype=dtype)
+    return x, text, style_prompt, time, start_time
+
+
+@torch.no_grad()
+def check_quantized_accuracy(reference_dit, quantized_dit, seeds=(0, 1, 2), frames=256):
+    """
+    Runs both DiTs on the same random inputs for each seed and reports the deviation
+    of the quantized output from the reference (fp32) output.
+    """
+    device = next(reference_dit.parameters()).device
+    dtype = next(reference_dit.parameters()).dtype
+    results = []
+    for seed in seeds:
+        generator = torch.Generator().manual_seed(seed)
+        x, text, style_prompt, time, start_time = [
+            t.to(device) for t in _random_dit_inputs(reference_dit, frames, generator, dtype)
+        ]
+
+        outputs = []
+        for dit in (reference_dit, quantized_dit):
+            s_t, text_embed, text_residuals = dit.forward_timestep_invariant(text, frames, drop_text=False, start_time=start_time)
+            outputs.append(
+                dit(
+                    x=x, text_embed=text_embed, text_residuals=text_residuals, cond=torch.zeros_like(x), time=time,
+                    drop_audio_cond=True, style_prompt=style_prompt, start_time=s_t,
+                ).float()
+            )
+        ref, out = outputs
+        results.append({
+            "seed": seed,
+            "max_abs_err": (out - ref).abs().max().item(),
+            "rel_err": ((out - ref).norm() / ref.norm().clamp(min=1e-8)).item(),
+            "cosine": F.cosine_similarity(out.flatten(), ref.flatten(), dim=0).item(),
+        })
+    for r in results:
+        print(f"seed {r['seed']}: max abs err {r['max_abs_err']:.4e}, rel err {r['rel_err']:.4e}, cosine {r['cosine']:.6f}")
+    return results
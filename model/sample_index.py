@@ -0,0 +1,218 @@
+"""
+Offline index of the training items DiffusionDataset can actually crop.
+
+A crop of max_frames starting at frame s is usable when a lyric line starts inside it and the
+latent up to the last such line (where get_triple ends the crop) is at least min_frames long.
+For every item the index keeps its latent length, lyric span, a validity code and the ranges of
+usable start frames, so the dataset draws only valid items and valid crops and never has to
+load an item to find out it is unusable.
+
+    python -m model.sample_index dataset/shards --max-frames 2048 --min-frames 512
+    python -m model.sample_index dataset/train.scp --max-frames 2048 --min-frames 512
+
+The index lands next to the data (samples_<max>_<min>.npz in a shard directory, <scp>.samples_<max>_<min>.npz
+for a train.scp). For shards the dataset builds it on the fly when the file is missing, it only
+needs the shard index; a train.scp needs this pass since every item has to be loaded once.
+"""
+
+from __future__ import annotations
+
+import argparse
+import math
+import os
+
+import numpy as np
+
+VALID = 0
+NO_LYRICS = 1
+TOO_SHORT = 2
+NO_VALID_CROP = 3
+UNREADABLE = 4
+REASONS = {VALID: "valid", NO_LYRICS: "no lyrics", TOO_SHORT: "too short", NO_VALID_CROP: "no valid crop", UNREADABLE: "unreadable"}
+
+
+def index_path(file_path, max_frames, min_frames):
+    name = f"samples_{max_frames}_{min_frames}.npz"
+    if os.path.isdir(file_path):
+        return os.path.join(file_path, name)
+    return f"{file_path}.{name}"
+
+
+def valid_start_intervals(latent_len, line_times, max_frames, min_frames, frames_per_sec):
+    """Inclusive [lo, hi] ranges of crop start frames that get_triple accepts, merged and sorted"""
+    max_start = max(0, latent_len - max_frames)
+    intervals = []
+    for time in sorted(line_times):
+        frame = time * frames_per_sec
+        # the line starts inside the crop and ends it at least min_frames in, within the latent
+        lo = max(0, math.floor(frame - max_frames) + 1)
+        hi = min(math.floor(frame) - min_frames, latent_len - min_frames, max_start)
+        if lo > hi:
+            continue
+        if intervals and lo <= intervals[-1][1] + 1:
+            intervals[-1][1] = max(intervals[-1][1], hi)
+        else:
+            intervals.append([lo, hi])
+    return intervals
+
+
+def build_sample_index(items, max_frames, min_frames, frames_per_sec):
+    """items yields (latent_len, line_times) per item in dataset order, None for an unreadable item"""
+    fields = {k: [] for k in ("latent_len", "lyric_start", "lyric_end", "status", "interval_offset", "interval_count")}
+    intervals = []
+    for item in items:
+        if item is None:
+            latent_len, line_times = 0, []
+        else:
+            latent_len, line_times = item
+        line_times = [float(t) for t in line_times]
+        starts = valid_start_intervals(latent_len, line_times, max_frames, min_frames, frames_per_sec)
+        if item is None:
+            status = UNREADABLE
+        elif not line_times:
+            status = NO_LYRICS
+        elif latent_len < min_frames:
+            status = TOO_SHORT
+        elif not starts:
+            status = NO_VALID_CROP
+        else:
+            status = VALID
+
+        fields["latent_len"].append(latent_len)
+        fields["lyric_start"].append(min(line_times, default=0.0))
+        fields["lyric_end"].append(max(line_times, default=0.0))
+        fields["status"].append(status)
+        fields["interval_offset"].append(len(intervals))
+        fields["interval_count"].append(len(starts) if status == VALID else 0)
+        if status == VALID:
+            intervals.extend(starts)
+
+    return SampleIndex(
+        max_frames=max_frames,
+        min_frames=min_frames,
+        frames_per_sec=frames_per_sec,
+        latent_len=np.asarray(fields["latent_len"], dtype=np.int32),
+        lyric_start=np.asarray(fields["lyric_start"], dtype=np.float32),
+        lyric_end=np.asarray(fields["lyric_end"], dtype=np.float32),
+        status=np.asarray(fields["status"], dtype=np.int8),
+        interval_offset=np.asarray(fields["interval_offset"], dtype=np.int64),
+        interval_count=np.asarray(fields["interval_count"], dtype=np.int32),
+        intervals=np.asarray(intervals, dtype=np.int32).reshape(-1, 2),
+    )
+
+
+def scan_shards(reader):
+    for i in range(len(reader)):
+        yield reader.latent_len(i), reader.line_times(i)
+
+
+def scan_scp(file_lst):
+    import torch
+
+    for n, line in enumerate(file_lst):
+        try:
+            utt, lrc_path, latent_path, style_path = line.split("|")
+            times = torch.load(lrc_path, map_location="cpu")["time"]
+            latent_len = torch.load(latent_path, map_location="cpu").shape[-1]
+            yield latent_len, times
+        except Exception:
+            yield None
+        if (n + 1) % 1000 == 0:
+            print(f"{n + 1}/{len(file_lst)} items indexed")
+
+
+class SampleIndex:
+    def __init__(self, max_frames, min_frames, frames_per_sec, **arrays):
+        self.max_frames = int(max_frames)
+        self.min_frames = int(min_frames)
+        self.frames_per_sec = float(frames_per_sec)
+        self.latent_len = arrays["latent_len"]
+        self.lyric_start = arrays["lyric_start"]
+        self.lyric_end = arrays["lyric_end"]
+        self.status = arrays["status"]
+        self.interval_offset = arrays["interval_offset"]
+        self.interval_count = arrays["interval_count"]
+        self.intervals = arrays["intervals"]
+
+        sizes = self.intervals[:, 1].astype(np.int64) - self.intervals[:, 0] + 1
+        self._cum_sizes = np.concatenate([[0], np.cumsum(sizes)])
+
+    def __len__(self):
+        return len(self.status)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            arrays = {k: data[k] for k in data.files}
+        return cls(arrays.pop("max_frames"), arrays.pop("min_frames"), arrays.pop("frames_per_sec"), **arrays)
+
+    def save(self, path):
+        tmp_path = f"{path}.tmp.npz"
+        np.savez(
+            tmp_path,
+            max_frames=np.int32(self.max_frames), min_frames=np.int32(self.min_frames),
+            frames_per_sec=np.float64(self.frames_per_sec), latent_len=self.latent_len,
+            lyric_start=self.lyric_start, lyric_end=self.lyric_end, status=self.status,
+            interval_offset=self.interval_offset, interval_count=self.interval_count, intervals=self.intervals,
+        )
+        os.replace(tmp_path, path)
+
+    def valid_items(self):
+        return np.nonzero(self.status == VALID)[0]
+
+    def sample_start(self, i, rng):
+        """A uniformly drawn start frame among the item's usable crops, rng is a random.Random like"""
+        first = int(self.interval_offset[i])
+        last = first + int(self.interval_count[i])
+        if first == last:
+            raise ValueError(f"item {i} has no valid crop ({REASONS[int(self.status[i])]})")
+        base = self._cum_sizes[first]
+        k = base + rng.randrange(int(self._cum_sizes[last] - base))
+        j = int(np.searchsorted(self._cum_sizes, k, side="right")) - 1
+        return int(self.intervals[j, 0] + (k - self._cum_sizes[j]))
+
+    def stats(self):
+        total = len(self)
+        counts = {name: int((self.status == code).sum()) for code, name in REASONS.items()}
+        valid_frames = int(self.latent_len[self.status == VALID].sum())
+        return {
+            "items": total,
+            **counts,
+            "filtered_fraction": 1 - counts["valid"] / total if total else 0.0,
+            "valid_hours": valid_frames / self.frames_per_sec / 3600,
+        }
+
+    def report(self):
+        stats = self.stats()
+        reasons = ", ".join(f"{stats[name]} {name}" for name in REASONS.values() if name != "valid" and stats[name])
+        return (
+            f"{stats['valid']}/{stats['items']} items valid ({stats['filtered_fraction']:.1%} filtered"
+            f"{': ' + reasons if reasons else ''}), {stats['valid_hours']:.1f} h of latents"
+        )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Index the usable training items and crops of a train.scp or shard directory")
+    parser.add_argument("file_path", help="train.scp or shard directory")
+    parser.add_argument("--max-frames", type=int, default=2048)
+    parser.add_argument("--min-frames", type=int, default=512)
+    parser.add_argument("--sampling-rate", type=int, default=44100)
+    parser.add_argument("--downsample-rate", type=int, default=2048)
+    parser.add_argument("--out", default=None, help="default next to the data, where DiffusionDataset looks for it")
+    args = parser.parse_args(argv)
+
+    from model.shards import ShardReader
+
+    if ShardReader.is_shard_dir(args.file_path):
+        items = scan_shards(ShardReader(args.file_path))
+    else:
+        with open(args.file_path, "r") as f:
+            items = scan_scp([line.strip() for line in f.readlines()])
+    index = build_sample_index(items, args.max_frames, args.min_frames, args.sampling_rate / args.downsample_rate)
+    out = args.out or index_path(args.file_path, args.max_frames, args.min_frames)
+    index.save(out)
+    print(f"{index.report()}, index written to {out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,295 @@
+"""
+Packed, memory-mapped training shards.
+
+The per-item .pt files of a train.scp (lrc, latent, style) are packed into a few large files:
+
+shard_00000.latent   fp16 [rows, d], every song's latent time-major and contiguous,
+                     so a crop of frames [a, b) is one contiguous read
+shard_00000.style    fp16 [items, 512]
+shard_00000.tokens   int32, the lyric tokens of every line of every song, concatenated
+shard_00000.timeline int16 [rows, 2], every song's lyric tokens laid out on its latent frames
+                     (the training lrc at full length) and the song line each token belongs to,
+                     -1 for frames without a token
+index.npz            per item: utt, shard, latent_offset / latent_len (rows), style_row,
+                     line_start / line_count into the per line arrays line_time / line_token_offset /
+                     line_token_count (token offsets are into the item's shard tokens),
+                     timeline_offset / timeline_len (rows)
+
+Convert with
+    python -m model.shards dataset/train.scp dataset/shards --shard-size-gb 4
+and pass the shard directory as file_path of DiffusionDataset.
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import os
+
+import numpy as np
+import torch
+
+INDEX_FILE = "index.npz"
+FORMAT_VERSION = 2
+
+COMMA_TOKEN_ID = 1
+PERIOD_TOKEN_ID = 2
+
+
+def _shard_path(shard_dir, shard, kind):
+    return os.path.join(shard_dir, f"shard_{shard:05d}.{kind}")
+
+
+def build_timeline(lrc_with_time, frames_per_sec, length=0):
+    """
+    Lays a song's lyric lines out on its frames like DiffusionDataset.get_triple does for a crop:
+    periods inside a line become commas, every line ends with a period and starts at its timestamp
+    or right after the previous line. Returns int16 [max(length, end of the last line), 2] of
+    (token, line), line is -1 on frames without a token.
+    """
+    placed = []
+    last_end_pos = 0
+    for line, (time_start, tokens) in enumerate(lrc_with_time):
+        tokens = [token if token != PERIOD_TOKEN_ID else COMMA_TOKEN_ID for token in tokens] + [PERIOD_TOKEN_ID]
+        frame_start = max(int(time_start * frames_per_sec), last_end_pos)
+        placed.append((frame_start, line, tokens))
+        last_end_pos = frame_start + len(tokens)
+
+    timeline = np.zeros((max(length, last_end_pos), 2), dtype=np.int16)
+    timeline[:, 1] = -1
+    for frame_start, line, tokens in placed:
+        timeline[frame_start : frame_start + len(tokens), 0] = tokens
+        timeline[frame_start : frame_start + len(tokens), 1] = line
+    return timeline
+
+
+class ShardWriter:
+    def __init__(self, shard_dir, latent_dim=64, style_dim=512, shard_size_bytes=4 * 2**30, frames_per_sec=44100 / 2048):
+        os.makedirs(shard_dir, exist_ok=True)
+        self.shard_dir = shard_dir
+        self.latent_dim = latent_dim
+        self.style_dim = style_dim
+        self.shard_size_bytes = shard_size_bytes
+        self.frames_per_sec = frames_per_sec
+
+        self.index = {k: [] for k in (
+            "utt", "shard", "latent_offset", "latent_len", "style_row", "line_start", "line_count",
+            "timeline_offset", "timeline_len",
+        )}
+        self.lines = {k: [] for k in ("line_time", "line_token_offset", "line_token_count")}
+        self.shard = -1
+        self._next_shard()
+
+    def _next_shard(self):
+        if self.shard >= 0:
+            self._close_shard()
+        self.shard += 1
+        self.files = {
+            kind: open(_shard_path(self.shard_dir, self.shard, kind), "wb") for kind in ("latent", "style", "tokens", "timeline")
+        }
+        self.rows = 0
+        self.styles = 0
+        self.tokens = 0
+        self.timeline_rows = 0
+
+    def _close_shard(self):
+        for f in self.files.values():
+            f.close()
+
+    def add(self, utt, latent, style, lrc_with_time):
+        """latent [d, t], style [style_dim], lrc_with_time [(seconds, tokens)] as in the .pt files."""
+        latent = np.ascontiguousarray(latent.to(torch.float16).numpy().T)  # [t, d]
+        assert latent.shape[1] == self.latent_dim, f"{utt}: latent dim {latent.shape[1]} != {self.latent_dim}"
+        if self.rows > 0 and (self.rows + latent.shape[0]) * self.latent_dim * 2 > self.shard_size_bytes:
+            self._next_shard()
+
+        self.index["utt"].append(utt)
+        self.index["shard"].append(self.shard)
+        self.index["latent_offset"].append(self.rows)
+        self.index["latent_len"].append(latent.shape[0])
+        self.index["style_row"].append(self.styles)
+        self.index["line_start"].append(len(self.lines["line_time"]))
+        self.index["line_count"].append(len(lrc_with_time))
+
+        self.files["latent"].write(latent.tobytes())
+        self.rows += latent.shape[0]
+
+        style = style.to(torch.float16).reshape(-1).numpy()
+        assert style.shape[0] == self.style_dim, f"{utt}: style dim {style.shape[0]} != {self.style_dim}"
+        self.files["style"].write(style.tobytes())
+        self.styles += 1
+
+        for time, tokens in lrc_with_time:
+            tokens = np.asarray(tokens, dtype=np.int32).reshape(-1)
+            self.lines["line_time"].append(time)
+            self.lines["line_token_offset"].append(self.tokens)
+            self.lines["line_token_count"].append(tokens.shape[0])
+            self.files["tokens"].write(tokens.tobytes())
+            self.tokens += tokens.shape[0]
+
+        timeline = build_timeline(lrc_with_time, self.frames_per_sec, length=latent.shape[0])
+        self.index["timeline_offset"].append(self.timeline_rows)
+        self.index["timeline_len"].append(timeline.shape[0])
+        self.files["timeline"].write(timeline.tobytes())
+        self.timeline_rows += timeline.shape[0]
+
+    def close(self):
+        self._close_shard()
+        np.savez(
+            os.path.join(self.shard_dir, INDEX_FILE),
+            version=np.int32(FORMAT_VERSION),
+            latent_dim=np.int32(self.latent_dim),
+            style_dim=np.int32(self.style_dim),
+            num_shards=np.int32(self.shard + 1),
+            frames_per_sec=np.float64(self.frames_per_sec),
+            utt=np.asarray(self.index["utt"], dtype=str),
+            shard=np.asarray(self.index["shard"], dtype=np.int32),
+            latent_offset=np.asarray(self.index["latent_offset"], dtype=np.int64),
+            latent_len=np.asarray(self.index["latent_len"], dtype=np.int32),
+            style_row=np.asarray(self.index["style_row"], dtype=np.int64),
+            line_start=np.asarray(self.index["line_start"], dtype=np.int64),
+            line_count=np.asarray(self.index["line_count"], dtype=np.int32),
+            line_time=np.asarray(self.lines["line_time"], dtype=np.float32),
+            line_token_offset=np.asarray(self.lines["line_token_offset"], dtype=np.int64),
+            line_token_count=np.asarray(self.lines["line_token_count"], dtype=np.int32),
+            timeline_offset=np.asarray(self.index["timeline_offset"], dtype=np.int64),
+            timeline_len=np.asarray(self.index["timeline_len"], dtype=np.int32),
+        )
+
+
+class ShardReader:
+    """
+    Random access to packed shards. The shard files are memory-mapped lazily in every process,
+    so a reader created before the DataLoader workers fork is safe to use in them.
+    """
+
+    def __init__(self, shard_dir):
+        self.shard_dir = shard_dir
+        with np.load(os.path.join(shard_dir, INDEX_FILE)) as index:
+            self.index = {k: index[k] for k in index.files}
+        self.latent_dim = int(self.index["latent_dim"])
+        self.style_dim = int(self.index["style_dim"])
+        # shards packed before the lyric timeline was added still load, the dataset builds lrc per crop for them
+        self.has_timeline = "timeline_offset" in self.index
+        self._maps = {}
+        self._pid = None
+
+    @staticmethod
+    def is_shard_dir(path):
+        return os.path.isdir(path) and os.path.exists(os.path.join(path, INDEX_FILE))
+
+    def __len__(self):
+        return len(self.index["utt"])
+
+    def _map(self, shard, kind):
+        if self._pid != os.getpid():
+            self._maps = {}
+            self._pid = os.getpid()
+        key = (shard, kind)
+        if key not in self._maps:
+            path = _shard_path(self.shard_dir, shard, kind)
+            if kind == "latent":
+                data = np.memmap(path, dtype=np.float16, mode="r").reshape(-1, self.latent_dim)
+            elif kind == "style":
+                data = np.memmap(path, dtype=np.float16, mode="r").reshape(-1, self.style_dim)
+            elif kind == "timeline":
+                data = np.memmap(path, dtype=np.int16, mode="r").reshape(-1, 2)
+            else:
+                data = np.memmap(path, dtype=np.int32, mode="r")
+            self._maps[key] = data
+        return self._maps[key]
+
+    def utt(self, i):
+        return str(self.index["utt"][i])
+
+    def latent_len(self, i):
+        return int(self.index["latent_len"][i])
+
+    def latent(self, i, start=0, end=None):
+        """Frames [start, end) of the item's latent as a [d, t] tensor, only that slice is read."""
+        length = self.latent_len(i)
+        end = length if end is None else min(end, length)
+        offset = int(self.index["latent_offset"][i])
+        rows = self._map(int(self.index["shard"][i]), "latent")[offset + start : offset + end]
+        return torch.from_numpy(np.array(rows)).T
+
+    def style(self, i):
+        row = self._map(int(self.index["shard"][i]), "style")[int(self.index["style_row"][i])]
+        return torch.from_numpy(np.array(row))
+
+    def line_times(self, i):
+        start = int(self.index["line_start"][i])
+        return self.index["line_time"][start : start + int(self.index["line_count"][i])]
+
+    def timeline(self, i, start=0, end=None):
+        """Frames [start, end) of the item's lyric timeline as int16 numpy [t, 2] of (token, line)"""
+        length = int(self.index["timeline_len"][i])
+        end = length if end is None else min(end, length)
+        offset = int(self.index["timeline_offset"][i])
+        return np.array(self._map(int(self.index["shard"][i]), "timeline")[offset + start : offset + max(start, end)])
+
+    def lrc(self, i):
+        """[(seconds, tokens)] with tokens a list of ints, like the lrc .pt files."""
+        tokens = self._map(int(self.index["shard"][i]), "tokens")
+        start = int(self.index["line_start"][i])
+        lines = []
+        for line in range(start, start + int(self.index["line_count"][i])):
+            offset = int(self.index["line_token_offset"][line])
+            count = int(self.index["line_token_count"][line])
+            lines.append((float(self.index["line_time"][line]), tokens[offset : offset + count].tolist()))
+        return lines
+
+
+def read_scp_item(line):
+    """Loads one train.scp item: (utt, latent [d, t], style [512], [(seconds, tokens)])."""
+    utt, lrc_path, latent_path, style_path = line.strip().split("|")
+    time_lrc = torch.load(lrc_path, map_location="cpu")
+    lrc_with_time = [(float(t), torch.as_tensor(tokens).tolist()) for t, tokens in zip(time_lrc["time"], time_lrc["lrc"])]
+    latent = torch.load(latent_path, map_location="cpu").squeeze(0)
+    style = torch.load(style_path, map_location="cpu").squeeze(0)
+    return utt, latent, style, lrc_with_time
+
+
+def convert_scp(scp_path, shard_dir, shard_size_gb=4.0, sampling_rate=44100, downsample_rate=2048):
+    with open(scp_path, "r") as f:
+        lines = [line for line in f if line.strip()]
+
+    writer = None
+    failed = []
+    for n, line in enumerate(lines):
+        try:
+            utt, latent, style, lrc_with_time = read_scp_item(line)
+        except Exception as e:
+            failed.append({"line": line.strip(), "error": repr(e)})
+            continue
+        if writer is None:
+            writer = ShardWriter(
+                shard_dir, latent_dim=latent.shape[0], style_dim=style.reshape(-1).shape[0],
+                shard_size_bytes=int(shard_size_gb * 2**30), frames_per_sec=sampling_rate / downsample_rate,
+            )
+        writer.add(utt, latent, style, lrc_with_time)
+        if (n + 1) % 1000 == 0:
+            print(f"{n + 1}/{len(lines)} items packed")
+    if writer is None:
+        raise ValueError(f"No readable items in {scp_path}")
+    writer.close()
+
+    if failed:
+        with open(os.path.join(shard_dir, "failed.jsonl"), "w", encoding="utf-8") as f:
+            for item in failed:
+                f.write(json.dumps(item) + "\n")
+    print(f"packed {len(lines) - len(failed)} items into {writer.shard + 1} shard(s) in {shard_dir}, {len(failed)} failed")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pack a train.scp into memory-mapped training shards")
+    parser.add_argument("scp_path")
+    parser.add_argument("shard_dir")
+    parser.add_argument("--shard-size-gb", type=float, default=4.0)
+    parser.add_argument("--sampling-rate", type=int, default=44100)
+    parser.add_argument("--downsample-rate", type=int, default=2048)
+    args = parser.parse_args()
+    convert_scp(
+        args.scp_path, args.shard_dir, shard_size_gb=args.shard_size_gb,
+        sampling_rate=args.sampling_rate, downsample_rate=args.downsample_rate,
+    )
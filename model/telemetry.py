@@ -0,0 +1,166 @@
+"""
+Training throughput telemetry.
+
+TrainingTelemetry aggregates every `window` optimizer steps of Trainer.train into one record:
+data wait vs compute time, samples / real (unpadded) frames / padded frames / lyric tokens per second,
+the memory high-water mark and the EMA update cost. Nothing in a step waits for the device: the step
+and EMA durations are CUDA events and the counters (loss, frames, tokens) stay device tensors,
+all read with a single synchronize when the window closes. Records go to wandb through
+accelerator.log and, with log_path, to a JSONL file.
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import time
+from contextlib import contextmanager
+
+import torch
+
+
+class _Timer:
+    """CUDA event pair on a GPU, host clock otherwise."""
+
+    def __init__(self, cuda):
+        self.cuda = cuda
+
+    def start(self):
+        if self.cuda:
+            self.start_event = torch.cuda.Event(enable_timing=True)
+            self.start_event.record()
+        else:
+            self.start_time = time.perf_counter()
+
+    def stop(self):
+        if self.cuda:
+            self.end_event = torch.cuda.Event(enable_timing=True)
+            self.end_event.record()
+        else:
+            self.end_time = time.perf_counter()
+
+    def seconds(self):
+        """Only after the end event completed, TrainingTelemetry.flush synchronizes first"""
+        if self.cuda:
+            return self.start_event.elapsed_time(self.end_event) / 1000
+        return self.end_time - self.start_time
+
+
+class TrainingTelemetry:
+    def __init__(self, device, window=50, log_path=None, num_processes=1):
+        self.device = torch.device(device)
+        self.cuda = self.device.type == "cuda"
+        self.window = window
+        self.log_path = log_path
+        self.num_processes = num_processes
+        if log_path is not None:
+            os.makedirs(os.path.dirname(os.path.abspath(log_path)), exist_ok=True)
+        self._reset()
+        self._last_step_end = None
+
+    def _reset(self):
+        self.steps = 0
+        self.samples = 0
+        self.padded_frames = 0
+        self.data_wait = 0.0
+        self.checkpoint_time = 0.0
+        self.window_start = None
+        self.step_timers = []
+        self.ema_timers = []
+        self.loss_sum = torch.zeros((), device=self.device)
+        self.real_frames = torch.zeros((), dtype=torch.long, device=self.device)
+        self.tokens = torch.zeros((), dtype=torch.long, device=self.device)
+        if self.cuda:
+            torch.cuda.reset_peak_memory_stats(self.device)
+
+    def start_epoch(self):
+        # the wait for the first batch of an epoch includes starting the workers, it isn't counted
+        self._last_step_end = None
+
+    def batch_ready(self, batch):
+        now = time.perf_counter()
+        if self._last_step_end is not None:
+            self.data_wait += now - self._last_step_end
+        if self.window_start is None:
+            self.window_start = now
+
+        latent = batch["latent"]
+        self.samples += latent.shape[0]
+        self.padded_frames += latent.shape[0] * latent.shape[-1]
+        self.real_frames += batch["latent_lengths"].to(self.device, non_blocking=True).sum()
+        self.tokens += (batch["lrc"] != 0).sum().to(self.device, non_blocking=True)
+
+        timer = _Timer(self.cuda)
+        timer.start()
+        self.step_timers.append(timer)
+
+    @contextmanager
+    def ema(self):
+        timer = _Timer(self.cuda)
+        timer.start()
+        try:
+            yield
+        finally:
+            timer.stop()
+            self.ema_timers.append(timer)
+
+    @contextmanager
+    def checkpoint(self):
+        """Checkpoint snapshots between steps, counted apart from the data wait"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.checkpoint_time += elapsed
+            if self._last_step_end is not None:
+                self._last_step_end += elapsed
+
+    def step_end(self, loss, lr=None):
+        """Closes the step, returns the window's record when it is complete, else None"""
+        self.step_timers[-1].stop()
+        self.loss_sum += loss.detach().float()
+        self.steps += 1
+        self.lr = lr
+        self._last_step_end = time.perf_counter()
+        if self.steps >= self.window:
+            return self.flush()
+        return None
+
+    def flush(self):
+        if self.steps == 0:
+            return None
+        if self.cuda:
+            torch.cuda.synchronize(self.device)
+        wall = max(time.perf_counter() - self.window_start, 1e-9)
+        compute = sum(timer.seconds() for timer in self.step_timers)
+        ema = sum(timer.seconds() for timer in self.ema_timers)
+        real_frames = int(self.real_frames)
+
+        record = {
+            "loss": float(self.loss_sum) / self.steps,
+            "perf/steps": self.steps,
+            "perf/step_time": wall / self.steps,
+            "perf/compute_time": compute / self.steps,
+            "perf/data_wait": self.data_wait / self.steps,
+            "perf/data_wait_fraction": self.data_wait / wall,
+            "perf/ema_time": ema / max(len(self.ema_timers), 1),
+            "perf/checkpoint_time": self.checkpoint_time,
+            "perf/samples_per_sec": self.samples / wall,
+            "perf/real_frames_per_sec": real_frames / wall,
+            "perf/padded_frames_per_sec": self.padded_frames / wall,
+            "perf/padding_efficiency": real_frames / max(self.padded_frames, 1),
+            "perf/tokens_per_sec": int(self.tokens) / wall,
+            "perf/num_processes": self.num_processes,
+        }
+        if self.lr is not None:
+            record["lr"] = self.lr
+        if self.cuda:
+            record["perf/max_memory_allocated_gb"] = torch.cuda.max_memory_allocated(self.device) / 2**30
+            record["perf/max_memory_reserved_gb"] = torch.cuda.max_memory_reserved(self.device) / 2**30
+
+        if self.log_path is not None:
+            with open(self.log_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps({"time": time.time(), **record}) + "\n")
+        self._reset()
+        return record
@@ -0,0 +1,140 @@
+"""
+Latency tracing for the inference pipeline.
+
+A Tracer records named spans (g2p, style_embed, sample, decode, postprocess, ...) of one request,
+and as a SamplingCallback also every sampling step and decoded chunk. A request is written as a
+Chrome trace (chrome://tracing or https://ui.perfetto.dev). With profile=True the spans are also
+torch.profiler ranges, and the exported file is the profiler trace with kernels and the spans together.
+
+Span durations of all requests go to LATENCY_STATS, which keeps percentiles for the process.
+"""
+
+from __future__ import annotations
+
+import json
+import math
+import os
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager, nullcontext
+
+import torch
+
+from model.callbacks import SamplingCallback
+from model.compile_utils import _synchronize
+
+
+class LatencyStats:
+    """Durations of the last `window` occurrences of every span name."""
+
+    def __init__(self, window=1000):
+        self.window = window
+        self.durations = defaultdict(lambda: deque(maxlen=self.window))
+        self.lock = threading.Lock()
+
+    def add(self, name, seconds):
+        with self.lock:
+            self.durations[name].append(seconds)
+
+    def percentiles(self, name, qs=(50, 90, 99)):
+        with self.lock:
+            values = sorted(self.durations[name])
+        if not values:
+            return {}
+        # nearest rank
+        return {f"p{q}": values[max(math.ceil(q / 100 * len(values)), 1) - 1] for q in qs}
+
+    def summary(self):
+        with self.lock:
+            names = list(self.durations)
+        out = {}
+        for name in names:
+            values = list(self.durations[name])
+            out[name] = {"count": len(values), "mean": sum(values) / len(values), **self.percentiles(name)}
+        return out
+
+    def report(self):
+        lines = [f"{'span':<24}{'count':>7}{'mean':>10}{'p50':>10}{'p90':>10}{'p99':>10}"]
+        for name, s in self.summary().items():
+            lines.append(
+                f"{name:<24}{s['count']:>7}{s['mean'] * 1000:>8.1f}ms{s['p50'] * 1000:>8.1f}ms"
+                f"{s['p90'] * 1000:>8.1f}ms{s['p99'] * 1000:>8.1f}ms"
+            )
+        return "\n".join(lines)
+
+
+LATENCY_STATS = LatencyStats()
+
+
+class Tracer(SamplingCallback):
+    def __init__(self, device=None, profile=False, stats=LATENCY_STATS, name="request"):
+        self.device = torch.device(device) if device is not None else None
+        self.stats = stats
+        self.name = name
+        self.events = []
+        self.pid = os.getpid()
+        self.origin = time.perf_counter()
+        self.profiler = None
+        if profile:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if self.device is not None and self.device.type == "cuda":
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.profiler = torch.profiler.profile(activities=activities, record_shapes=True)
+            self.profiler.__enter__()
+
+    def _add(self, name, start, end, **args):
+        self.events.append({
+            "name": name,
+            "ph": "X",
+            "ts": (start - self.origin) * 1e6,
+            "dur": (end - start) * 1e6,
+            "pid": self.pid,
+            "tid": threading.get_ident(),
+            "args": args,
+        })
+        if self.stats is not None:
+            self.stats.add(name, end - start)
+
+    @contextmanager
+    def span(self, name, **args):
+        # the device is synchronized at both ends, so a span holds the GPU work launched inside it
+        if self.device is not None:
+            _synchronize(self.device)
+        record = torch.profiler.record_function(name) if self.profiler is not None else nullcontext()
+        start = time.perf_counter()
+        with record:
+            try:
+                yield
+            finally:
+                if self.device is not None:
+                    _synchronize(self.device)
+                self._add(name, start, time.perf_counter(), **args)
+
+    # SamplingCallback, the step times are already synchronized by the caller
+    def on_step(self, stage, step, total, elapsed):
+        now = time.perf_counter()
+        self._add(f"{stage}_step", now - elapsed, now, step=step, total=total)
+
+    def finish(self, path=None):
+        """Stops the profiler and writes the trace to path (a .json file) if given."""
+        total = time.perf_counter() - self.origin
+        if self.stats is not None:
+            self.stats.add(self.name, total)
+        if self.profiler is not None:
+            self.profiler.__exit__(None, None, None)
+        if path is None:
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        if self.profiler is not None:
+            # the profiler trace already holds the spans as record_function ranges
+            self.profiler.export_chrome_trace(path)
+        else:
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump({"traceEvents": self.events, "displayTimeUnit": "ms"}, f)
+
+
+def trace_span(tracer, name, **args):
+    if tracer is None:
+        return nullcontext()
+    return tracer.span(name, **args)
@@ -31,13 +31,16 @@ from torch.optim.lr_scheduler import LinearLR, SequentialLR, ConstantLR
 
 from accelerate import Accelerator
 from accelerate.utils import DistributedDataParallelKwargs
-from model.dataset import DiffusionDataset
+from model.dataset import DiffusionDataset, DynamicBatchSampler
 
 from torch.utils.data import DataLoader
 
 from ema_pytorch import EMA
 
 from model import CFM
+from model.ema import EMA_MODES, FastEMA
+from model.checkpoint import AsyncCheckpointer, checkpoint_step, is_checkpoint_dir, load_checkpoint_dir
+from model.telemetry import TrainingTelemetry
 from model.utils import exists, default
 
 class Trainer:
@@ -63,10 +66,13 @@ class Trainer:
         last_per_steps=None,
         accelerate_kwargs: dict = dict(),
         ema_kwargs: dict = dict(),
+        ema_mode: str = "ema_pytorch",
         bnb_optimizer: bool = False,
         reset_lr: bool = False,
         use_style_prompt: bool = False,
-        grad_ckpt: bool = False
+        grad_ckpt: bool | int = False,  # True or k, checkpoint every k-th DiT block
+        keep_last_n_checkpoints: int | None = None,
+        telemetry_window: int = 50,
     ):
         self.args = args
 
@@ -108,19 +114,34 @@ class Trainer:
 
         self.model = model
 
-        if self.is_main:
+        # ema_pytorch's EMA on the main rank, or FastEMA (model/ema.py) in one of its modes,
+        # the sharded one runs on every rank. Both take the same ema_kwargs with the same meaning
+        # (beta is the decay applied once per update, every update_every steps) and average alike
+        if ema_mode not in ["ema_pytorch"] + EMA_MODES:
+            raise ValueError(f"Unknown ema_mode {ema_mode}, expected ema_pytorch or one of {EMA_MODES}")
+        self.ema_mode = ema_mode
+        self.has_ema = self.is_main or ema_mode == "sharded"
+        if ema_mode == "ema_pytorch" and self.is_main:
             self.ema_model = EMA(model, include_online_model=False, **ema_kwargs)
 
             self.ema_model.to(self.accelerator.device)
             if self.accelerator.state.distributed_type in ["DEEPSPEED", "FSDP"]:
                 self.ema_model.half()
+        elif ema_mode != "ema_pytorch" and self.has_ema:
+            self.ema_model = FastEMA(
+                model, mode=ema_mode, rank=self.accelerator.process_index,
+                world_size=self.accelerator.num_processes, **ema_kwargs,
+            )
 
         self.epochs = epochs
         self.num_warmup_updates = num_warmup_updates
         self.save_per_updates = save_per_updates
         self.last_per_steps = default(last_per_steps, save_per_updates * grad_accumulation_steps)
         self.checkpoint_path = default(checkpoint_path, "ckpts/test_e2-tts")
+        self.checkpointer = AsyncCheckpointer(self.checkpoint_path, keep_last_n=keep_last_n_checkpoints)
 
+        self.batch_size = batch_size
+        self.batch_size_type = batch_size_type
         self.max_samples = max_samples
         self.grad_accumulation_steps = grad_accumulation_steps
         self.max_grad_norm = max_grad_norm
@@ -135,6 +156,14 @@ class Trainer:
 
         self.grad_ckpt = grad_ckpt
 
+        # loss and throughput are logged once per window of steps, see model/telemetry.py
+        self.telemetry = TrainingTelemetry(
+            self.accelerator.device,
+            window=telemetry_window,
+            log_path=os.path.join(self.checkpoint_path, "telemetry.jsonl") if self.accelerator.is_local_main_process else None,
+            num_processes=self.accelerator.num_processes,
+        )
+
         if bnb_optimizer:
             import bitsandbytes as bnb
 
@@ -169,6 +198,22 @@ class Trainer:
     def get_dataloader(self):
         print(self.args)
         dd = DiffusionDataset(self.args.file_path, self.args.max_frames, self.args.min_frames, self.args.sampling_rate, self.args.downsample_rate, self.precision)
+        self.batch_sampler = None
+        if self.batch_size_type == "frame":
+            # batch_size is a budget of padded frames per batch and process
+            self.batch_sampler = DynamicBatchSampler(
+                dd.frame_lengths(), self.batch_size, max_samples=self.max_samples,
+                num_replicas=self.accelerator.num_processes, seed=getattr(self.args, "seed", 0),
+            )
+            self.train_dataloader = DataLoader(
+                dataset=dd,
+                batch_sampler=self.batch_sampler,
+                num_workers=4,
+                pin_memory=True,
+                collate_fn=dd.custom_collate_fn,
+                persistent_workers=True
+            )
+            return
         self.train_dataloader = DataLoader(
             dataset=dd,
             batch_size=self.args.batch_size,
@@ -185,7 +230,10 @@ class Trainer:
         return self.accelerator.is_main_process
 
     def save_checkpoint(self, step, last=False):
-        self.accelerator.wait_for_everyone()
+        if self.ema_mode == "sharded":
+            self.ema_model.gather()
+        # only the main rank snapshots its (DDP-replicated) state to host memory, the other ranks
+        # keep training and the files are written in the background
         if self.is_main:
             checkpoint = dict(
                 model_state_dict=self.accelerator.unwrap_model(self.model).state_dict(),
@@ -194,13 +242,34 @@ class Trainer:
                 scheduler_state_dict=self.scheduler.state_dict(),
                 step=step,
             )
-            if not os.path.exists(self.checkpoint_path):
-                os.makedirs(self.checkpoint_path)
             if last:
-                self.accelerator.save(checkpoint, f"{self.checkpoint_path}/model_last.pt")
-                print(f"Saved last checkpoint at step {step}")
+                self.checkpointer.save(checkpoint, "model_last", step)
+                print(f"Saving last checkpoint at step {step}")
             else:
-                self.accelerator.save(checkpoint, f"{self.checkpoint_path}/model_{step}.pt")
+                self.checkpointer.save(checkpoint, f"model_{step}", step)
+
+    def latest_checkpoint(self):
+        """
+        Path of the checkpoint to resume from: safetensors directories first, then .pt files.
+        None when there is none, the directory may only hold telemetry.jsonl or an unfinished model_*.tmp
+        """
+        names = os.listdir(self.checkpoint_path)
+        dirs = [
+            os.path.join(self.checkpoint_path, name) for name in names
+            if name.startswith("model_") and not name.endswith((".tmp", ".old"))
+        ]
+        dirs = [path for path in dirs if is_checkpoint_dir(path)]
+        if dirs:
+            return max(dirs, key=checkpoint_step)
+
+        if "model_last.pt" in names:
+            latest_checkpoint = "model_last.pt"
+        else:
+            checkpoints = [f for f in names if f.endswith(".pt")]
+            if not checkpoints:
+                return None
+            latest_checkpoint = max(checkpoints, key=lambda x: int("".join(filter(str.isdigit, x)) or 0))
+        return os.path.join(self.checkpoint_path, latest_checkpoint)
 
     def load_checkpoint(self):
         if (
@@ -211,15 +280,13 @@ class Trainer:
             return 0
 
         self.accelerator.wait_for_everyone()
-        if "model_last.pt" in os.listdir(self.checkpoint_path):
-            latest_checkpoint = "model_last.pt"
+        latest_checkpoint = self.latest_checkpoint()
+        if latest_checkpoint is None:
+            return 0
+        if os.path.isdir(latest_checkpoint):
+            checkpoint = load_checkpoint_dir(latest_checkpoint)
         else:
-            latest_checkpoint = sorted(
-                [f for f in os.listdir(self.checkpoint_path) if f.endswith(".pt")],
-                key=lambda x: int("".join(filter(str.isdigit, x))),
-            )[-1]
-
-        checkpoint = torch.load(f"{self.checkpoint_path}/{latest_checkpoint}", map_location="cpu")
+            checkpoint = torch.load(latest_checkpoint, map_location="cpu")
 
         if self.is_main:
             ema_dict = self.ema_model.state_dict()
@@ -231,6 +298,8 @@ class Trainer:
             }
 
             self.ema_model.load_state_dict(filtered_ema_dict, strict=False)
+        if self.ema_mode == "sharded":
+            self.ema_model.scatter()
 
         model_dict = self.accelerator.unwrap_model(self.model).state_dict()
         checkpoint_model_dict = checkpoint["model_state_dict"]
@@ -270,6 +339,9 @@ class Trainer:
 
         for epoch in range(skipped_epoch, self.epochs):
             self.model.train()
+            if self.batch_sampler is not None:
+                self.batch_sampler.set_epoch(epoch)
+            self.telemetry.start_epoch()
             if resumable_with_seed > 0 and epoch == skipped_epoch:
                 progress_bar = tqdm(
                     skipped_dataloader,
@@ -290,6 +362,7 @@ class Trainer:
                 )
 
             for batch in progress_bar:
+                self.telemetry.batch_ready(batch)
                 with self.accelerator.accumulate(self.model):
                     text_inputs = batch["lrc"]
                     mel_spec = batch["latent"].permute(0, 2, 1)
@@ -313,22 +386,27 @@ class Trainer:
                     self.scheduler.step()
                     self.optimizer.zero_grad()
 
-                if self.is_main:
-                    self.ema_model.update()
+                if self.has_ema:
+                    with self.telemetry.ema():
+                        self.ema_model.update()
 
                 global_step += 1
 
-                if self.accelerator.is_local_main_process:
-                    self.accelerator.log({"loss": loss.item(), "lr": self.scheduler.get_last_lr()[0]}, step=global_step)
-
-                progress_bar.set_postfix(step=str(global_step), loss=loss.item())
+                # no loss.item() here, the loss stays on device until the telemetry window closes
+                metrics = self.telemetry.step_end(loss, lr=self.scheduler.get_last_lr()[0])
+                if metrics is not None:
+                    if self.accelerator.is_local_main_process:
+                        self.accelerator.log(metrics, step=global_step)
+                    progress_bar.set_postfix(step=str(global_step), loss=metrics["loss"])
 
-                if global_step % (self.save_per_updates * self.grad_accumulation_steps) == 0:
-                    self.save_checkpoint(global_step)
+                with self.telemetry.checkpoint():
+                    if global_step % (self.save_per_updates * self.grad_accumulation_steps) == 0:
+                        self.save_checkpoint(global_step)
 
-                if global_step % self.last_per_steps == 0:
-                    self.save_checkpoint(global_step, last=True)
+                    if global_step % self.last_per_steps == 0:
+                        self.save_checkpoint(global_step, last=True)
 
         self.save_checkpoint(global_step, last=True)
+        self.checkpointer.wait()
 
         self.accelerator.end_training()